@@ -4,5 +4,5 @@ from .cfg import Settings  # noqa
 
 settings = Settings()
 
-from .api import Downloader, Item, Response, Request, Spider, Task, Throttle  # noqa
-from .storage import Storage  # noqa
+from .api import AdaptiveThrottle, Downloader, Item, Response, Request, Spider, Task, Throttle  # noqa
+from .storage import SqliteStorage, Storage  # noqa
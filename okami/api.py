@@ -1,10 +1,17 @@
+import asyncio
+import hashlib
 import logging
 import time
+from collections import OrderedDict, deque
 
+import aiohttp
+import aiohttp.abc
+import aiohttp.resolver
+import lxml.etree
 import lxml.html
 
 from okami import constants, settings, signals, utils
-from okami.exceptions import SpiderException
+from okami.exceptions import ResponseRejectedException, SpiderException
 
 log = logging.getLogger(__name__)
 
@@ -15,10 +22,16 @@ class BaseSpider:
 
     :cvar name: unique spider name
     :cvar urls: (dictionary)
+    :cvar stream: tuple of tag names, enables streaming of responses into elements with these tags
+    :cvar max_body_size: maximum size of response body in bytes, CONN_MAX_BODY_SIZE if None
+    :cvar content_types: tuple of allowed response content types, CONN_CONTENT_TYPES if None
     """
 
     name = None
     urls = None
+    stream = None
+    max_body_size = None
+    content_types = None
 
     async def items(self, task, response):
         """
@@ -38,13 +51,34 @@ class BaseSpider:
         :returns: tuple of (Set[Task <okami.Task>], List[Item <okami.Item>])
         """
         try:
+            if response.content is not None:
+                tasks, items = set(), []
+                async for element in response.iterparse(tag=self.stream):
+                    t, i = await self.element(task=task, response=response, element=element)
+                    tasks |= t
+                    items.extend(i)
+                return tasks, items
             return (
                 await self.tasks(task=task, response=response),
                 await self.items(task=task, response=response),
             )
+        except ResponseRejectedException:
+            raise
         except Exception as e:
             raise SpiderException(e) from e
 
+    async def element(self, task, response, element):
+        """
+        In case streaming is enabled with `stream` this method should be implemented to process every streamed
+        element as it is closed. Element is cleared afterwards so it should not be kept.
+
+        :param task: Task <okami.Task>
+        :param response: Response <okami.Response>
+        :param element: lxml.etree._Element
+        :returns: tuple of (Set[Task <okami.Task>], List[Item <okami.Item>])
+        """
+        raise NotImplementedError
+
     def request(self):
         """
         Defines a dictionary of extra arguments to pass in HTTP request.
@@ -87,13 +121,142 @@ class BaseSpider:
         :param response: Response <okami.Response>
         :returns: Set[Task <okami.Task>]
         """
-        document = lxml.html.document_fromstring(html=response.text)
-        urls = set()
-        for xp in self.urls.get("allow", []):
-            urls |= {utils.parse_domain_url(domain=str(response.url), url=str(u)) for u in document.xpath(xp)}
-        for xp in self.urls.get("avoid", []):
-            urls -= {utils.parse_domain_url(domain=str(response.url), url=str(u)) for u in document.xpath(xp)}
-        return {Task(url=url) for url in urls}
+        allow = utils.compile_xpath(tuple(self.urls.get("allow", [])))
+        if allow is None:
+            return set()
+        avoid = utils.compile_xpath(tuple(self.urls.get("avoid", [])))
+        domain = str(response.url)
+        avoided = set()
+        if avoid is not None:
+            avoided = {utils.parse_domain_url(domain=domain, url=str(u)) for u in set(avoid(response.document))}
+        urls = {utils.parse_domain_url(domain=domain, url=str(u)) for u in set(allow(response.document))}
+        return {Task(url=url) for url in urls - avoided}
+
+
+class Bucket:
+    """
+    Bucket <okami.api.Bucket>
+
+    Token bucket controlling request rate and concurrency for a single host.
+
+    Bucket is also a circuit breaker of a host. After `max_failures` consecutive failed requests the circuit opens
+    and no request is allowed for `recovery` seconds. Then the circuit is half-open and allows a single trial request,
+    its success closes the circuit and its failure opens it again.
+
+    :param max_rps: (float) maximum number of requests per second
+    :param max_concurrent: (int) maximum number of concurrent requests
+    :param burst: (int) maximum number of requests allowed at once after being idle
+    :param max_failures: (int) number of consecutive failures opening circuit, circuit never opens if None
+    :param recovery: (float) seconds circuit stays open
+
+    :ivar tokens: (float) currently available tokens
+    :ivar active: (int) number of requests in progress
+    :ivar requests: (int) number of requests
+    :ivar throttled: (int) number of times a request was not allowed
+    :ivar circuit: (str) circuit state, CLOSED, OPEN or HALF_OPEN
+    :ivar failures: (int) number of consecutive failures
+    :ivar opened: (int) number of times circuit opened
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, max_rps=None, max_concurrent=None, burst=None, max_failures=None, recovery=30.0):
+        self.max_rps = float(max_rps) if max_rps else None
+        self.max_concurrent = max_concurrent
+        self.burst = float(burst or 1)
+        self.tokens = self.burst
+        self.time_last_modified = time.time()
+        self.condition = asyncio.Condition()
+        self.active = 0
+        self.requests = 0
+        self.throttled = 0
+        self.max_failures = max_failures
+        self.recovery = float(30.0 if recovery is None else recovery)
+        self.circuit = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.time_opened = None
+        self.trial = False
+
+    async def __aenter__(self):
+        if self.max_concurrent:
+            async with self.condition:
+                await self.condition.wait_for(lambda: self.active < self.max_concurrent)
+        self.active += 1
+        self.requests += 1
+        return self
+
+    async def __aexit__(self, exc, value, traceback):
+        self.active -= 1
+        if self.max_concurrent:
+            async with self.condition:
+                self.condition.notify_all()
+
+    def to_dict(self):
+        return dict(
+            requests=self.requests,
+            throttled=self.throttled,
+            tokens=self.tokens,
+            circuit=self.circuit,
+            opened=self.opened,
+        )
+
+    def wait(self):
+        """
+        Refills tokens for time passed since last call. Open circuit turns half-open once `recovery` seconds passed.
+
+        :returns: (float) time until a request is allowed
+        """
+        if self.circuit == self.OPEN:
+            remaining = self.time_opened + self.recovery - time.time()
+            if remaining > 0:
+                return remaining
+            self.circuit = self.HALF_OPEN
+            self.trial = False
+        if self.circuit == self.HALF_OPEN and self.trial:
+            return self.recovery
+        if not self.max_rps:
+            return 0.0
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.time_last_modified) * self.max_rps)
+        self.time_last_modified = now
+        return max(0.0, (1.0 - self.tokens) / self.max_rps)
+
+    def take(self):
+        """
+        Takes a token for a single request if one is available.
+
+        :returns: (float) 0.0 if request is allowed otherwise time until a request is allowed
+        """
+        delay = self.wait()
+        if delay:
+            self.throttled += 1
+            return delay
+        if self.circuit == self.HALF_OPEN:
+            self.trial = True
+        if self.max_rps:
+            self.tokens -= 1.0
+        return 0.0
+
+    def success(self):
+        """
+        Records successful request, closes circuit.
+        """
+        self.failures = 0
+        self.circuit = self.CLOSED
+
+    def failure(self):
+        """
+        Records failed request, opens circuit after `max_failures` consecutive failures or on failed trial request.
+        """
+        self.failures += 1
+        if self.circuit == self.HALF_OPEN or (self.max_failures and self.failures >= self.max_failures):
+            if self.circuit != self.OPEN:
+                self.opened += 1
+            self.circuit = self.OPEN
+            self.time_opened = time.time()
 
 
 class Downloader:
@@ -106,14 +269,25 @@ class Downloader:
     def __init__(self, controller):
         self.controller = controller
 
+    def initialise(self):
+        pass
+
+    def finalise(self):
+        pass
+
     async def process(self, request):
         """
         Makes an actual HTTP request against a processing website's URL.
 
+        When spider streams responses, body is not read and response has to be released. Responses of content types
+        not allowed or with body over size limit are rejected as soon as known, before the rest of body is read.
+        Requests are limited by CONN_TIMEOUT, CONN_CONNECT_TIMEOUT and CONN_READ_TIMEOUT.
+
         :param request: Request <okami.Request>
         :returns: Response <okami.Response>
+        :raises: ResponseRejectedException <okami.exceptions.ResponseRejectedException>
         """
-        async with self.controller.session.request(
+        response = await self.controller.session.request(
             **{
                 **dict(
                     method=constants.method.GET,
@@ -121,20 +295,96 @@ class Downloader:
                     headers=request.headers,
                     allow_redirects=bool(settings.CONN_MAX_HTTP_REDIRECTS),
                     max_redirects=settings.CONN_MAX_HTTP_REDIRECTS,
+                    timeout=self.timeout,
                 ),
                 **self.controller.spider.request(),
             }
-        ) as response:
-            response = Response(
+        )
+        try:
+            stream = bool(self.controller.spider.stream)
+            size = self.max_body_size
+            self.check(response=response, size=size)
+            result = Response(
                 url=response.url,
                 version=response.version,
                 status=response.status,
                 reason=response.reason,
                 headers=response.headers,
-                text=await response.text(),
+                body=None if stream else await self.read(response=response, size=size),
+                content=response.content if stream else None,
+                encoding=response.charset,
+                release=response.release if stream else None,
+                max_body_size=size,
+                request_url=request.url,
             )
-            await signals.response_created.send(sender=self, response=response, response_created=True)
-            return response
+            await signals.response_created.send(sender=self, response=result, response_created=True)
+        except ResponseRejectedException:
+            response.close()
+            raise
+        except BaseException:
+            response.release()
+            raise
+        if not stream:
+            response.release()
+        return result
+
+    @property
+    def timeout(self):
+        return aiohttp.ClientTimeout(
+            total=settings.CONN_TIMEOUT, connect=settings.CONN_CONNECT_TIMEOUT, sock_read=settings.CONN_READ_TIMEOUT
+        )
+
+    @property
+    def max_body_size(self):
+        size = self.controller.spider.max_body_size
+        return settings.CONN_MAX_BODY_SIZE if size is None else size
+
+    @property
+    def content_types(self):
+        types = self.controller.spider.content_types
+        return settings.CONN_CONTENT_TYPES if types is None else types
+
+    def check(self, response, size):
+        """
+        Rejects response by its headers, content type not in allowed content types or content length over size.
+        Responses 304 Not Modified have no body and are never rejected.
+
+        :param response: aiohttp.ClientResponse
+        :param size: (int) maximum size of response body in bytes or None
+        :raises: ResponseRejectedException <okami.exceptions.ResponseRejectedException>
+        """
+        if response.status == constants.status.HTTP_304:
+            return
+        types = self.content_types
+        if types is not None and response.content_type not in types:
+            raise ResponseRejectedException(
+                "Content type {} of {} not allowed".format(response.content_type, response.url)
+            )
+        if size is not None and (response.content_length or 0) > size:
+            raise ResponseRejectedException(
+                "Content length {} of {} over {} bytes".format(response.content_length, response.url, size)
+            )
+
+    @staticmethod
+    async def read(response, size, chunk=2 ** 16):
+        """
+        Reads response body in chunks, stops reading as soon as body is over size.
+
+        :param response: aiohttp.ClientResponse
+        :param size: (int) maximum size of response body in bytes or None
+        :param chunk: (int) size of body chunks in bytes
+        :returns: (bytes)
+        :raises: ResponseRejectedException <okami.exceptions.ResponseRejectedException>
+        """
+        if size is None:
+            return await response.read()
+        chunks, length = [], 0
+        async for data in response.content.iter_chunked(chunk):
+            length += len(data)
+            if length > size:
+                raise ResponseRejectedException("Body of {} over {} bytes".format(response.url, size))
+            chunks.append(data)
+        return b"".join(chunks)
 
 
 class Item:
@@ -151,6 +401,53 @@ class Item:
         raise NotImplementedError
 
 
+class KeyCache:
+    """
+    KeyCache <okami.api.KeyCache>
+
+    Bounded LRU cache of delta keys of tasks shared by delta middlewares. Keys are cached by task, which assumes
+    Spider.hash <okami.Spider> depends only on the task. Keys are computed from tasks with canonical URLs when
+    CANONICAL_ENABLED is set, so links found with a different URL of an already processed page get its key. Hits and
+    misses are counted in Stats <okami.api.Stats>.
+
+    :param controller: Controller <okami.engine.Controller>
+    :param size: (int) maximum number of cached keys, 0 disables cache
+    """
+
+    def __init__(self, controller, size):
+        self.controller = controller
+        self.size = int(size)
+        self.keys = OrderedDict()
+        self.key_hits = "key_cache/hits"
+        self.key_misses = "key_cache/misses"
+        self.controller.stats.set(self.key_hits, 0)
+        self.controller.stats.set(self.key_misses, 0)
+
+    async def get(self, task, response):
+        """
+        Returns delta key of a task, Spider.hash <okami.Spider> or sha1 of canonical task URL.
+
+        :param task: Task <okami.Task>
+        :param response: Response <okami.Response>
+        :returns: (str)
+        """
+        key = self.keys.get(task)
+        if key is not None:
+            self.keys.move_to_end(task)
+            self.controller.stats.incr(key=self.key_hits)
+            return key
+
+        self.controller.stats.incr(key=self.key_misses)
+        canonical = task.canonical()
+        key = await self.controller.spider.hash(task=canonical, response=response)
+        key = key or hashlib.sha1(canonical.url.encode()).hexdigest()
+        if self.size:
+            self.keys[task] = key
+            if len(self.keys) > self.size:
+                self.keys.popitem(last=False)
+        return key
+
+
 class Request:
     """
     Request <okami.Request>
@@ -173,16 +470,140 @@ class Response:
     :param status: HTTP status code
     :param reason: HTTP status text
     :param headers: (dictionary) of HTTP headers
-    :param text: HTTP response body content
+    :param text: HTTP response body content, decoded from body on first access if not passed
+    :param body: (bytes) HTTP response body
+    :param content: aiohttp.StreamReader of HTTP response body of streamed response, text and body are None
+    :param encoding: HTTP response body encoding from headers
+    :param release: function releasing connection of streamed response
+    :param max_body_size: (int) maximum size of streamed response body in bytes, no limit if None
+    :param request_url: URL of Request <okami.Request> as requested, before redirects and normalisation
     """
 
-    def __init__(self, url, version, status, reason, headers, text):
+    def __init__(
+        self,
+        url,
+        version,
+        status,
+        reason,
+        headers,
+        text=None,
+        body=None,
+        content=None,
+        encoding=None,
+        release=None,
+        max_body_size=None,
+        request_url=None,
+    ):
         self.url = url
         self.version = version
         self.status = status
         self.reason = reason
         self.headers = headers
-        self.text = text
+        self.body = body
+        self.content = content
+        self.encoding = encoding
+        self._text = text
+        self._charset = None
+        self._release = release
+        self._document = None
+        self.max_body_size = max_body_size
+        self.request_url = request_url
+
+    @property
+    def charset(self):
+        """
+        Encoding of HTTP response body, from headers or detected from body, see
+        utils.detect_encoding <okami.utils.detect_encoding>.
+
+        :returns: (str)
+        """
+        if self._charset is None:
+            self._charset = self.encoding or (utils.detect_encoding(self.body) if self.body is not None else None)
+        return self._charset
+
+    @property
+    def text(self):
+        """
+        HTTP response body decoded on first access with response charset. Undecodable bytes are replaced.
+
+        :returns: (str)
+        """
+        if self._text is None and self.body is not None:
+            self._text = str(self.body, self.charset, "replace")
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self._text = value
+
+    @property
+    def document(self):
+        """
+        HTML document parsed from response on first access and reused afterwards. Body is parsed without decoding
+        unless text was passed or set.
+
+        :returns: lxml.html.HtmlElement
+        """
+        if self._document is None:
+            if self.body is not None and self._text is None:
+                parser = lxml.html.HTMLParser(encoding=self.charset)
+                self._document = lxml.html.document_fromstring(html=bytes(self.body), parser=parser)
+            else:
+                self._document = lxml.html.document_fromstring(html=self.text)
+        return self._document
+
+    def xpath(self, path, **kwargs):
+        """
+        Evaluates XPath expression on response document.
+
+        :param path: XPath expression
+        :returns: List of results
+        """
+        return self.document.xpath(path, **kwargs)
+
+    async def iterparse(self, tag=None, size=2 ** 16):
+        """
+        Parses streamed response body incrementally and yields elements as they are closed. Every element is
+        cleared together with its preceding siblings once the next element is requested, so memory stays bounded.
+        Parsing stops once more than `max_body_size` bytes are read.
+
+        :param tag: tag name or tuple of tag names to yield, all elements by default
+        :param size: (int) size of body chunks in bytes
+        :returns: async generator of lxml.etree._Element
+        :raises: ResponseRejectedException <okami.exceptions.ResponseRejectedException>
+        """
+        parser = lxml.etree.HTMLPullParser(events=("end",), tag=tag, encoding=self.encoding)
+        empty, length = True, 0
+        async for chunk in self.content.iter_chunked(size):
+            empty = empty and not chunk
+            length += len(chunk)
+            if self.max_body_size is not None and length > self.max_body_size:
+                raise ResponseRejectedException("Body of {} over {} bytes".format(self.url, self.max_body_size))
+            parser.feed(chunk)
+            for _, element in parser.read_events():
+                yield element
+                self.clear(element=element)
+        if empty:
+            return
+        parser.close()
+        for _, element in parser.read_events():
+            yield element
+            self.clear(element=element)
+
+    @staticmethod
+    def clear(element):
+        element.clear()
+        parent = element.getparent()
+        while parent is not None and element.getprevious() is not None:
+            del parent[0]
+
+    def release(self):
+        """
+        Releases connection of streamed response.
+        """
+        if self._release is not None:
+            self._release()
+            self._release = None
 
 
 class Result:
@@ -227,6 +648,10 @@ class Stats:
             self.data["storage/{}".format(k)] = v
         for k, v in self.controller.throttle.to_dict().items():
             self.data["throttle/{}".format(k)] = v
+        for k, v in self.controller.connections.to_dict().items():
+            self.data["connector/{}".format(k)] = v
+        for k, v in self.controller.resolver.to_dict().items():
+            self.data["resolver/{}".format(k)] = v
         return self.data
 
     def get(self, key, default=None):
@@ -242,6 +667,208 @@ class Stats:
         self.data[key] += value
 
 
+class Connections:
+    """
+    Connections <okami.api.Connections>
+
+    Counts connections and DNS lookups of a session connector with aiohttp.TraceConfig. Pass `trace` in session
+    `trace_configs` and set `connector` to report its open connections, see `pool`.
+
+    :ivar trace: aiohttp.TraceConfig
+    :ivar connector: aiohttp.TCPConnector or None
+    :ivar created: (int) number of new connections
+    :ivar reused: (int) number of requests made on a kept alive connection
+    :ivar queued: (int) number of requests which waited for a free connection
+    :ivar dns_hits: (int) number of hosts resolved from DNS cache
+    :ivar dns_misses: (int) number of hosts resolved with a DNS query
+    """
+
+    def __init__(self):
+        self.connector = None
+        self.created = 0
+        self.reused = 0
+        self.queued = 0
+        self.dns_hits = 0
+        self.dns_misses = 0
+        self.warned = False
+        self.trace = aiohttp.TraceConfig()
+        self.trace.on_connection_create_end.append(self.on_connection_created)
+        self.trace.on_connection_reuseconn.append(self.on_connection_reused)
+        self.trace.on_connection_queued_start.append(self.on_connection_queued)
+        self.trace.on_dns_cache_hit.append(self.on_dns_cache_hit)
+        self.trace.on_dns_cache_miss.append(self.on_dns_cache_miss)
+
+    async def on_connection_created(self, session, context, params):
+        self.created += 1
+
+    async def on_connection_reused(self, session, context, params):
+        self.reused += 1
+
+    async def on_connection_queued(self, session, context, params):
+        self.queued += 1
+
+    async def on_dns_cache_hit(self, session, context, params):
+        self.dns_hits += 1
+
+    async def on_dns_cache_miss(self, session, context, params):
+        self.dns_misses += 1
+
+    def pool(self):
+        """
+        Reads connection pool of connector. aiohttp has no public API for it, so private `_acquired` set and `_conns`
+        dictionary of aiohttp.BaseConnector are read, both present in all supported aiohttp versions. When connector
+        is not set or aiohttp does not expose them, pool is not reported, a warning is logged once in the latter case.
+
+        :returns: tuple of (int, int) numbers of connections in use and kept alive idle connections, or (None, None)
+        """
+        acquired = getattr(self.connector, "_acquired", None)
+        conns = getattr(self.connector, "_conns", None)
+        if acquired is None or conns is None:
+            if self.connector is not None and not self.warned:
+                log.warning("Connection pool of %s not reported, aiohttp does not expose it", self.connector)
+                self.warned = True
+            return None, None
+        return len(acquired), sum(len(c) for c in conns.values())
+
+    def to_dict(self):
+        connections = self.created + self.reused
+        lookups = self.dns_hits + self.dns_misses
+        acquired, idle = self.pool()
+        return dict(
+            open=None if acquired is None else acquired + idle,
+            acquired=acquired,
+            created=self.created,
+            reused=self.reused,
+            queued=self.queued,
+            reuse_ratio=self.reused / connections if connections else 0.0,
+            dns_hits=self.dns_hits,
+            dns_misses=self.dns_misses,
+            dns_hit_ratio=self.dns_hits / lookups if lookups else 0.0,
+        )
+
+
+class Resolver(aiohttp.abc.AbstractResolver):
+    """
+    Resolver <okami.api.Resolver>
+
+    DNS resolver keeping resolved host addresses in a cache shared by sessions. Hosts are resolved in background with
+    `prefetch` before they are requested, so requests do not wait for DNS lookups. Lookups run in aiohttp default
+    resolver, at most `max_concurrent` at once.
+
+    :param ttl: (float) seconds addresses are cached for, None caches them forever, 0 disables cache
+    :param max_concurrent: (int) maximum number of concurrent lookups
+
+    :ivar hits: (int) number of resolutions served from cache or from a pending lookup
+    :ivar misses: (int) number of resolutions which had to look host up
+    :ivar prefetched: (int) number of hosts looked up in background
+    :ivar failed: (int) number of failed background lookups
+    """
+
+    def __init__(self, ttl=10, max_concurrent=10):
+        self.ttl = ttl
+        self.semaphore = asyncio.Semaphore(value=max_concurrent)
+        self.resolver = None
+        self.cache = dict()
+        self.pending = dict()
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.failed = 0
+
+    def cached(self, key):
+        """
+        :param key: tuple of (host, family)
+        :returns: cached addresses or None when not cached or expired
+        """
+        if key not in self.cache:
+            return None
+        time_resolved, addresses = self.cache[key]
+        if self.ttl is not None and time.time() - time_resolved > self.ttl:
+            del self.cache[key]
+            return None
+        return addresses
+
+    async def lookup(self, key):
+        if self.resolver is None:
+            self.resolver = aiohttp.resolver.DefaultResolver()
+        async with self.semaphore:
+            addresses = await self.resolver.resolve(key[0], 0, family=key[1])
+        if self.ttl != 0:
+            self.cache[key] = (time.time(), addresses)
+        return addresses
+
+    def fetch(self, key):
+        """
+        Starts a lookup unless the same host is being looked up already.
+
+        :param key: tuple of (host, family)
+        :returns: asyncio.Future of addresses
+        """
+        if key not in self.pending:
+            future = asyncio.ensure_future(self.lookup(key=key))
+            future.add_done_callback(lambda f: self.pending.pop(key, None))
+            self.pending[key] = future
+        return self.pending[key]
+
+    def prefetch(self, host, family=0):
+        """
+        Looks passed host up in background unless it is an IP address, is cached or is being looked up already.
+
+        :param host: host name
+        :param family: address family, any by default as used by aiohttp.TCPConnector
+        """
+        key = (host, family)
+        if not host or utils.is_ip_address(host) or key in self.pending or self.cached(key) is not None:
+            return
+        self.prefetched += 1
+        self.fetch(key=key).add_done_callback(self.prefetch_done)
+
+    def prefetch_done(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            self.failed += 1
+            log.debug("DNS prefetch failed: {}".format(future.exception()))
+
+    async def resolve(self, host, port=0, family=0):
+        """
+        Returns cached addresses of host, waits for a pending lookup of host or looks host up.
+
+        :param host: host name
+        :param port: port
+        :param family: address family
+        :returns: List[dictionary] of addresses as returned by aiohttp resolvers
+        """
+        key = (host, family)
+        addresses = self.cached(key)
+        if addresses is None and key in self.pending:
+            addresses = await asyncio.shield(self.pending[key])
+        if addresses is None:
+            self.misses += 1
+            addresses = await asyncio.shield(self.fetch(key=key))
+        else:
+            self.hits += 1
+        return [dict(address, port=port) for address in addresses]
+
+    async def close(self):
+        """
+        Cancels pending lookups, keeps cached addresses. Resolver is shared, sessions do not close it.
+        """
+        for future in list(self.pending.values()):
+            future.cancel()
+        self.pending.clear()
+
+    def to_dict(self):
+        resolutions = self.hits + self.misses
+        return dict(
+            cached=len(self.cache),
+            pending=len(self.pending),
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=self.hits / resolutions if resolutions else 0.0,
+            prefetched=self.prefetched,
+            failed=self.failed,
+        )
+
+
 class State:
     """
     State <okami.api.State>
@@ -299,6 +926,24 @@ class Task:
     def __ne__(self, other):
         return not (self == other)
 
+    def canonical(self):
+        """
+        Returns Task <okami.Task> with canonical URL, see utils.canonical_url <okami.utils.canonical_url> and
+        CANONICAL_* settings, or this task when its URL is canonical already or CANONICAL_ENABLED is not set.
+
+        :returns: Task <okami.Task>
+        """
+        if not settings.CANONICAL_ENABLED:
+            return self
+        url = utils.canonical_url(
+            url=self.url,
+            sort_query=settings.CANONICAL_SORT_QUERY,
+            drop_fragment=settings.CANONICAL_DROP_FRAGMENT,
+            drop_params=tuple(settings.CANONICAL_DROP_PARAMS),
+            strip_www=settings.CANONICAL_STRIP_WWW,
+        )
+        return self if url == self.url else Task(url=url, data=self.data)
+
     @classmethod
     def from_dict(cls, data):
         """
@@ -331,17 +976,44 @@ class Throttle:
     :param sleep: (float) sleep time between requests
     :param max_rps: (float) maximum number of requests per second
     :param fn: (function) custom function for calculating sleep time
+    :param host_max_rps: (float) maximum number of requests per second for every host
+    :param host_max_concurrent: (int) maximum number of concurrent requests for every host
+    :param host_burst: (int) maximum number of requests at once for every host after being idle
+    :param host_max_failures: (int) number of consecutive connection errors of a host opening its circuit
+    :param host_recovery: (float) seconds circuit of a host stays open before a trial request
+    :param hosts: (dictionary) of host and dictionary of host_* arguments without prefix, overrides for a single host
 
     :ivar time_started: (float) time at start
     :ivar time_last_modified: (float) time at last request
     :ivar state: State <okami.api.State>
+    :ivar buckets: (dictionary) of host and Bucket <okami.api.Bucket>
     """
 
-    def __init__(self, sleep=None, max_rps=None, fn=None):
+    def __init__(
+        self,
+        sleep=None,
+        max_rps=None,
+        fn=None,
+        host_max_rps=None,
+        host_max_concurrent=None,
+        host_burst=None,
+        host_max_failures=5,
+        host_recovery=30.0,
+        hosts=None,
+    ):
         self.fn = fn
         self.time_started = time.time()
         self.time_last_modified = None
         self.state = State(sleep=sleep, max_rps=max_rps)
+        self.host_settings = dict(
+            max_rps=host_max_rps,
+            max_concurrent=host_max_concurrent,
+            burst=host_burst,
+            max_failures=host_max_failures,
+            recovery=host_recovery,
+        )
+        self.hosts = hosts or dict()
+        self.buckets = dict()
 
     def __enter__(self):
         return self
@@ -350,7 +1022,12 @@ class Throttle:
         pass
 
     def to_dict(self):
-        return self.state.to_dict()
+        return dict(
+            **self.state.to_dict(),
+            hosts=len(self.buckets),
+            hosts_open=sum(b.circuit != Bucket.CLOSED for b in self.buckets.values()),
+            opened=sum(b.opened for b in self.buckets.values()),
+        )
 
     def calculate(self):
         now = time.time()
@@ -379,3 +1056,205 @@ class Throttle:
     def sleep(self):
         self.calculate()
         return self.state.sleep
+
+    @staticmethod
+    def host(url):
+        """
+        Parses host and port from URL.
+
+        :param url: URL
+        :returns: (string) host[:port]
+        """
+        match = utils.RE_DOMAIN.match(str(url))
+        return "{}{}".format(match.group(3), match.group(4) or "") if match else ""
+
+    def bucket(self, url):
+        """
+        Bucket <okami.api.Bucket> for host of a URL. Use it as async context manager around a request to limit
+        concurrency of host.
+
+        :param url: URL
+        :returns: Bucket <okami.api.Bucket>
+        """
+        host = self.host(url=url)
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            bucket = self.buckets[host] = Bucket(**{**self.host_settings, **self.hosts.get(host, {})})
+        return bucket
+
+    def delay(self, url):
+        """
+        Takes a request for host of a URL if host allows it.
+
+        :param url: URL
+        :returns: (float) 0.0 if request is allowed otherwise time until host allows a request
+        """
+        return self.bucket(url=url).take()
+
+    def update(self, url, status, latency):
+        """
+        Receives an outcome of every request. Override it when throttling should react to responses. Connection
+        errors are recorded as failures of host circuit, other outcomes as successes.
+
+        :param url: URL
+        :param status: HTTP status code or status <okami.constants.status>
+        :param latency: (float) time taken by request
+        """
+        bucket = self.bucket(url=url)
+        if status == constants.status.RETRIAL:
+            bucket.failure()
+        else:
+            bucket.success()
+
+
+class AdaptiveThrottle(Throttle):
+    """
+    AdaptiveThrottle <okami.AdaptiveThrottle>
+
+    Adapts request rate and concurrency of every host with AIMD (additive increase, multiplicative decrease).
+    Every `window` responses of a host are evaluated. Limits are decreased when window contains errors (HTTP 429, 5xx
+    or connection errors) or when its mean latency exceeds `max_latency`, otherwise limits are increased. Until first
+    decrease limits are doubled (slow start).
+
+    Accepts all Throttle <okami.Throttle> arguments. Host arguments `host_max_rps` and `host_max_concurrent`
+    are upper limits, `host_max_concurrent` defaults to CONN_MAX_CONCURRENT_REQUESTS.
+
+    :param window: (int) number of responses evaluated at once
+    :param start_rps: (float) initial requests per second for every host
+    :param min_rps: (float) minimum requests per second for every host
+    :param increase: (float) requests per second added on increase, concurrency is increased by one
+    :param decrease: (float) factor limits are multiplied with on decrease
+    :param max_latency: (float) mean latency considered as congestion, defaults to `latency_factor` times the baseline
+        latency of a host, an exponential moving average of its window mean latencies
+    :param latency_factor: (float)
+
+    :ivar windows: (dictionary) of host and Window <okami.api.Window>
+    """
+
+    def __init__(
+        self,
+        window=10,
+        start_rps=1.0,
+        min_rps=0.1,
+        increase=1.0,
+        decrease=0.5,
+        max_latency=None,
+        latency_factor=3.0,
+        **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.window = int(window)
+        self.start_rps = float(start_rps)
+        self.min_rps = float(min_rps)
+        self.increase = float(increase)
+        self.decrease = float(decrease)
+        self.max_latency = max_latency
+        self.latency_factor = float(latency_factor)
+        self.windows = dict()
+        self.total = Window(size=self.window)
+
+    def to_dict(self):
+        buckets = self.buckets.values()
+        return dict(
+            **super().to_dict(),
+            window_latency=self.total.latency,
+            window_errors=self.total.errors,
+            host_rps=sum(b.max_rps for b in buckets),
+            host_concurrent=sum(b.max_concurrent for b in buckets),
+            increased=sum(w.increased for w in self.windows.values()),
+            decreased=sum(w.decreased for w in self.windows.values()),
+        )
+
+    def bucket(self, url):
+        host = self.host(url=url)
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            limits = {**self.host_settings, **self.hosts.get(host, {})}
+            window = self.windows[host] = Window(
+                size=self.window,
+                max_rps=limits.get("max_rps"),
+                max_concurrent=limits.get("max_concurrent") or settings.CONN_MAX_CONCURRENT_REQUESTS,
+            )
+            bucket = self.buckets[host] = Bucket(
+                max_rps=min(self.start_rps, window.max_rps or self.start_rps),
+                max_concurrent=1,
+                burst=limits.get("burst"),
+                max_failures=limits.get("max_failures"),
+                recovery=limits.get("recovery"),
+            )
+        return bucket
+
+    def update(self, url, status, latency):
+        super().update(url=url, status=status, latency=latency)
+        error = status == constants.status.RETRIAL or status == constants.status.HTTP_429 or status >= 500
+        bucket = self.bucket(url=url)
+        window = self.windows[self.host(url=url)]
+        window.add(latency=latency, error=error)
+        self.total.add(latency=latency, error=error)
+        if window.count - window.count_adjusted < self.window:
+            return
+
+        max_latency = self.max_latency or (window.latency_baseline or window.latency) * self.latency_factor
+        if window.errors or window.latency > max_latency:
+            bucket.max_rps = max(self.min_rps, bucket.max_rps * self.decrease)
+            bucket.max_concurrent = max(1, int(bucket.max_concurrent * self.decrease))
+            window.decreased += 1
+        elif not window.decreased:
+            bucket.max_rps = min(bucket.max_rps * 2.0, window.max_rps or float("inf"))
+            bucket.max_concurrent = min(bucket.max_concurrent * 2, window.max_concurrent)
+            window.increased += 1
+        else:
+            bucket.max_rps = min(bucket.max_rps + self.increase, window.max_rps or float("inf"))
+            bucket.max_concurrent = min(bucket.max_concurrent + 1, window.max_concurrent)
+            window.increased += 1
+        window.adjust()
+
+
+class Window:
+    """
+    Window <okami.api.Window>
+
+    Moving window of response latencies and errors.
+
+    :param size: (int) number of responses kept
+    :param max_rps: (float) maximum number of requests per second
+    :param max_concurrent: (int) maximum number of concurrent requests
+
+    :ivar count: (int) number of responses
+    :ivar count_adjusted: (int) number of responses at last adjustment of limits
+    :ivar latency_baseline: (float) exponential moving average of mean latencies at adjustment of limits
+    :ivar increased: (int) number of increases
+    :ivar decreased: (int) number of decreases
+    """
+
+    def __init__(self, size, max_rps=None, max_concurrent=None):
+        self.latencies = deque(maxlen=size)
+        self.failures = deque(maxlen=size)
+        self.max_rps = max_rps
+        self.max_concurrent = max_concurrent
+        self.count = 0
+        self.count_adjusted = 0
+        self.latency_baseline = None
+        self.increased = 0
+        self.decreased = 0
+
+    @property
+    def latency(self):
+        return sum(self.latencies) / len(self.latencies) if self.latencies else 0.0
+
+    @property
+    def errors(self):
+        return sum(self.failures)
+
+    def add(self, latency, error):
+        self.latencies.append(float(latency))
+        self.failures.append(bool(error))
+        self.count += 1
+
+    def adjust(self, alpha=0.3):
+        latency = self.latency
+        if self.latency_baseline is None:
+            self.latency_baseline = latency
+        else:
+            self.latency_baseline += alpha * (latency - self.latency_baseline)
+        self.count_adjusted = self.count
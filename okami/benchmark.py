@@ -0,0 +1,182 @@
+import asyncio
+import gc
+import time
+import tracemalloc
+
+from okami import utils
+from okami.api import Response, Task
+from okami.engine import Manager
+from okami.example import Example, HTTPService
+from okami.storage import Fingerprints, Storage
+
+
+def get_example_urls(address, multiplier):
+    """
+    Builds a list of all URLs served by example HTTPService <okami.example.HTTPService> without running it.
+
+    :param address: example server address:port
+    :param multiplier: category items multiplier
+    :returns: List[str]
+    """
+    service = HTTPService(address=address, multiplier=multiplier)
+    urls = ["http://{}/".format(address)]
+    for gender in ["men", "women"]:
+        for category in service.CATEGORIES:
+            cat = "{}-{}".format(gender, category)
+            urls.append("http://{}/{}/".format(address, cat))
+            urls.extend("http://{}/{}/{}/".format(address, cat, p["pid"]) for p in service.get_products(cat=cat))
+    return urls
+
+
+async def scheduler(urls, size):
+    """
+    Measures scheduler layer alone, Manager.scheduled <okami.engine.Manager> and Manager.done, for tasks made from
+    passed urls.
+
+    :param urls: List[str]
+    :param size: (int) scheduler batch size
+    :returns: (float) tasks per second
+    """
+    storage = Storage(name="benchmark")
+    storage.add_tasks_queued({Task(url=url) for url in urls})
+    manager = Manager(name="benchmark", storage=storage)
+    started = time.perf_counter()
+    while manager.available:
+        await manager.done(tasks=await manager.scheduled(size=size))
+    return len(urls) / (time.perf_counter() - started)
+
+
+def seen(urls, size, fingerprints):
+    """
+    Measures memory used by a set of processed tasks made from passed urls, repeated with a numeric suffix until
+    there are `size` of them, either as a set of Task <okami.Task> or as Fingerprints <okami.storage.Fingerprints>.
+
+    :param urls: List[str]
+    :param size: (int) number of tasks
+    :param fingerprints: (bool)
+    :returns: (float) bytes per task
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        processed = Fingerprints() if fingerprints else set()
+        for i in range(0, size, len(urls)):
+            processed.update({Task(url="{}?page={}".format(url, i)) for url in urls[:size - i]})
+        return tracemalloc.get_traced_memory()[0] / size
+    finally:
+        tracemalloc.stop()
+
+
+def get_example_category_responses(address, multiplier):
+    """
+    Builds a list of Response <okami.Response> of all category pages served by example
+    HTTPService <okami.example.HTTPService> without running it.
+
+    :param address: example server address:port
+    :param multiplier: category items multiplier
+    :returns: List[Response <okami.Response>]
+    """
+    service = HTTPService(address=address, multiplier=multiplier)
+    responses = []
+    for gender in ["men", "women"]:
+        for category in service.CATEGORIES:
+            cat = "{}-{}".format(gender, category)
+            text = service.render_template(data=dict(title=cat, products=service.get_products(cat=cat))).decode()
+            url = "http://{}/{}/".format(address, cat)
+            responses.append(Response(url=url, version="1.1", status=200, reason="OK", headers=dict(), text=text))
+    return responses
+
+
+def xpath_strings(spider, response):
+    """
+    Extracts task URLs evaluating every allow and avoid expression on its own, as spiders did before expressions
+    were compiled.
+    """
+    urls = set()
+    for xp in spider.urls.get("allow", []):
+        urls |= {utils.parse_domain_url(domain=str(response.url), url=str(u)) for u in response.document.xpath(xp)}
+    for xp in spider.urls.get("avoid", []):
+        urls -= {utils.parse_domain_url(domain=str(response.url), url=str(u)) for u in response.document.xpath(xp)}
+    return {Task(url=url) for url in urls}
+
+
+async def xpath(responses, size, compiled):
+    """
+    Measures task URL extraction from already parsed responses, `size` times over all responses.
+
+    :param responses: List[Response <okami.Response>]
+    :param size: (int) number of rounds
+    :param compiled: (bool) uses Spider.tasks <okami.Spider> with compiled expressions
+    :returns: (float) pages per second
+    """
+    spider = Example()
+    started = time.perf_counter()
+    for _ in range(size):
+        for response in responses:
+            if compiled:
+                await spider.tasks(task=None, response=response)
+            else:
+                xpath_strings(spider=spider, response=response)
+    return size * len(responses) / (time.perf_counter() - started)
+
+
+def run_scheduler(address, multiplier, sizes):
+    """
+    Runs scheduler benchmark for every batch size.
+
+    :returns: List[tuple of (str, float, str)] of batch size, tasks per second and unit
+    """
+    urls = get_example_urls(address=address, multiplier=multiplier)
+    loop = asyncio.get_event_loop()
+    return [("size={}".format(size), loop.run_until_complete(scheduler(urls=urls, size=size)), "/s") for size in sizes]
+
+
+def run_seen(address, multiplier, sizes):
+    """
+    Runs memory benchmark of processed tasks for every number of tasks.
+
+    :returns: List[tuple of (str, float, str)] of kind and number of tasks, bytes per task and unit
+    """
+    urls = get_example_urls(address=address, multiplier=multiplier)
+    results = []
+    for size in sizes:
+        for kind, fingerprints in [("tasks", False), ("fingerprints", True)]:
+            value = seen(urls=urls, size=size, fingerprints=fingerprints)
+            results.append(("{} size={}".format(kind, size), value, " B/task"))
+    return results
+
+
+def run_xpath(address, multiplier, sizes):
+    """
+    Runs task URL extraction benchmark over example category pages for every number of rounds.
+
+    :returns: List[tuple of (str, float, str)] of kind and number of rounds, pages per second and unit
+    """
+    responses = get_example_category_responses(address=address, multiplier=multiplier)
+    for response in responses:
+        # parse documents up front, only extraction is measured
+        response.document
+    loop = asyncio.get_event_loop()
+    results = []
+    for size in sizes:
+        for kind, compiled in [("strings", False), ("compiled", True)]:
+            value = loop.run_until_complete(xpath(responses=responses, size=size, compiled=compiled))
+            results.append(("{} size={}".format(kind, size), value, "/s"))
+    return results
+
+
+BENCHMARKS = dict(
+    scheduler=(run_scheduler, (1, 10, 100)),
+    seen=(run_seen, (10 ** 6, 10 ** 7)),
+    xpath=(run_xpath, (1, 10)),
+)
+
+
+def run(name, address="127.0.0.1:8000", multiplier=4, sizes=None):
+    """
+    Runs benchmark by name with its default sizes unless sizes are passed.
+
+    :returns: List[tuple of (str, float, str)] of benchmark size, value and unit
+    """
+    fn, default = BENCHMARKS[name]
+    return fn(address=address, multiplier=multiplier, sizes=sizes or default)
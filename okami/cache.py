@@ -0,0 +1,217 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+
+import aiohttp
+import multidict
+import yarl
+
+from okami import settings, signals
+from okami.api import Downloader, Response
+from okami.exceptions import CacheMissException
+
+log = logging.getLogger(__name__)
+
+MODES = ("record", "replay", "refresh")
+EVICTIONS = ("lru", "fifo")
+
+
+class ResponseCache:
+    """
+    ResponseCache <okami.cache.ResponseCache>
+
+    Keeps responses in SQLite database keyed by request fingerprint. Bodies are compressed with zlib, headers are kept
+    as JSON. When compressed size of all responses is over `max_size` bytes, least recently used or oldest responses
+    are evicted.
+
+    :param filename: (str) database file
+    :param max_size: (int) maximum size of all compressed responses in bytes, no limit if None
+    :param eviction: (str) "lru" evicts least recently used, "fifo" oldest stored responses first
+    :param level: (int) zlib compression level
+    """
+
+    def __init__(self, filename, max_size=None, eviction="lru", level=6):
+        if eviction not in EVICTIONS:
+            raise ValueError("Eviction has to be one of {}".format(", ".join(EVICTIONS)))
+        self.filename = filename
+        self.max_size = max_size
+        self.eviction = eviction
+        self.level = int(level)
+        self.evicted = 0
+        self.connection = sqlite3.connect(self.filename)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, created REAL, accessed REAL, size INTEGER, meta TEXT, body BLOB)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responses_created ON responses (created)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def fingerprint(method, url):
+        """
+        Returns request fingerprint, sha1 of method and URL.
+
+        :param method: HTTP method
+        :param url: URL
+        :returns: (str)
+        """
+        return hashlib.sha1("{} {}".format(method.upper(), url).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Returns cached Response <okami.Response> or None.
+
+        :param key: request fingerprint
+        :returns: Response <okami.Response>
+        """
+        row = self.connection.execute("SELECT meta, body FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if self.eviction == "lru":
+            with self.connection:
+                self.connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+        meta = json.loads(row[0])
+        return Response(
+            url=yarl.URL(meta["url"]),
+            version=aiohttp.HttpVersion(*meta["version"]),
+            status=meta["status"],
+            reason=meta["reason"],
+            headers=multidict.CIMultiDictProxy(multidict.CIMultiDict(meta["headers"])),
+            body=zlib.decompress(row[1]),
+            encoding=meta["encoding"],
+        )
+
+    def set(self, key, response):
+        """
+        Stores Response <okami.Response> with read body and evicts responses over maximum size.
+
+        :param key: request fingerprint
+        :param response: Response <okami.Response>
+        """
+        meta = json.dumps(
+            dict(
+                url=str(response.url),
+                version=list(response.version),
+                status=response.status,
+                reason=response.reason,
+                headers=list(response.headers.items()),
+                encoding=response.encoding,
+            )
+        )
+        body = zlib.compress(response.body, self.level)
+        size = len(meta) + len(body)
+        now = time.time()
+        with self.connection:
+            row = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, created, accessed, size, meta, body) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, now, now, size, meta, body),
+            )
+        self.size += size - (row[0] if row else 0)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used or oldest responses until size of cache is not over maximum size.
+        """
+        if self.max_size is None or self.size <= self.max_size:
+            return
+        column = "accessed" if self.eviction == "lru" else "created"
+        keys = []
+        with self.connection:
+            for key, size in self.connection.execute("SELECT key, size FROM responses ORDER BY {}".format(column)):
+                if self.size <= self.max_size:
+                    break
+                keys.append((key,))
+                self.size -= size
+            self.connection.executemany("DELETE FROM responses WHERE key = ?", keys)
+        self.evicted += len(keys)
+
+    def close(self):
+        self.connection.close()
+
+
+class CacheDownloader(Downloader):
+    """
+    CacheDownloader <okami.cache.CacheDownloader>
+
+    Downloader <okami.Downloader> keeping responses in ResponseCache <okami.cache.ResponseCache>, so crawls can be
+    re-run at disk speed. In CACHE_MODE "record" cached responses are replayed and missing ones are downloaded and
+    stored, in "replay" only cached responses are used and no requests are made, in "refresh" all responses are
+    downloaded and stored again. Only successful HTTP 2xx responses are cached, others such as 5xx, 404, 429 or
+    304 Not Modified are downloaded again next time. Streamed responses are not cached. Hits, misses and evicted
+    responses are counted in Stats <okami.api.Stats>.
+
+    :param controller: Controller <okami.engine.Controller>
+    """
+
+    def __init__(self, controller):
+        super().__init__(controller)
+        self.cache = None
+        self.mode = None
+        self.key_hits = "cache/hits"
+        self.key_misses = "cache/misses"
+        self.key_evicted = "cache/evicted"
+
+    def initialise(self):
+        if not settings.CACHE_MODE:
+            return
+        if settings.CACHE_MODE not in MODES:
+            raise ValueError("CACHE_MODE has to be one of {}".format(", ".join(MODES)))
+        self.mode = settings.CACHE_MODE
+        filename = os.path.join(settings.CACHE_PATH or ".", "{}.cache.sqlite".format(self.controller.spider.name))
+        self.cache = ResponseCache(
+            filename=filename, max_size=settings.CACHE_MAX_SIZE, eviction=settings.CACHE_EVICTION
+        )
+        self.controller.stats.set(self.key_hits, 0)
+        self.controller.stats.set(self.key_misses, 0)
+        self.controller.stats.set(self.key_evicted, 0)
+
+    def finalise(self):
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    async def process(self, request):
+        """
+        Returns cached response or makes an actual HTTP request and caches its successful response, according to
+        CACHE_MODE.
+
+        :param request: Request <okami.Request>
+        :returns: Response <okami.Response>
+        :raises: CacheMissException <okami.cache.CacheMissException> in replay mode when response is not cached
+        """
+        if self.cache is None or self.controller.spider.stream:
+            return await super().process(request=request)
+
+        method = self.controller.spider.request().get("method", "GET")
+        key = self.cache.fingerprint(method=method, url=request.url)
+        if self.mode != "refresh":
+            response = self.cache.get(key)
+            if response is not None:
+                response.request_url = request.url
+                self.controller.stats.incr(key=self.key_hits)
+                await signals.response_created.send(sender=self, response=response, response_created=True)
+                return response
+            self.controller.stats.incr(key=self.key_misses)
+            if self.mode == "replay":
+                raise CacheMissException("Response of {} not cached".format(request.url))
+
+        response = await super().process(request=request)
+        if not 200 <= response.status < 300:
+            return response
+        evicted = self.cache.evicted
+        self.cache.set(key=key, response=response)
+        self.controller.stats.incr(key=self.key_evicted, value=self.cache.evicted - evicted)
+        return response
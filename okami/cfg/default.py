@@ -45,33 +45,84 @@ ASYNC_TIMEOUT = 10
 # Details: https://docs.python.org/3/library/asyncio-dev.html#asyncio-debug-mode
 ASYNC_SLOW_CALLBACK_DURATION = 0.1
 
-# Pause timeout, in case of server connection errors etc. okami pauses scraping
+# Executor spider processing runs in, "thread" or "process". Defaults to event loop.
+SPIDER_EXECUTOR = None
+
+# Maximum number of executor workers. Defaults to executor default.
+SPIDER_EXECUTOR_WORKERS = None
+
+# Delay of the first retrial of a task in case of server connection errors etc. Other tasks are processed meanwhile.
 PAUSE_TIMEOUT = 5
 
-# Connection timeout
+# Delay of every next retrial of a task is multiplied by this factor
+RETRY_BACKOFF = 2.0
+
+# Maximum delay of a retrial in seconds
+RETRY_MAX_DELAY = 60.0
+
+# Random jitter added to delay of a retrial, as a fraction of the delay
+RETRY_JITTER = 0.25
+
+# Total timeout of a request in seconds, including connection, redirects and reading of response body
 CONN_TIMEOUT = 20
 
+# Timeout of establishing a connection in seconds, including waiting for a free connection. None disables it.
+CONN_CONNECT_TIMEOUT = 10
+
+# Maximum time in seconds between two reads of response data. None disables it.
+CONN_READ_TIMEOUT = 10
+
 # SSL verification for HTTP requests
 CONN_VERIFY_SSL = False
 
 # Maximum number of concurrent connections to website
 CONN_MAX_CONCURRENT_CONNECTIONS = 5
 
+# Maximum number of concurrent connections to a single host. None or 0 for no limit.
+CONN_MAX_CONCURRENT_CONNECTIONS_PER_HOST = None
+
+# Seconds resolved host addresses are cached for. None caches them forever, 0 disables DNS cache.
+CONN_DNS_CACHE_TTL = 10
+
+# Maximum number of concurrent DNS lookups, including background lookups of hosts of new tasks
+RESOLVER_MAX_CONCURRENT = 10
+
+# Seconds an idle connection is kept alive for another request
+CONN_KEEPALIVE_TIMEOUT = 15
+
+# Close connection after every request instead of keeping it alive
+CONN_FORCE_CLOSE = False
+
 # Maximum number of concurrent requests to website. Effectively an async loop size.
 CONN_MAX_CONCURRENT_REQUESTS = 10
 
+# Maximum number of tasks handed out to a worker at once. Worker processes its batch concurrently.
+SCHEDULER_BATCH_SIZE = 1
+
+# Maximum number of tasks parked in memory while their host is throttled. No more tasks are taken from storage above it.
+SCHEDULER_MAX_PARKED = 10000
+
 # Maximum number of connection retries in case of connection issues
 CONN_MAX_RETRIES = 5
 
 # Maximum number of HTTP redirects
 CONN_MAX_HTTP_REDIRECTS = 10
 
+# Maximum size of response body in bytes, larger responses are rejected. None disables the limit.
+CONN_MAX_BODY_SIZE = None
+
+# Allowed response content types, e.g. ("text/html",), others are rejected. None allows all.
+CONN_CONTENT_TYPES = None
+
 # Maximum number of failed requests before okami stops
 REQUEST_MAX_FAILED = 50
 
 # Maximum number of pending requests before logging an error
 REQUEST_MAX_PENDING = 10
 
+# Pending requests running longer than this many seconds are cancelled and retried. None disables it.
+REQUEST_DEADLINE = 60
+
 # List of base http middleware. Should not change.
 BASE_HTTP_MIDDLEWARE = (
     "okami.middleware.Session",
@@ -100,13 +151,70 @@ BASE_ITEMS_PIPELINE = ()
 ITEMS_PIPELINE = ()
 
 # List of base tasks pipelines. Should not change.
-BASE_TASKS_PIPELINE = ()
+BASE_TASKS_PIPELINE = (
+    "okami.pipeline.Canonical",
+    "okami.pipeline.Resolve",
+)
 
 # List of tasks pipelines. Use to add custom handlers.
 TASKS_PIPELINE = ()
 
+# Canonical tasks pipeline replaces URLs of tasks with canonical URLs. Changes delta keys of non-canonical URLs.
+CANONICAL_ENABLED = False
+
+# Canonical tasks pipeline sorts query parameters of URLs
+CANONICAL_SORT_QUERY = True
+
+# Canonical tasks pipeline drops fragments of URLs
+CANONICAL_DROP_FRAGMENT = True
+
+# Canonical tasks pipeline drops these query parameters of URLs, names ending with * drop parameters by prefix
+CANONICAL_DROP_PARAMS = ("utm_*", "gclid", "fbclid", "msclkid", "_ga")
+
+# Canonical tasks pipeline drops www. prefix of URL hosts
+CANONICAL_STRIP_WWW = False
+
 # Delta middleware enable
 DELTA_ENABLED = False
 
 # Delta middleware database directory. Defaults to current directory.
 DELTA_PATH = None
+
+# DeltaSqlite middleware commits writes after this number of writes
+DELTA_COMMIT_SIZE = 1000
+
+# DeltaSqlite middleware commits writes after this number of seconds
+DELTA_COMMIT_INTERVAL = 5.0
+
+# Conditional middleware enable
+CONDITIONAL_ENABLED = False
+
+# Conditional middleware database directory. Defaults to current directory.
+CONDITIONAL_PATH = None
+
+# Conditional middleware behaviour on 304 Not Modified, "skip" page or "replay" its cached body
+CONDITIONAL_MODE = "skip"
+
+# Conditional middleware commits writes after this number of writes
+CONDITIONAL_COMMIT_SIZE = 1000
+
+# Duplicates middleware compares also simhashes of responses to skip near-identical ones
+DUPLICATES_SIMHASH = False
+
+# Maximum number of different bits of simhashes of near-identical responses
+DUPLICATES_SIMHASH_DISTANCE = 3
+
+# CacheDownloader mode, "record", "replay" or "refresh". None disables cache.
+CACHE_MODE = None
+
+# CacheDownloader database directory. Defaults to current directory.
+CACHE_PATH = None
+
+# Maximum size of cached compressed responses in bytes. None disables the limit.
+CACHE_MAX_SIZE = None
+
+# CacheDownloader eviction policy, "lru" evicts least recently used, "fifo" oldest stored responses first
+CACHE_EVICTION = "lru"
+
+# Maximum number of delta keys of tasks cached by controller key cache. 0 disables cache.
+KEY_CACHE_SIZE = 100000
@@ -7,7 +7,7 @@ import pstats
 import click
 import pkg_resources
 
-from okami import loader, settings, utils
+from okami import benchmark as benchmarks, loader, settings, utils
 from okami.engine import Okami
 from okami.example import HTTPService
 
@@ -57,6 +57,19 @@ def example(process, address, name, multiplier, delay):
         Okami.start(name=name)
 
 
+@main.command(context_settings=CTX, help="okami benchmark scheduler --multiplier=4 --size=1 --size=10")
+@click.argument("name", type=click.Choice(sorted(benchmarks.BENCHMARKS)))
+@click.option("--address", default="127.0.0.1:8000", type=str, help="Example server address:port")
+@click.option("--multiplier", default=4, type=int, help="Category items multiplier")
+@click.option("--size", "-s", type=int, multiple=True, help="Benchmark size")
+def benchmark(name, address, multiplier, size):
+    click.echo("")
+    click.echo("  Benchmark: {}".format(name))
+    for label, value, unit in benchmarks.run(name=name, address=address, multiplier=multiplier, sizes=size):
+        click.echo("    {:<28} {:>14.2f}{}".format(label, value, unit))
+    click.echo("")
+
+
 @main.command(context_settings=CTX, help="List available spiders")
 def list():
     discovered = dict()
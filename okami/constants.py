@@ -2,9 +2,13 @@ class status:
     OK = 0
     FAILED = 1
     RETRIAL = 2
+    REJECTED = 3
+    HTTP_304 = 304
     HTTP_404 = 404
+    HTTP_429 = 429
     HTTP_500 = 500
     HTTP_501 = 501
+    HTTP_503 = 503
 
 
 class method:
@@ -1,16 +1,23 @@
 import asyncio
+import concurrent.futures
+import functools
+import heapq
+import itertools
 import logging
+import random
+import threading
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
 
 import aiohttp
 
 from okami import constants, loader, settings, signals
-from okami.api import Request, Result, Stats, Task
+from okami.api import Connections, KeyCache, Request, Resolver, Response, Result, Stats, Task
 from okami.exceptions import (
     HttpMiddlewareException,
     ItemsPipelineException,
     OkamiTerminationException,
+    ResponseRejectedException,
     SpiderMiddlewareException,
     StartupPipelineException,
     TasksPipelineException,
@@ -20,6 +27,28 @@ log = logging.getLogger(__name__)
 
 asyncio.set_event_loop_policy(settings.EVENT_LOOP_POLICY)
 
+EXECUTORS = dict(
+    thread=concurrent.futures.ThreadPoolExecutor,
+    process=concurrent.futures.ProcessPoolExecutor,
+)
+
+local = threading.local()
+
+
+def process_spider(spider, task, response):
+    """
+    Runs Spider.process <okami.Spider> in executor worker on event loop of worker thread.
+
+    :param spider: Spider <okami.Spider>
+    :param task: Task <okami.Task>
+    :param response: Response <okami.Response>
+    :returns: tuple of (Set[Task <okami.Task>], List[Item <okami.Item>])
+    """
+    loop = getattr(local, "loop", None)
+    if loop is None:
+        loop = local.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(spider.process(task=task, response=response))
+
 
 class Okami:
     @staticmethod
@@ -52,21 +81,31 @@ class Controller:
 
         self.spider = spider
         self.stats = Stats(controller=self)
+        self.key_cache = KeyCache(controller=self, size=settings.KEY_CACHE_SIZE)
         self.session = None
+        self.connections = Connections()
+        self.resolver = Resolver(ttl=settings.CONN_DNS_CACHE_TTL, max_concurrent=settings.RESOLVER_MAX_CONCURRENT)
         self.storage = loader.get_class(settings.STORAGE)(name=self.spider.name, **settings.STORAGE_SETTINGS)
         self.throttle = loader.get_class(settings.THROTTLE)(**settings.THROTTLE_SETTINGS)
         self.downloader = loader.get_class(settings.DOWNLOADER)(controller=self)
+        self.stats.set("downloader/rejected", 0)
+        self.stats.set("downloader/timeouts", 0)
+        self.watchdog = Watchdog(controller=self)
         self.middleware = Middlewares(controller=self)
         self.pipeline = Pipelines(controller=self)
-        self.manager = Manager(name=self.spider.name, storage=self.storage)
+        self.manager = Manager(name=self.spider.name, storage=self.storage, throttle=self.throttle)
+        self.executor = None
+        if settings.SPIDER_EXECUTOR:
+            self.executor = EXECUTORS[settings.SPIDER_EXECUTOR](max_workers=settings.SPIDER_EXECUTOR_WORKERS)
 
     async def initialise(self):
         log.debug("Okami: initialising")
         await self.pipeline.initialise()
         await self.middleware.initialise()
         self.spider = await self.pipeline.startup.process(spider=self.spider)
-        self.manager.event.clear()
-        self.manager.storage.add_tasks_queued({Task(url=url) for url in self.spider.urls.get("start", [])})
+        self.storage.initialise()
+        self.downloader.initialise()
+        self.manager.storage.add_tasks_queued({Task(url=url).canonical() for url in self.spider.urls.get("start", [])})
 
     async def start(self):
         log.debug("Okami: starting")
@@ -84,95 +123,331 @@ class Controller:
         log.debug("Okami: running")
         self.manager.storage.set_info_time_started(time.time())
 
-        with self.throttle as throttle:
-            while self.manager.running:
-                for task in await self.manager.scheduled():
-                    await asyncio.Task(self.process(task=task))
-                    await asyncio.sleep(throttle.sleep)
+        with self.throttle, self.watchdog:
+            workers = [asyncio.ensure_future(self.worker()) for _ in range(settings.CONN_MAX_CONCURRENT_REQUESTS)]
+            try:
+                results = await asyncio.gather(*workers, return_exceptions=True)
+            finally:
+                for worker in workers:
+                    worker.cancel()
 
-                if not self.manager.event.is_set():
-                    await self.manager.event.wait()
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def worker(self):
+        """
+        Pulls batches of scheduled tasks and processes them until there is nothing left to process.
+        On error stops the manager so other workers drain their current tasks and exit.
+        """
+        try:
+            while self.manager.running:
+                tasks = await self.manager.scheduled()
+                if not tasks:
+                    await self.manager.wait()
+                    continue
+                try:
+                    results = await asyncio.gather(
+                        *[self.dispatch(task=task) for task in tasks], return_exceptions=True
+                    )
+                finally:
+                    await self.manager.done(tasks=tasks)
+                for result in results:
+                    if isinstance(result, BaseException):
+                        raise result
+        except Exception:
+            await self.manager.stop()
+            raise
+
+    async def dispatch(self, task):
+        async with self.throttle.bucket(url=task.url):
+            result = await self.process(task=task)
+        await asyncio.sleep(self.throttle.sleep)
+        return result
 
     async def process(self, task):
-        status, tasks, items = 0, set(), set()
-        with (await self.manager.semaphore):
+        status, tasks, items, response = 0, set(), set(), None
+        async with self.manager.semaphore:
             try:
                 request = Request(url=task.url)
                 request = await self.middleware.http.before(request=request)
-                response = await self.downloader.process(request=request)
+                response = await self.download(task=task, request=request)
                 response = await self.middleware.http.after(response=response)
 
                 if response.status in constants.HTTP_FAILED:
                     status = response.status
+                elif response.status == constants.status.HTTP_304:
+                    status = response.status
                 else:
-                    response = await self.middleware.spider.before(task=task, response=response)
-                    tasks, items = await self.spider.process(task=task, response=response)
-                    tasks, items = await self.middleware.spider.after(
-                        task=task, response=response, tasks=tasks, items=items
-                    )
-                    if tasks:
-                        tasks = await self.pipeline.tasks.process(tasks=tasks)
-                    if items:
-                        items = await self.pipeline.items.process(items=items)
-
-            except aiohttp.ClientError as e:
+                    processed = await self.middleware.spider.before(task=task, response=response)
+                    if processed is not None:
+                        response = processed
+                        tasks, items = await self.parse(task=task, response=response)
+                        tasks, items = await self.middleware.spider.after(
+                            task=task, response=response, tasks=tasks, items=items
+                        )
+                        if tasks:
+                            tasks = await self.pipeline.tasks.process(tasks=tasks)
+                        if items:
+                            items = await self.pipeline.items.process(items=items)
+
+            except ResponseRejectedException as e:
+                log.info(e)
+                status = constants.status.REJECTED
+                self.stats.incr(key="downloader/rejected")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
                 log.exception(e)
                 status = constants.status.RETRIAL
-                await self.session.close()
             except Exception as e:
                 log.exception(e)
                 status = constants.status.FAILED
+            finally:
+                if isinstance(response, Response):
+                    response.release()
 
             result = Result(status=status, task=task, tasks=tasks, items=items)
             await self.manager.process(result=result)
             return result
 
+    async def parse(self, task, response):
+        """
+        Processes Response <okami.Response> with Spider.process <okami.Spider>, in SPIDER_EXECUTOR if set and
+        response is not streamed. Process executor receives a copy of response with headers as a dictionary, body is
+        not decoded.
+
+        :param task: Task <okami.Task>
+        :param response: Response <okami.Response>
+        :returns: tuple of (Set[Task <okami.Task>], List[Item <okami.Item>])
+        """
+        if self.executor is None or response.content is not None:
+            return await self.spider.process(task=task, response=response)
+        if isinstance(self.executor, concurrent.futures.ProcessPoolExecutor):
+            response = Response(
+                url=response.url,
+                version=response.version,
+                status=response.status,
+                reason=response.reason,
+                headers=dict(response.headers),
+                text=None if response.body is not None else response.text,
+                body=response.body,
+                encoding=response.encoding,
+                request_url=response.request_url,
+            )
+        fn = functools.partial(process_spider, spider=self.spider, task=task, response=response)
+        return await asyncio.get_event_loop().run_in_executor(self.executor, fn)
+
+    async def download(self, task, request):
+        """
+        Downloads a Request <okami.Request> watched by Watchdog <okami.engine.Watchdog> and reports its outcome and
+        latency to throttle. Timed out requests are counted in stats.
+
+        :param task: Task <okami.Task>
+        :param request: Request <okami.Request>
+        :returns: Response <okami.Response>
+        """
+        time_started = time.time()
+        try:
+            response = await self.watchdog.watch(url=task.url, coro=self.downloader.process(request=request))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if isinstance(e, asyncio.TimeoutError):
+                self.stats.incr(key="downloader/timeouts")
+            self.throttle.update(url=task.url, status=constants.status.RETRIAL, latency=time.time() - time_started)
+            raise
+        self.throttle.update(url=task.url, status=response.status, latency=time.time() - time_started)
+        return response
+
     async def finalise(self):
         log.debug("Okami: finalising")
         await self.manager.stop()
         if self.session and not self.session.closed:
             await self.session.close()
+        await self.resolver.close()
         await self.pipeline.finalise()
         await self.middleware.finalise()
+        self.storage.finalise()
+        self.downloader.finalise()
+        if self.executor is not None:
+            self.executor.shutdown()
         log.debug("Okami: finished")
 
 
 class Manager:
-    def __init__(self, name, storage):
+    def __init__(self, name, storage, throttle=None):
         self.name = name
         self.storage = storage
+        self.throttle = throttle
+        self.parked = dict()
         self.terminate = False
         self.retrials = set()
+        self.delayed = []
+        self.sequence = itertools.count()
         self.counters = defaultdict(lambda: defaultdict(lambda: 0))
         self.iterations = 0
-        self.event = asyncio.Event()
+        self.pending = 0
+        self.condition = asyncio.Condition()
         self.semaphore = asyncio.Semaphore(value=settings.CONN_MAX_CONCURRENT_REQUESTS)
 
     @property
     def running(self):
-        return not self.terminate and (bool(self.retrials) or not self.storage.tasks_queued_is_empty())
+        return not self.terminate and (
+            bool(self.retrials)
+            or bool(self.pending)
+            or bool(self.parked)
+            or not self.storage.tasks_queued_is_empty()
+        )
+
+    @property
+    def available(self):
+        return (
+            self.delayed_wait() == 0
+            or any(not bucket.wait() for bucket in self.parked)
+            or (self.parked_size < settings.SCHEDULER_MAX_PARKED and not self.storage.tasks_queued_is_empty())
+        )
+
+    def delayed_wait(self):
+        """
+        :returns: (float) seconds until the first delayed retrial can be handed out, None without delayed retrials
+        """
+        if not self.delayed:
+            return None
+        return max(0.0, self.delayed[0][0] - time.time())
+
+    def delay(self, task, delay):
+        """
+        Delays retrial of a task, it is handed out by `scheduled` once delay has elapsed.
+
+        :param task: Task <okami.Task>
+        :param delay: (float) seconds
+        """
+        self.retrials.add(task)
+        heapq.heappush(self.delayed, (time.time() + delay, next(self.sequence), task))
 
-    async def scheduled(self):
-        subset = set(list(self.retrials or [self.storage.get_tasks_queued()])[:1])
-        self.retrials -= subset
+    def isolated(self, task):
+        """
+        Tells whether failures of task host are isolated by circuit breaker of its throttle bucket. Tasks of such hosts
+        running out of retrials fail on their own instead of terminating scraping.
+
+        :param task: Task <okami.Task>
+        :returns: (bool)
+        """
+        return bool(self.throttle and self.throttle.bucket(url=task.url).max_failures)
+
+    @staticmethod
+    def backoff(retrials):
+        """
+        Computes delay of a retrial growing exponentially from PAUSE_TIMEOUT by RETRY_BACKOFF with every retrial up to
+        RETRY_MAX_DELAY, with random jitter of up to RETRY_JITTER of the delay added.
+
+        :param retrials: (int) number of retrials of a task so far
+        :returns: (float) seconds
+        """
+        delay = min(settings.PAUSE_TIMEOUT * settings.RETRY_BACKOFF ** (retrials - 1), settings.RETRY_MAX_DELAY)
+        return delay + random.uniform(0, delay * settings.RETRY_JITTER)
+
+    @property
+    def parked_size(self):
+        """
+        Number of parked tasks counting toward SCHEDULER_MAX_PARKED. Tasks of hosts with open circuit are not counted,
+        so a dead host does not keep tasks of healthy hosts in storage until it recovers.
+
+        :returns: (int)
+        """
+        return sum(len(tasks) for bucket, tasks in self.parked.items() if bucket.circuit != bucket.OPEN)
+
+    async def scheduled(self, size=None):
+        """
+        Hands out a batch of up to `size` tasks, retrials with elapsed delay first, then parked tasks of hosts which
+        allow a request and then queued tasks. Queued tasks of hosts which do not allow a request are parked until
+        they do.
+
+        :param size: (int) maximum batch size, defaults to SCHEDULER_BATCH_SIZE
+        :returns: List[Task <okami.Task>]
+        """
+        size = size or settings.SCHEDULER_BATCH_SIZE
+        subset = []
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now and len(subset) < size:
+            task = heapq.heappop(self.delayed)[2]
+            self.retrials.discard(task)
+            bucket = self.throttle.bucket(url=task.url) if self.throttle else None
+            if bucket is not None and (bucket in self.parked or bucket.take()):
+                self.parked.setdefault(bucket, deque()).append(task)
+            else:
+                subset.append(task)
+        for bucket, tasks in list(self.parked.items()):
+            while tasks and len(subset) < size and not bucket.take():
+                subset.append(tasks.popleft())
+            if not tasks:
+                del self.parked[bucket]
+        parked_size = self.parked_size
+        while len(subset) < size and parked_size < settings.SCHEDULER_MAX_PARKED:
+            if self.storage.tasks_queued_is_empty():
+                break
+            batch_size = min(size - len(subset), settings.SCHEDULER_MAX_PARKED - parked_size)
+            for task in self.storage.get_tasks_queued_batch(size=batch_size):
+                bucket = self.throttle.bucket(url=task.url) if self.throttle else None
+                if bucket is not None and (bucket in self.parked or bucket.take()):
+                    self.parked.setdefault(bucket, deque()).append(task)
+                    if bucket.circuit != bucket.OPEN:
+                        parked_size += 1
+                else:
+                    subset.append(task)
+        self.pending += len(subset)
         return subset
 
+    async def wait(self):
+        """
+        Waits until a task is available, scraping has finished, a host with parked tasks allows a request or delay of
+        a retrial has elapsed.
+        """
+
+        async def wait_for():
+            async with self.condition:
+                await self.condition.wait_for(lambda: not self.running or self.available)
+
+        timeouts = [bucket.wait() for bucket in self.parked]
+        if self.delayed:
+            timeouts.append(self.delayed_wait())
+        timeout = min(timeouts) if timeouts else None
+        try:
+            await asyncio.wait_for(wait_for(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def done(self, tasks):
+        self.pending -= len(tasks)
+        self.storage.add_tasks_finished({task for task in tasks if task not in self.retrials})
+        async with self.condition:
+            self.condition.notify_all()
+
+    def fail(self, task):
+        """
+        Marks task as failed, terminates scraping once REQUEST_MAX_FAILED tasks failed.
+
+        :param task: Task <okami.Task>
+        :raises: OkamiTerminationException
+        """
+        self.storage.add_tasks_failed({task})
+        failed = self.storage.get_tasks_failed()
+        if len(failed) >= settings.REQUEST_MAX_FAILED:
+            raise OkamiTerminationException("REQUEST_MAX_FAILED Reached. Terminating!")
+
     async def process(self, result):
         self.iterations += 1
 
         if result.status == constants.status.RETRIAL:
-            self.retrials.add(result.task)
             retrials = self.counters["retrials"]
             retrials[result.task] += 1
-            if retrials[result.task] >= settings.CONN_MAX_RETRIES:
-                raise OkamiTerminationException("CONN_MAX_RETRIES Reached. Terminating!")
-            await asyncio.sleep(settings.PAUSE_TIMEOUT)
+            if retrials[result.task] >= settings.CONN_MAX_RETRIES and self.isolated(task=result.task):
+                log.warning("CONN_MAX_RETRIES Reached. Giving up %s", result.task.url)
+                self.fail(task=result.task)
+            else:
+                self.delay(task=result.task, delay=self.backoff(retrials=retrials[result.task]))
+                if retrials[result.task] >= settings.CONN_MAX_RETRIES:
+                    raise OkamiTerminationException("CONN_MAX_RETRIES Reached. Terminating!")
 
         if result.status in constants.FAILED:
-            self.storage.add_tasks_failed({result.task})
-            failed = self.storage.get_tasks_failed()
-            if len(failed) >= settings.REQUEST_MAX_FAILED:
-                raise OkamiTerminationException("REQUEST_MAX_FAILED Reached. Terminating!")
+            self.fail(task=result.task)
 
         if result.tasks:
             self.storage.add_tasks_queued(result.tasks)
@@ -180,14 +455,90 @@ class Manager:
         if result.items:
             self.storage.add_info_items_processed(len(result.items))
 
-        if not self.event.is_set():
-            self.event.set()
-
     async def stop(self):
         self.terminate = True
+        async with self.condition:
+            self.condition.notify_all()
         return self.terminate
 
 
+class Watchdog:
+    """
+    Watchdog <okami.engine.Watchdog>
+
+    Keeps track of pending downloads while crawling. Every `interval` seconds it logs an error when there are more
+    than REQUEST_MAX_PENDING of them and cancels downloads pending longer than REQUEST_DEADLINE seconds, e.g. hung on
+    a server which keeps sending data slowly. Cancelled downloads raise asyncio.TimeoutError and are retried.
+
+    :param controller: Controller <okami.engine.Controller>
+    :param interval: (float) seconds between checks
+    """
+
+    def __init__(self, controller, interval=1.0):
+        self.controller = controller
+        self.interval = float(interval)
+        self.pending = dict()
+        self.cancelled = set()
+        self.future = None
+        self.key_pending = "downloader/pending"
+        self.key_cancelled = "downloader/cancelled"
+        self.controller.stats.set(self.key_pending, 0)
+        self.controller.stats.set(self.key_cancelled, 0)
+
+    def __enter__(self):
+        self.future = asyncio.ensure_future(self.run())
+        return self
+
+    def __exit__(self, *args):
+        if self.future is not None:
+            self.future.cancel()
+            self.future = None
+        self.controller.stats.set(self.key_pending, len(self.pending))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.check()
+
+    def check(self):
+        """
+        Reports too many pending downloads and cancels downloads pending over deadline.
+        """
+        self.controller.stats.set(self.key_pending, len(self.pending))
+        if len(self.pending) > settings.REQUEST_MAX_PENDING:
+            log.error("REQUEST_MAX_PENDING Reached. {} requests pending".format(len(self.pending)))
+        if settings.REQUEST_DEADLINE is None:
+            return
+        now = time.time()
+        for future, (url, time_started) in list(self.pending.items()):
+            if future not in self.cancelled and now - time_started > settings.REQUEST_DEADLINE:
+                log.warning("Request {} pending for {:.1f}s, cancelling".format(url, now - time_started))
+                self.cancelled.add(future)
+                self.controller.stats.incr(key=self.key_cancelled)
+                future.cancel()
+
+    async def watch(self, url, coro):
+        """
+        Runs passed download as pending until it is finished or cancelled.
+
+        :param url: URL
+        :param coro: download coroutine
+        :returns: result of passed coroutine
+        :raises: asyncio.TimeoutError when download was cancelled over deadline
+        """
+        future = asyncio.ensure_future(coro)
+        self.pending[future] = (url, time.time())
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if future in self.cancelled:
+                raise asyncio.TimeoutError("Request {} over REQUEST_DEADLINE".format(url))
+            raise
+        finally:
+            del self.pending[future]
+            self.cancelled.discard(future)
+
+
 class Middlewares:
     def __init__(self, controller):
         self.http = HttpMiddleware(controller=controller)
@@ -340,11 +691,12 @@ class SpiderMiddleware(Middleware):
     async def before(self, task, response):
         """
         Runs passed objects through all registered spider middleware.
-        Runs for every spider scraping cycle.
+        Runs for every spider scraping cycle. Middleware returning None skips spider processing of the response and
+        remaining middleware.
 
         :param task: Task <okami.Task>
         :param response: Response <okami.Response>
-        :returns: Response <okami.Response>
+        :returns: Response <okami.Response> or None
         """
         try:
             if self.middlewares:
@@ -353,6 +705,8 @@ class SpiderMiddleware(Middleware):
                         response = await middleware.before(task=task, response=response)
                     except NotImplementedError:
                         response = response
+                    if response is None:
+                        break
                     await signals.spider_middleware_started.send(sender=middleware, task=task, response=response)
             return response
         except Exception as e:
@@ -3,7 +3,6 @@ import base64
 import logging
 import random
 
-import lxml.html
 from aiohttp import web
 
 from okami import settings, Item, Spider
@@ -31,8 +30,7 @@ class Example(Spider):
 
     async def items(self, task, response):
         items = []
-        document = lxml.html.document_fromstring(html=response.text)
-        products = document.xpath("//div[@class='product']")
+        products = response.xpath("//div[@class='product']")
         for product in products:
             iid = int(product.xpath(".//@product-id")[0])
             name = product.xpath(".//h2/text()")[0]
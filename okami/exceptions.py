@@ -16,6 +16,14 @@ class NoSuchSpiderException(OkamiException):
     pass
 
 
+class ResponseRejectedException(OkamiException):
+    pass
+
+
+class CacheMissException(ResponseRejectedException):
+    pass
+
+
 class SpiderException(OkamiException):
     pass
 
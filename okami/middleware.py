@@ -1,14 +1,16 @@
-import hashlib
 import json
 import logging
 import os
 import time
+from collections.abc import Mapping
 from pathlib import Path
 
 import aiohttp
 from sqlitedict import SqliteDict
 
-from okami import settings, utils
+from okami import constants, settings, utils
+from okami.api import Response
+from okami.storage import Fingerprints, SimHashes
 
 log = logging.getLogger(__name__)
 
@@ -58,6 +60,9 @@ class Delta(Middleware):
     """
     Delta <okami.middleware.Delta>
 
+    Keeps keys in Journal <okami.middleware.Journal>, so keys are stored as they are added and loaded only when
+    they are first looked up.
+
     :param controller: Controller <okami.engine.Controller>
     """
 
@@ -72,11 +77,8 @@ class Delta(Middleware):
         if not settings.DELTA_ENABLED:
             return
         self.filename = os.path.join(settings.DELTA_PATH or ".", "{}.json".format(self.controller.spider.name))
-        path = Path(self.filename)
-        path.parent.mkdir(exist_ok=True)
-        path.touch(exist_ok=True)
-        with open(path, "r") as f:
-            self.db = json.loads(f.read() or "{}")
+        Path(self.filename).parent.mkdir(exist_ok=True)
+        self.db = Journal(filename=self.filename)
         self.controller.stats.set(self.key_added, 0)
         self.controller.stats.set(self.key_skipped, 0)
 
@@ -100,18 +102,19 @@ class Delta(Middleware):
 
     async def finalise(self):
         if self.db is not None:
-            with open(self.filename, "w") as f:
-                json.dump(obj=self.db, fp=f)
+            self.db.close()
 
     async def to_key(self, task, response):
-        key = await self.controller.spider.hash(task=task, response=response)
-        return key or hashlib.sha1(task.url.encode()).hexdigest()
+        return await self.controller.key_cache.get(task=task, response=response)
 
 
 class DeltaSqlite(Middleware):
     """
     DeltaSqlite <okami.middleware.DeltaSqlite>
 
+    Looks up keys of all tasks found in a response with one query and commits writes in batches of
+    DELTA_COMMIT_SIZE writes or every DELTA_COMMIT_INTERVAL seconds.
+
     :param controller: Controller <okami.engine.Controller>
     """
 
@@ -121,12 +124,15 @@ class DeltaSqlite(Middleware):
         self.filename = None
         self.key_added = "delta/added"
         self.key_skipped = "delta/skipped"
+        self.writes = 0
+        self.time_committed = time.time()
 
     async def initialise(self):
         if not settings.DELTA_ENABLED:
             return
         self.filename = os.path.join(settings.DELTA_PATH or ".", "{}.sqlite".format(self.controller.spider.name))
-        self.db = SqliteDict(filename=self.filename, tablename="delta", autocommit=True)
+        self.db = SqliteDict(filename=self.filename, tablename="delta", autocommit=False)
+        self.time_committed = time.time()
         self.controller.stats.set(self.key_added, 0)
         self.controller.stats.set(self.key_skipped, 0)
 
@@ -136,11 +142,16 @@ class DeltaSqlite(Middleware):
 
         if items:
             self.db[await self.to_key(task=task, response=response)] = str(time.time())
+            self.writes += 1
             self.controller.stats.incr(key=self.key_added)
+        self.commit()
+
+        keys = {t: await self.to_key(task=t, response=response) for t in tasks}
+        existing = self.existing(keys=set(keys.values()))
 
         _tasks = set()
-        for t in tasks:
-            if await self.to_key(task=t, response=response) in self.db:
+        for t, key in keys.items():
+            if key in existing:
                 log.info("Skipped visited url - %s", t.url)
                 self.controller.stats.incr(key=self.key_skipped)
                 continue
@@ -150,11 +161,94 @@ class DeltaSqlite(Middleware):
 
     async def finalise(self):
         if self.db is not None:
+            self.commit(force=True)
             self.db.close()
 
     async def to_key(self, task, response):
-        key = await self.controller.spider.hash(task=task, response=response)
-        return key or hashlib.sha1(task.url.encode()).hexdigest()
+        return await self.controller.key_cache.get(task=task, response=response)
+
+    def existing(self, keys, size=500):
+        """
+        Finds keys stored in database, uncommitted writes included.
+
+        :param keys: set of keys
+        :param size: (int) maximum number of keys in one query
+        :returns: set of stored keys
+        """
+        keys = list(keys)
+        existing = set()
+        for i in range(0, len(keys), size):
+            chunk = keys[i:i + size]
+            query = 'SELECT key FROM "{}" WHERE key IN ({})'.format(self.db.tablename, ",".join("?" * len(chunk)))
+            existing.update(key for key, in self.db.conn.select(query, tuple(chunk)))
+        return existing
+
+    def commit(self, force=False):
+        """
+        Commits buffered writes when there are DELTA_COMMIT_SIZE of them or DELTA_COMMIT_INTERVAL seconds passed
+        since the last commit.
+
+        :param force: (bool) commits any buffered writes
+        """
+        if not self.writes:
+            return
+        if (
+            force
+            or self.writes >= settings.DELTA_COMMIT_SIZE
+            or time.time() - self.time_committed >= settings.DELTA_COMMIT_INTERVAL
+        ):
+            self.db.commit()
+            self.writes = 0
+            self.time_committed = time.time()
+
+
+class Duplicates(Middleware):
+    """
+    Duplicates <okami.middleware.Duplicates>
+
+    Spider middleware skipping processing of responses with text already seen during scraping process, e.g. the same
+    page served under different URLs. Texts are compared by their fingerprints kept in
+    Fingerprints <okami.storage.Fingerprints> and with DUPLICATES_SIMHASH also by simhashes kept in
+    SimHashes <okami.storage.SimHashes>, so near-identical texts are skipped too. Streamed responses are
+    not compared. Skipped responses are counted in Stats <okami.api.Stats>.
+
+    :param controller: Controller <okami.engine.Controller>
+    """
+
+    def __init__(self, controller):
+        super().__init__(controller)
+        self.fingerprints = None
+        self.simhashes = None
+        self.key_skipped = "duplicates/skipped"
+
+    async def initialise(self):
+        self.fingerprints = Fingerprints(canonical=self.text)
+        if settings.DUPLICATES_SIMHASH:
+            self.simhashes = SimHashes(distance=settings.DUPLICATES_SIMHASH_DISTANCE)
+        self.controller.stats.set(self.key_skipped, 0)
+
+    async def before(self, task, response):
+        """
+        Processes passed Response <okami.Response>.
+
+        :param task: Task <okami.Task>
+        :param response: Response <okami.Response>
+        :returns: passed Response <okami.Response> or None when response is a duplicate
+        """
+        if self.fingerprints is None or response.content is not None:
+            return response
+        duplicate = not self.fingerprints.add(response)
+        if not duplicate and self.simhashes is not None:
+            duplicate = not self.simhashes.add(utils.simhash(text=response.text))
+        if duplicate:
+            log.info("Skipped duplicate response - %s", task.url)
+            self.controller.stats.incr(key=self.key_skipped)
+            return None
+        return response
+
+    @staticmethod
+    def text(response):
+        return response.text or ""
 
 
 class Logger(Middleware):
@@ -210,11 +304,138 @@ class Headers(Middleware):
         return request
 
 
+class Conditional(Middleware):
+    """
+    Conditional <okami.middleware.Conditional>
+
+    Stores ETag and Last-Modified headers of responses per requested URL, before redirects, and makes conditional
+    requests with If-None-Match and If-Modified-Since headers. On 304 Not Modified, page is either skipped or its
+    cached response is replayed into spider, see CONDITIONAL_MODE. Bodies are stored only in replay mode. Not
+    modified responses are counted in Stats <okami.api.Stats>. Writes are committed every CONDITIONAL_COMMIT_SIZE
+    writes.
+
+    :param controller: Controller <okami.engine.Controller>
+    """
+
+    def __init__(self, controller):
+        super().__init__(controller)
+        self.db = None
+        self.filename = None
+        self.replay = False
+        self.writes = 0
+        self.key_not_modified = "conditional/not_modified"
+
+    async def initialise(self):
+        if not settings.CONDITIONAL_ENABLED:
+            return
+        if settings.CONDITIONAL_MODE not in ("skip", "replay"):
+            raise ValueError("CONDITIONAL_MODE has to be skip or replay")
+        self.replay = settings.CONDITIONAL_MODE == "replay"
+        self.filename = os.path.join(
+            settings.CONDITIONAL_PATH or ".", "{}.conditional.sqlite".format(self.controller.spider.name)
+        )
+        self.db = SqliteDict(filename=self.filename, tablename="conditional", autocommit=False)
+        self.controller.stats.set(self.key_not_modified, 0)
+
+    async def before(self, request):
+        """
+        Adds conditional headers to passed Request <okami.Request> of already seen URL.
+
+        :param request: Request <okami.Request>
+        :returns: altered passed Request <okami.Request>
+        """
+        if self.db is None:
+            return request
+        entry = self.db.get(request.url)
+        if entry is None:
+            return request
+        if entry["etag"]:
+            request.headers["If-None-Match"] = entry["etag"]
+        if entry["modified"]:
+            request.headers["If-Modified-Since"] = entry["modified"]
+        return request
+
+    async def after(self, response):
+        """
+        Stores validators of passed Response <okami.Response> or replays cached response on 304 Not Modified.
+
+        :param response: Response <okami.Response>
+        :returns: Response <okami.Response>
+        """
+        if self.db is None:
+            return response
+
+        url = response.request_url or str(response.url)
+        if response.status == constants.status.HTTP_304:
+            self.controller.stats.incr(key=self.key_not_modified)
+            entry = self.db.get(url)
+            if not self.replay or entry is None or entry["body"] is None:
+                return response
+            response.release()
+            return Response(
+                url=response.url,
+                version=response.version,
+                status=entry["status"],
+                reason=entry["reason"],
+                headers=entry["headers"],
+                body=entry["body"],
+                encoding=entry["encoding"],
+                request_url=response.request_url,
+            )
+
+        etag, modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+        if response.status >= 300 or not (etag or modified):
+            return response
+        self.db[url] = dict(
+            etag=etag,
+            modified=modified,
+            status=response.status,
+            reason=response.reason,
+            headers=dict(response.headers) if self.replay else None,
+            body=response.body if self.replay else None,
+            encoding=response.encoding,
+        )
+        self.writes += 1
+        if self.writes >= settings.CONDITIONAL_COMMIT_SIZE:
+            self.db.commit()
+            self.writes = 0
+        return response
+
+    async def finalise(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+
+
 class Session(Middleware):
     """
     Session <okami.middleware.Session>
+
+    Creates a session shared by all requests unless a spider defines its own. Connections and DNS lookups of created
+    session are counted by Connections <okami.api.Connections>, hosts are resolved by Resolver <okami.api.Resolver>.
     """
 
+    def connector(self):
+        """
+        Returns arguments of aiohttp.TCPConnector from settings, resolving hosts with shared
+        Resolver <okami.api.Resolver> of controller. Keep-alive timeout does not apply when connections
+        are closed after every request, DNS cache is disabled with zero TTL.
+
+        :returns: (dictionary)
+        """
+        kwargs = dict(
+            limit=settings.CONN_MAX_CONCURRENT_CONNECTIONS,
+            limit_per_host=settings.CONN_MAX_CONCURRENT_CONNECTIONS_PER_HOST or 0,
+            verify_ssl=settings.CONN_VERIFY_SSL,
+            use_dns_cache=settings.CONN_DNS_CACHE_TTL != 0,
+            ttl_dns_cache=settings.CONN_DNS_CACHE_TTL,
+            force_close=settings.CONN_FORCE_CLOSE,
+            resolver=self.controller.resolver,
+        )
+        if not settings.CONN_FORCE_CLOSE:
+            kwargs.update(keepalive_timeout=settings.CONN_KEEPALIVE_TIMEOUT)
+        return kwargs
+
     async def before(self, request):
         """
         Processes passed Request <okami.Request>.
@@ -227,9 +448,94 @@ class Session(Middleware):
             try:
                 self.controller.session = await self.controller.spider.session(request=request)
             except NotImplementedError:
-                connector = aiohttp.TCPConnector(
-                    limit=settings.CONN_MAX_CONCURRENT_CONNECTIONS,
-                    verify_ssl=settings.CONN_VERIFY_SSL,
+                connector = aiohttp.TCPConnector(**self.connector())
+                self.controller.connections.connector = connector
+                self.controller.session = aiohttp.ClientSession(
+                    connector=connector, trace_configs=[self.controller.connections.trace]
                 )
-                self.controller.session = aiohttp.ClientSession(connector=connector)
         return request
+
+
+class Journal(Mapping):
+    """
+    Journal <okami.middleware.Journal>
+
+    Append-only mapping stored as a file with one JSON line of key and value per write. Index of keys is read from
+    file on first access and file is compacted when it holds `ratio` times more lines than there are keys. Lines
+    holding JSON object are read as multiple keys, so files written as a single JSON object are read as well.
+
+    :param filename: (str)
+    :param ratio: (float) ratio of lines to keys triggering compaction
+    """
+
+    def __init__(self, filename, ratio=2.0):
+        self.filename = filename
+        self.ratio = float(ratio)
+        self.lines = 0
+        self._index = None
+        with open(self.filename, "ab+") as f:
+            if f.tell():
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+        self.file = open(self.filename, "a", buffering=1)
+
+    def __getitem__(self, key):
+        return self.index[key]
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __setitem__(self, key, value):
+        self.file.write(json.dumps([key, value]) + "\n")
+        if self._index is not None:
+            self._index[key] = value
+            self.lines += 1
+            if self.lines > self.ratio * len(self._index):
+                self.compact()
+
+    @property
+    def index(self):
+        if self._index is None:
+            self.load()
+        return self._index
+
+    def load(self):
+        """
+        Reads index from file line by line. Lines which can not be parsed, e.g. written partially on crash, are
+        skipped.
+        """
+        index = dict()
+        lines = 0
+        with open(self.filename, "r") as f:
+            for line in f:
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(data, dict):
+                    index.update(data)
+                else:
+                    index[data[0]] = data[1]
+                lines += 1
+        self._index = index
+        self.lines = lines
+
+    def compact(self):
+        """
+        Rewrites file with one line per key.
+        """
+        filename = "{}.compact".format(self.filename)
+        with open(filename, "w") as f:
+            for key, value in self.index.items():
+                f.write(json.dumps([key, value]) + "\n")
+        self.file.close()
+        os.replace(filename, self.filename)
+        self.file = open(self.filename, "a", buffering=1)
+        self.lines = len(self._index)
+
+    def close(self):
+        self.file.close()
@@ -1,3 +1,8 @@
+import urllib.parse
+
+from okami import settings
+
+
 class Pipeline:
     """
     Base Pipeline <okami.pipeline.Pipeline>
@@ -35,6 +40,47 @@ class Cache(Pipeline):
         return spider
 
 
+class Canonical(Pipeline):
+    """
+    Canonical <okami.pipeline.Canonical>
+
+    Replaces tasks with tasks of canonical URLs when CANONICAL_ENABLED is set, see Task.canonical <okami.Task>, so the
+    same page linked with different URLs is queued and fetched only once.
+    """
+
+    async def process(self, tasks):
+        return {task.canonical() for task in tasks}
+
+
+class Resolve(Pipeline):
+    """
+    Resolve <okami.pipeline.Resolve>
+
+    Starts background DNS lookups of hosts of new tasks with Resolver <okami.api.Resolver>, so their addresses are
+    cached by the time tasks are scheduled. Lookups are skipped when DNS cache is disabled with CONN_DNS_CACHE_TTL or
+    when spider session does not use the resolver, i.e. session was not created by Session <okami.middleware.Session>.
+    """
+
+    @property
+    def enabled(self):
+        """
+        :returns: (bool) True when prefetched addresses are used by session
+        """
+        session = self.controller.session
+        return (
+            settings.CONN_DNS_CACHE_TTL != 0
+            and session is not None
+            and session.connector is not None
+            and session.connector is self.controller.connections.connector
+        )
+
+    async def process(self, tasks):
+        if self.enabled:
+            for task in tasks:
+                self.controller.resolver.prefetch(host=urllib.parse.urlsplit(task.url).hostname)
+        return tasks
+
+
 class Cleaner(Pipeline):
     async def process(self, items):
         return items
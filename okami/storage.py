@@ -1,5 +1,314 @@
+import array
+import hashlib
+import json
+import math
+import os
 import queue
+import sqlite3
 import time
+from collections import deque
+
+from okami import loader
+from okami.api import Task
+
+
+def canonical(task):
+    """
+    Default canonical representation of Task <okami.Task> used for fingerprints, URL and data.
+
+    :param task: Task <okami.Task>
+    :returns: (str)
+    """
+    return "{}\n{}".format(task.url, json.dumps(task.data, sort_keys=True, default=str))
+
+
+class Fingerprints:
+    """
+    Fingerprints <okami.storage.Fingerprints>
+
+    Compact set of tasks which keeps only 64-bit fingerprints of their canonical representation in an open addressing
+    hash table backed by an array, about 16 bytes per task. Different tasks sharing a fingerprint are considered
+    equal, which is unlikely below billions of tasks.
+
+    :param canonical: function returning canonical (str) representation of Task <okami.Task>
+    :param capacity: (int) initial number of slots, power of two
+    :param load: (float) maximum ratio of occupied slots before table is doubled
+    """
+
+    def __init__(self, canonical=canonical, capacity=1024, load=0.75):
+        self.canonical = canonical
+        self.max_load = float(load)
+        self.size = 0
+        self.table = array.array("Q", bytes(8 * capacity))
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, task):
+        fingerprint = self.fingerprint(task=task)
+        return self.table[self._slot(fingerprint=fingerprint)] == fingerprint
+
+    @property
+    def nbytes(self):
+        return self.table.itemsize * len(self.table)
+
+    def fingerprint(self, task):
+        """
+        :param task: Task <okami.Task>
+        :returns: (int) non-zero 64-bit fingerprint
+        """
+        digest = hashlib.blake2b(self.canonical(task).encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little") or 1
+
+    def add(self, task):
+        """
+        Adds task to a set.
+
+        :param task: Task <okami.Task>
+        :returns: (bool) True when task was not in a set before
+        """
+        fingerprint = self.fingerprint(task=task)
+        slot = self._slot(fingerprint=fingerprint)
+        if self.table[slot] == fingerprint:
+            return False
+        self.table[slot] = fingerprint
+        self.size += 1
+        if self.size > self.max_load * len(self.table):
+            self._resize()
+        return True
+
+    def update(self, values):
+        for v in values:
+            self.add(task=v)
+
+    def dump(self, fp):
+        """
+        Writes fingerprints to binary file object, header line in JSON followed by hash table.
+
+        :param fp: binary file object
+        """
+        fp.write(json.dumps(dict(size=self.size, capacity=len(self.table))).encode("utf-8") + b"\n")
+        fp.write(self.table.tobytes())
+
+    def load(self, fp):
+        """
+        Replaces fingerprints with ones read from binary file object written by `dump`.
+
+        :param fp: binary file object
+        """
+        header = json.loads(fp.readline().decode("utf-8"))
+        self.table = array.array("Q")
+        self.table.frombytes(fp.read(8 * header["capacity"]))
+        self.size = header["size"]
+
+    def _slot(self, fingerprint):
+        table = self.table
+        mask = len(table) - 1
+        slot = fingerprint & mask
+        while table[slot] and table[slot] != fingerprint:
+            slot = (slot + 1) & mask
+        return slot
+
+    def _resize(self):
+        table = self.table
+        self.table = array.array("Q", bytes(16 * len(table)))
+        for fingerprint in table:
+            if fingerprint:
+                self.table[self._slot(fingerprint=fingerprint)] = fingerprint
+
+
+class SimHashes:
+    """
+    SimHashes <okami.storage.SimHashes>
+
+    Set of 64-bit simhashes answering whether a similar simhash, differing in at most `distance` bits, was added.
+    Simhashes are split into `distance + 1` blocks and indexed by every block, so similar simhashes share at least
+    one block and only simhashes sharing a block are compared.
+
+    :param distance: (int) maximum number of different bits of similar simhashes
+    """
+
+    def __init__(self, distance=3):
+        self.distance = int(distance)
+        width = 64 // (self.distance + 1)
+        self.blocks = []
+        for i in range(self.distance + 1):
+            bits = 64 - i * width if i == self.distance else width
+            self.blocks.append((i * width, (1 << bits) - 1))
+        self.index = [dict() for _ in self.blocks]
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, value):
+        for (shift, mask), index in zip(self.blocks, self.index):
+            for other in index.get(value >> shift & mask, ()):
+                if bin(value ^ other).count("1") <= self.distance:
+                    return True
+        return False
+
+    def add(self, value):
+        """
+        Adds simhash to a set unless a similar one was added before.
+
+        :param value: (int) simhash
+        :returns: (bool) True when no similar simhash was in a set before
+        """
+        if value in self:
+            return False
+        for (shift, mask), index in zip(self.blocks, self.index):
+            index.setdefault(value >> shift & mask, []).append(value)
+        self.size += 1
+        return True
+
+
+class BloomFilter:
+    """
+    BloomFilter <okami.storage.BloomFilter>
+
+    :param capacity: (int) number of values filter is sized for
+    :param error_rate: (float) false positive rate at capacity
+    :param bits: (bytearray) filter bits, empty filter by default
+    :param count: (int) number of values added
+    """
+
+    def __init__(self, capacity, error_rate, bits=None, count=0):
+        self.capacity = int(capacity)
+        self.error_rate = float(error_rate)
+        self.size = int(math.ceil(-self.capacity * math.log(self.error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / self.capacity * math.log(2))))
+        self.bits = bits if bits is not None else bytearray((self.size + 7) // 8)
+        self.count = int(count)
+
+    @property
+    def fill_ratio(self):
+        """
+        :returns: (float) estimated ratio of set bits
+        """
+        return 1.0 - math.exp(-self.hashes * self.count / self.size)
+
+    @property
+    def false_positive_rate(self):
+        """
+        :returns: (float) estimated false positive rate
+        """
+        return self.fill_ratio ** self.hashes
+
+    def positions(self, h1, h2):
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def contains(self, h1, h2):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self.positions(h1=h1, h2=h2))
+
+    def add(self, h1, h2):
+        for p in self.positions(h1=h1, h2=h2):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+
+class ScalableBloomFilter:
+    """
+    ScalableBloomFilter <okami.storage.ScalableBloomFilter>
+
+    Probabilistic set of tasks. When a filter reaches its capacity, a new one is added with `growth` times larger
+    capacity and `ratio` times lower error rate, so overall false positive rate stays below `error_rate` however
+    many tasks are added. Tasks are never reported as not present when they were added.
+
+    :param canonical: function returning canonical (str) representation of Task <okami.Task>
+    :param capacity: (int) capacity of the first filter
+    :param error_rate: (float) overall false positive rate
+    :param growth: (int) capacity growth of every next filter
+    :param ratio: (float) error rate tightening of every next filter
+    """
+
+    def __init__(self, canonical=canonical, capacity=100000, error_rate=0.001, growth=2, ratio=0.5):
+        self.canonical = canonical
+        self.capacity = int(capacity)
+        self.error_rate = float(error_rate)
+        self.growth = int(growth)
+        self.ratio = float(ratio)
+        self.filters = []
+
+    def __len__(self):
+        return sum(f.count for f in self.filters)
+
+    def __contains__(self, task):
+        h1, h2 = self.hash(task=task)
+        return any(f.contains(h1=h1, h2=h2) for f in self.filters)
+
+    @property
+    def fill_ratio(self):
+        """
+        :returns: (float) estimated ratio of set bits of the filter tasks are added to
+        """
+        return self.filters[-1].fill_ratio if self.filters else 0.0
+
+    @property
+    def false_positive_rate(self):
+        """
+        :returns: (float) estimated false positive rate of all filters
+        """
+        rate = 1.0
+        for f in self.filters:
+            rate *= 1.0 - f.false_positive_rate
+        return 1.0 - rate
+
+    def hash(self, task):
+        """
+        :param task: Task <okami.Task>
+        :returns: (tuple of (int, int)) two 64-bit hashes
+        """
+        digest = hashlib.blake2b(self.canonical(task).encode("utf-8"), digest_size=16).digest()
+        return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+    def add(self, task):
+        """
+        Adds task to a filter.
+
+        :param task: Task <okami.Task>
+        :returns: (bool) True when task was certainly not in a filter before
+        """
+        h1, h2 = self.hash(task=task)
+        if any(f.contains(h1=h1, h2=h2) for f in self.filters):
+            return False
+        if not self.filters or self.filters[-1].count >= self.filters[-1].capacity:
+            n = len(self.filters)
+            self.filters.append(
+                BloomFilter(
+                    capacity=self.capacity * self.growth ** n,
+                    error_rate=self.error_rate * (1.0 - self.ratio) * self.ratio ** n,
+                )
+            )
+        self.filters[-1].add(h1=h1, h2=h2)
+        return True
+
+    def update(self, values):
+        for v in values:
+            self.add(task=v)
+
+    def dump(self, fp):
+        """
+        Writes filters to binary file object, header line in JSON followed by bits of every filter.
+
+        :param fp: binary file object
+        """
+        header = [dict(capacity=f.capacity, error_rate=f.error_rate, count=f.count) for f in self.filters]
+        fp.write(json.dumps(header).encode("utf-8") + b"\n")
+        for f in self.filters:
+            fp.write(f.bits)
+
+    def load(self, fp):
+        """
+        Replaces filters with ones read from binary file object written by `dump`.
+
+        :param fp: binary file object
+        """
+        self.filters = []
+        for kwargs in json.loads(fp.readline().decode("utf-8")):
+            f = BloomFilter(**kwargs)
+            f.bits = bytearray(fp.read(len(f.bits)))
+            self.filters.append(f)
 
 
 class BaseStorage:
@@ -15,6 +324,9 @@ class BaseStorage:
     def to_dict(self):
         return dict()
 
+    def initialise(self):
+        pass
+
     def finalise(self):
         pass
 
@@ -42,9 +354,18 @@ class BaseStorage:
     def get_tasks_queued(self):
         raise NotImplementedError
 
+    def get_tasks_queued_batch(self, size):
+        tasks = []
+        while len(tasks) < size and not self.tasks_queued_is_empty():
+            tasks.append(self.get_tasks_queued())
+        return tasks
+
     def add_tasks_queued(self, values):
         raise NotImplementedError
 
+    def add_tasks_finished(self, values):
+        pass
+
     def tasks_queued_is_empty(self):
         raise NotImplementedError
 
@@ -65,28 +386,118 @@ class Storage(BaseStorage):
     """
     Storage <okami.storage.Storage>
 
+    Processed tasks are kept as Fingerprints <okami.storage.Fingerprints>. With `bloom` enabled they are checked
+    against ScalableBloomFilter <okami.storage.ScalableBloomFilter> first and, unless `bloom_exact` is enabled,
+    fingerprints are not kept at all, so roughly `bloom_error_rate` of new tasks are skipped as already processed.
+    When `path` is set, Bloom filter, fingerprints and queued tasks, including tasks handed out but not finished, are
+    stored on finalise and loaded on initialise, so a crawl can be continued.
+
     :param name: Spider <okami.Spider> name attribute
+    :param canonical: (str) path and name of a function returning canonical representation of Task <okami.Task>
+        used for fingerprints, tasks with the same representation are processed only once
+    :param bloom: (bool) enables Bloom filter
+    :param bloom_capacity: (int) capacity of the first Bloom filter
+    :param bloom_error_rate: (float) Bloom filter false positive rate
+    :param bloom_exact: (bool) keeps fingerprints to confirm tasks Bloom filter reports as processed
+    :param path: (str) directory Bloom filter and queue are stored to on finalise and loaded from on initialise
     """
 
-    def __init__(self, name=None, **kwargs):
+    def __init__(
+        self,
+        name=None,
+        canonical="okami.storage.canonical",
+        bloom=False,
+        bloom_capacity=100000,
+        bloom_error_rate=0.001,
+        bloom_exact=False,
+        path=None,
+        **kwargs
+    ):
         super().__init__(name, **kwargs)
         self.name = name
+        self.filename = os.path.join(path, "{}.bloom".format(name)) if bloom and path else None
         self._info_time_started = None
         self._info_items_processed = 0
         self._info_items_failed = 0
         self._tasks_queued = queue.Queue()
-        self._tasks_processed = set()
+        self._tasks_pending = set()
+        canonical = loader.get_class(canonical) if isinstance(canonical, str) else canonical
+        self._tasks_bloom = None
+        self._tasks_processed = None
+        if bloom:
+            self._tasks_bloom = ScalableBloomFilter(
+                canonical=canonical, capacity=bloom_capacity, error_rate=bloom_error_rate
+            )
+        if not bloom or bloom_exact:
+            self._tasks_processed = Fingerprints(canonical=canonical)
         self._tasks_failed = set()
 
     def to_dict(self):
-        return dict(
+        data = dict(
             times_running=self.get_info_time_running(),
             tasks_queued=self._tasks_queued.qsize(),
-            tasks_processed=len(self._tasks_processed),
+            tasks_processed=len(self.get_tasks_processed()),
             tasks_failed=len(self._tasks_failed),
             items_processed=self._info_items_processed,
             items_failed=self._info_items_failed,
         )
+        if self._tasks_bloom is not None:
+            data.update(
+                bloom_filters=len(self._tasks_bloom.filters),
+                bloom_fill_ratio=self._tasks_bloom.fill_ratio,
+                bloom_error_rate=self._tasks_bloom.false_positive_rate,
+            )
+        return data
+
+    def initialise(self):
+        if self.filename and os.path.exists(self.filename):
+            with open(self.filename, "rb") as f:
+                self.load(fp=f)
+
+    def finalise(self):
+        if self.filename:
+            with open(self.filename, "wb") as f:
+                self.dump(fp=f)
+
+    def dump(self, fp):
+        """
+        Writes state to binary file object, header line in JSON, a line in JSON for every queued task, Bloom filter and
+        fingerprints when kept. Tasks handed out but not finished are written as queued.
+
+        :param fp: binary file object
+        """
+        tasks = list(self._tasks_pending) + list(self._tasks_queued.queue)
+        header = dict(queued=len(tasks), fingerprints=self._tasks_processed is not None)
+        fp.write(json.dumps(header).encode("utf-8") + b"\n")
+        for task in tasks:
+            fp.write(json.dumps(task.to_dict(), sort_keys=True).encode("utf-8") + b"\n")
+        self._tasks_bloom.dump(fp=fp)
+        if self._tasks_processed is not None:
+            self._tasks_processed.dump(fp=fp)
+
+    def load(self, fp):
+        """
+        Replaces state with one read from binary file object written by `dump`.
+
+        :param fp: binary file object
+        """
+        header = json.loads(fp.readline().decode("utf-8"))
+        self._tasks_queued = queue.Queue()
+        for _ in range(header["queued"]):
+            self._tasks_queued.put(item=Task.from_dict(json.loads(fp.readline().decode("utf-8"))), timeout=0)
+        self._tasks_bloom.load(fp=fp)
+        if header["fingerprints"] and self._tasks_processed is not None:
+            self._tasks_processed.load(fp=fp)
+
+    def _add_tasks_processed(self, task):
+        if self._tasks_bloom is not None:
+            if self._tasks_bloom.add(task=task):
+                if self._tasks_processed is not None:
+                    self._tasks_processed.add(task=task)
+                return True
+            if self._tasks_processed is None:
+                return False
+        return self._tasks_processed.add(task=task)
 
     def get_info_time_started(self):
         return self._info_time_started
@@ -114,24 +525,39 @@ class Storage(BaseStorage):
     def add_tasks_queued(self, values: set):
         if not isinstance(values, set):
             raise ValueError
-        values -= self._tasks_processed
-        self.add_tasks_processed(values=values)
         for v in values:
-            self._tasks_queued.put(item=v, timeout=0)
+            if self._add_tasks_processed(task=v):
+                self._tasks_queued.put(item=v, timeout=0)
 
     def tasks_queued_is_empty(self):
         return self._tasks_queued.empty()
 
     def get_tasks_queued(self):
-        return self._tasks_queued.get(timeout=0)
+        task = self._tasks_queued.get(timeout=0)
+        self._tasks_pending.add(task)
+        return task
+
+    def get_tasks_queued_batch(self, size: int):
+        tasks = []
+        try:
+            for _ in range(size):
+                tasks.append(self._tasks_queued.get_nowait())
+        except queue.Empty:
+            pass
+        self._tasks_pending.update(tasks)
+        return tasks
+
+    def add_tasks_finished(self, values: set):
+        self._tasks_pending -= values
 
     def get_tasks_processed(self):
-        return self._tasks_processed
+        return self._tasks_bloom if self._tasks_processed is None else self._tasks_processed
 
     def add_tasks_processed(self, values: set):
         if not isinstance(values, set):
             raise ValueError
-        self._tasks_processed |= values
+        for v in values:
+            self._add_tasks_processed(task=v)
 
     def get_tasks_failed(self):
         return self._tasks_failed
@@ -140,3 +566,164 @@ class Storage(BaseStorage):
         if not isinstance(values, set):
             raise ValueError
         self._tasks_failed |= values
+
+
+class SqliteStorage(BaseStorage):
+    """
+    SqliteStorage <okami.storage.SqliteStorage>
+
+    Keeps queue, processed and failed tasks in SQLite database in WAL mode, so crawls are not limited by memory and
+    can be resumed after restart. Queued tasks are read from disk in chunks of `buffer` tasks and removed from disk
+    when finished, so tasks interrupted by a crash are queued again on resume.
+
+    :param name: Spider <okami.Spider> name attribute
+    :param path: (str) database directory, defaults to current directory
+    :param resume: (bool) continue from existing database, otherwise it is cleared
+    :param buffer: (int) number of queued tasks read from disk at once
+    :param mmap_size: (int) number of bytes of database memory mapped by SQLite
+    :param synchronous: (str) SQLite synchronous pragma, NORMAL is safe with WAL
+    """
+
+    def __init__(
+        self, name=None, path=None, resume=True, buffer=1000, mmap_size=2 ** 26, synchronous="NORMAL", **kwargs
+    ):
+        super().__init__(name, **kwargs)
+        self.filename = os.path.join(path or ".", "{}.storage.sqlite".format(name))
+        self.buffer = int(buffer)
+        self.connection = sqlite3.connect(self.filename)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous={}".format(synchronous))
+        self.connection.execute("PRAGMA mmap_size={}".format(int(mmap_size)))
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value REAL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS queued (id INTEGER PRIMARY KEY, task TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS processed (task TEXT PRIMARY KEY) WITHOUT ROWID")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS failed (task TEXT PRIMARY KEY) WITHOUT ROWID")
+            if not resume:
+                for table in ["info", "queued", "processed", "failed"]:
+                    self.connection.execute("DELETE FROM {}".format(table))
+        self._tasks_queued = deque()
+        self._tasks_queued_ids = dict()
+        self._tasks_queued_last = 0
+        self._tasks_queued_size = self._count("queued")
+        self._tasks_processed_size = self._count("processed")
+        self._tasks_failed_size = self._count("failed")
+        self._info_time_started = self._get_info("time_started")
+        self._info_items_processed = int(self._get_info("items_processed") or 0)
+        self._info_items_failed = int(self._get_info("items_failed") or 0)
+
+    def to_dict(self):
+        return dict(
+            times_running=self.get_info_time_running(),
+            tasks_queued=self._tasks_queued_size,
+            tasks_processed=self._tasks_processed_size,
+            tasks_failed=self._tasks_failed_size,
+            items_processed=self._info_items_processed,
+            items_failed=self._info_items_failed,
+        )
+
+    def finalise(self):
+        self.connection.close()
+
+    @staticmethod
+    def dumps(task):
+        return json.dumps(task.to_dict(), sort_keys=True)
+
+    @staticmethod
+    def loads(value):
+        return Task.from_dict(json.loads(value))
+
+    def _count(self, table):
+        return self.connection.execute("SELECT COUNT(*) FROM {}".format(table)).fetchone()[0]
+
+    def _get_info(self, key):
+        row = self.connection.execute("SELECT value FROM info WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_info(self, key, value):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)", (key, value))
+        return value
+
+    def get_info_time_started(self):
+        return self._info_time_started
+
+    def set_info_time_started(self, value: float):
+        self._info_time_started = self._set_info("time_started", float(value))
+
+    def get_info_time_running(self):
+        return (time.time() - self._info_time_started) if self._info_time_started else 0.0
+
+    def get_info_items_processed(self):
+        return self._info_items_processed
+
+    def add_info_items_processed(self, value: int):
+        self._info_items_processed = self._set_info("items_processed", self._info_items_processed + int(value))
+        return self._info_items_processed
+
+    def get_info_items_failed(self):
+        return self._info_items_failed
+
+    def add_info_items_failed(self, value: int):
+        self._info_items_failed = self._set_info("items_failed", self._info_items_failed + int(value))
+        return self._info_items_failed
+
+    def add_tasks_queued(self, values: set):
+        if not isinstance(values, set):
+            raise ValueError
+        with self.connection:
+            for v in values:
+                task = self.dumps(v)
+                if self.connection.execute("INSERT OR IGNORE INTO processed (task) VALUES (?)", (task,)).rowcount:
+                    self.connection.execute("INSERT INTO queued (task) VALUES (?)", (task,))
+                    self._tasks_queued_size += 1
+                    self._tasks_processed_size += 1
+
+    def add_tasks_finished(self, values: set):
+        ids = [(self._tasks_queued_ids.pop(v),) for v in values if v in self._tasks_queued_ids]
+        with self.connection:
+            self.connection.executemany("DELETE FROM queued WHERE id = ?", ids)
+
+    def tasks_queued_is_empty(self):
+        return self._tasks_queued_size == 0
+
+    def _read_tasks_queued(self):
+        rows = self.connection.execute(
+            "SELECT id, task FROM queued WHERE id > ? ORDER BY id LIMIT ?", (self._tasks_queued_last, self.buffer)
+        ).fetchall()
+        for i, task in rows:
+            self._tasks_queued.append((i, self.loads(task)))
+        if rows:
+            self._tasks_queued_last = rows[-1][0]
+
+    def get_tasks_queued(self):
+        if not self._tasks_queued:
+            self._read_tasks_queued()
+        if not self._tasks_queued:
+            raise queue.Empty
+        i, task = self._tasks_queued.popleft()
+        self._tasks_queued_ids[task] = i
+        self._tasks_queued_size -= 1
+        return task
+
+    def get_tasks_processed(self):
+        return {self.loads(task) for task, in self.connection.execute("SELECT task FROM processed")}
+
+    def add_tasks_processed(self, values: set):
+        if not isinstance(values, set):
+            raise ValueError
+        with self.connection:
+            self._tasks_processed_size += self.connection.executemany(
+                "INSERT OR IGNORE INTO processed (task) VALUES (?)", [(self.dumps(v),) for v in values]
+            ).rowcount
+
+    def get_tasks_failed(self):
+        return {self.loads(task) for task, in self.connection.execute("SELECT task FROM failed")}
+
+    def add_tasks_failed(self, values: set):
+        if not isinstance(values, set):
+            raise ValueError
+        with self.connection:
+            self._tasks_failed_size += self.connection.executemany(
+                "INSERT OR IGNORE INTO failed (task) VALUES (?)", [(self.dumps(v),) for v in values]
+            ).rowcount
@@ -1,10 +1,21 @@
+import codecs
+import functools
+import hashlib
+import ipaddress
 import json
 import re
 import urllib.parse
+from collections import Counter
+
+import lxml.etree
 
 RE_DOMAIN = re.compile(
     pattern="^((http[s]?|ftp):\/\/)?(?:[^@\n]+@)?(?:www\.)?([^:\/\n]+)(:[0-9]{2,6})?", flags=re.UNICODE | re.IGNORECASE
 )
+RE_WORD = re.compile(pattern=r"\w+", flags=re.UNICODE)
+RE_META_CHARSET = re.compile(pattern=rb"<meta[^>]+charset\s*=\s*[\"']?\s*([\w.:-]+)", flags=re.IGNORECASE)
+BOMS = ((codecs.BOM_UTF8, "utf-8"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16"))
+DEFAULT_PORTS = dict(http=80, https=443, ftp=21)
 
 
 def slow_parse_domain_url(domain, url):
@@ -33,6 +44,135 @@ def filter_urls(domains, urls):
     return {u for u in urls if RE_DOMAIN.match(u).group(0) in dd}
 
 
+@functools.lru_cache(maxsize=2 ** 16)
+def canonical_url(url, sort_query=True, drop_fragment=True, drop_params=(), strip_www=False):
+    """
+    Canonicalises URL, lowercases scheme and host, removes default port and optionally sorts query, drops fragment,
+    query parameters and `www.` host prefix. Query is kept as it is otherwise, parameters are not decoded. Canonical
+    URLs are cached, so URLs linked from many pages are canonicalised only once.
+
+    :param url: URL
+    :param sort_query: (bool) sorts query parameters
+    :param drop_fragment: (bool) drops fragment
+    :param drop_params: tuple of query parameter names to drop, names ending with * drop parameters by prefix
+    :param strip_www: (bool) drops www. host prefix
+    :returns: (str) canonical URL
+    """
+    parts = urllib.parse.urlsplit(url)
+    scheme, netloc, path, query, fragment = parts
+    scheme = scheme.lower()
+    if netloc:
+        try:
+            port = parts.port
+        except ValueError:
+            return url
+        host = parts.hostname or ""
+        if strip_www and host.startswith("www."):
+            host = host[4:]
+        if ":" in host:
+            host = "[{}]".format(host)
+        if port is not None and port != DEFAULT_PORTS.get(scheme):
+            host = "{}:{}".format(host, port)
+        userinfo, _, _ = netloc.rpartition("@")
+        netloc = "{}@{}".format(userinfo, host) if userinfo else host
+        path = path or "/"
+    if query and (sort_query or drop_params):
+        params = [p for p in query.split("&") if p]
+        if drop_params:
+            names = {p for p in drop_params if not p.endswith("*")}
+            prefixes = tuple(p[:-1] for p in drop_params if p.endswith("*"))
+            params = [p for p in params if not is_param_dropped(p.partition("=")[0], names, prefixes)]
+        query = "&".join(sorted(params) if sort_query else params)
+    if drop_fragment:
+        fragment = ""
+    return urllib.parse.urlunsplit((scheme, netloc, path, query, fragment))
+
+
+def is_param_dropped(name, names, prefixes):
+    return name in names or name.startswith(prefixes)
+
+
+def is_ip_address(host):
+    try:
+        ipaddress.ip_address(host.strip("[]"))
+    except ValueError:
+        return False
+    return True
+
+
+@functools.lru_cache(maxsize=256)
+def compile_xpath(expressions):
+    """
+    Compiles XPath expressions into a single union expression, compiled only once for the same expressions.
+
+    :param expressions: tuple of XPath expressions
+    :returns: lxml.etree.XPath or None if there are no expressions
+    """
+    if not expressions:
+        return None
+    return lxml.etree.XPath(" | ".join("({})".format(e) for e in expressions))
+
+
+# bits of every byte value spread into 32-bit lanes, one lane per bit, for each of 8 bytes of a 64-bit hash
+SIMHASH_LANES = [
+    [sum(1 << 32 * (8 * i + bit) for bit in range(8) if value >> bit & 1) for value in range(256)] for i in range(8)
+]
+
+
+def simhash(text, shingle=3):
+    """
+    Computes 64-bit simhash of text from its lowercased word shingles weighted by number of occurrences. Similar
+    texts have simhashes differing in a few bits. Weights of all 64 bits are summed at once in lanes of one integer.
+
+    :param text: (str)
+    :param shingle: (int) number of words in a shingle
+    :returns: (int)
+    """
+    words = RE_WORD.findall(text.lower())
+    if not words:
+        return 0
+    features = Counter(" ".join(words[i:i + shingle]) for i in range(max(1, len(words) - shingle + 1)))
+    lanes = 0
+    for feature, weight in features.items():
+        digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+        lanes += weight * sum(SIMHASH_LANES[i][b] for i, b in enumerate(digest))
+    total = sum(features.values())
+    mask = (1 << 32) - 1
+    return sum(1 << bit for bit in range(64) if 2 * (lanes >> 32 * bit & mask) > total)
+
+
+def detect_encoding(body, default="cp1252"):
+    """
+    Detects encoding of HTML body not declared in headers, from byte order mark, charset of `<meta>` tag in the first
+    1024 bytes or by trying UTF-8. Otherwise encoding is detected with chardet when installed.
+
+    :param body: (bytes)
+    :param default: encoding used when encoding is not detected
+    :returns: (str)
+    """
+    body = bytes(body)
+    for bom, encoding in BOMS:
+        if body.startswith(bom):
+            return encoding
+    match = RE_META_CHARSET.search(body[:1024])
+    if match is not None:
+        try:
+            return codecs.lookup(match.group(1).decode("ascii")).name
+        except LookupError:
+            pass
+    try:
+        body.decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    try:
+        import chardet
+
+        return chardet.detect(body)["encoding"] or default
+    except ImportError:
+        return default
+
+
 def pprint(obj):
     dump = json.dumps(obj, sort_keys=True, indent=4, separators=(",", ": "), ensure_ascii=False)
     try:
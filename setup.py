@@ -27,7 +27,7 @@ setup(
     include_package_data=True,
     python_requires=">=3.6",
     install_requires=[
-        "aiohttp>=3.2.0,<4.0",
+        "aiohttp>=3.3.0,<4.0",
         "attrs>=18.1.0,<19.0",
         "click>=6.0,<7.0",
         "lxml>=4.0,<5.0",
@@ -1,18 +1,155 @@
+import asyncio
+import hashlib
 import time
 from collections import namedtuple
 from unittest import mock
 
 import aiohttp
+import lxml.html
 import pytest
 import yarl
 from aiohttp import web
 
-from okami import constants
-from okami.api import Downloader, Item, Response, Result, Request, State, Stats, Task, Throttle
+from okami import constants, settings
+from okami.api import (
+    AdaptiveThrottle, Bucket, Connections, Downloader, Item, KeyCache, Resolver, Response, Result, Request, State,
+    Stats, Task, Throttle, Window,
+)
 from okami.engine import Controller
+from okami.exceptions import ResponseRejectedException
 from tests.factory import Factory
 
 
+@pytest.mark.freeze_time("2016-12-23 00:00:00")
+def test_bucket___init__():
+    bucket = Bucket()
+    assert bucket.max_rps is None
+    assert bucket.burst == 1.0
+    assert bucket.tokens == 1.0
+    assert bucket.time_last_modified == time.time()
+    assert bucket.max_concurrent is None
+    assert bucket.active == 0
+    assert bucket.requests == 0
+    assert bucket.throttled == 0
+
+    assert bucket.max_failures is None
+    assert bucket.recovery == 30.0
+    assert bucket.circuit == Bucket.CLOSED
+
+    bucket = Bucket(max_rps=2, max_concurrent=3, burst=4, max_failures=5, recovery=None)
+    assert bucket.max_rps == 2.0
+    assert bucket.burst == 4.0
+    assert bucket.tokens == 4.0
+    assert bucket.max_concurrent == 3
+    assert bucket.max_failures == 5
+    assert bucket.recovery == 30.0
+
+
+@pytest.mark.asyncio
+async def test_bucket___aenter__():
+    bucket = Bucket(max_concurrent=1)
+    async with bucket as b:
+        assert b is bucket
+        assert bucket.active == 1
+        assert bucket.requests == 1
+        waiter = asyncio.ensure_future(bucket.__aenter__())
+        await asyncio.sleep(0)
+        assert waiter.done() is False
+    await asyncio.wait_for(waiter, timeout=1)
+    assert bucket.active == 1
+    await bucket.__aexit__(None, None, None)
+    assert bucket.active == 0
+
+    bucket = Bucket()
+    async with bucket:
+        async with bucket:
+            assert bucket.requests == 2
+
+
+def test_bucket_to_dict():
+    assert Bucket(burst=2).to_dict() == dict(requests=0, throttled=0, tokens=2.0, circuit="closed", opened=0)
+
+
+@pytest.mark.freeze_time("2016-12-23 00:00:00")
+def test_bucket_circuit(freezer):
+    bucket = Bucket()
+    for _ in range(10):
+        bucket.failure()
+    assert bucket.circuit == Bucket.CLOSED
+    assert bucket.take() == 0.0
+
+    bucket = Bucket(max_failures=2, recovery=10)
+    bucket.failure()
+    bucket.success()
+    bucket.failure()
+    assert bucket.circuit == Bucket.CLOSED
+    bucket.failure()
+    assert bucket.circuit == Bucket.OPEN
+    assert bucket.opened == 1
+    assert bucket.take() == 10.0
+    assert bucket.throttled == 1
+
+    # half-open allows a single trial request
+    freezer.move_to("2016-12-23 00:00:10")
+    assert bucket.wait() == 0.0
+    assert bucket.circuit == Bucket.HALF_OPEN
+    assert bucket.take() == 0.0
+    assert bucket.take() == 10.0
+
+    # failed trial opens circuit again
+    bucket.failure()
+    assert bucket.circuit == Bucket.OPEN
+    assert bucket.opened == 2
+    freezer.move_to("2016-12-23 00:00:15")
+    assert bucket.take() == 5.0
+
+    freezer.move_to("2016-12-23 00:00:20")
+    assert bucket.take() == 0.0
+    bucket.success()
+    assert bucket.circuit == Bucket.CLOSED
+    assert bucket.failures == 0
+    assert bucket.take() == 0.0
+
+
+@pytest.mark.freeze_time("2016-12-23 00:00:00")
+def test_bucket_wait(freezer):
+    bucket = Bucket()
+    assert bucket.wait() == 0.0
+
+    bucket = Bucket(max_rps=2)
+    assert bucket.wait() == 0.0
+    bucket.tokens = 0.0
+    assert bucket.wait() == 0.5
+    freezer.move_to("2016-12-23 00:00:00.25")
+    assert bucket.wait() == 0.25
+    assert bucket.tokens == 0.5
+    freezer.move_to("2016-12-23 00:01:00")
+    assert bucket.wait() == 0.0
+    assert bucket.tokens == 1.0
+
+
+@pytest.mark.freeze_time("2016-12-23 00:00:00")
+def test_bucket_take(freezer):
+    bucket = Bucket()
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.throttled == 0
+
+    bucket = Bucket(max_rps=2)
+    assert bucket.take() == 0.0
+    assert bucket.take() == 0.5
+    assert bucket.take() == 0.5
+    assert bucket.throttled == 2
+    freezer.move_to("2016-12-23 00:00:00.5")
+    assert bucket.take() == 0.0
+    assert bucket.take() == 0.5
+
+    freezer.move_to("2016-12-23 00:00:00")
+    bucket = Bucket(max_rps=1, burst=2)
+    assert bucket.take() == 0.0
+    assert bucket.take() == 0.0
+    assert bucket.take() == 1.0
+
+
 def test_downloader___init__():
     controller = object()
     downloader = Downloader(controller=controller)
@@ -36,11 +173,133 @@ async def test_downloader_process(factory: Factory, server):
         response = await downloader.process(request=request)
         assert isinstance(response.url, yarl.URL)
         assert str(response.url) == request.url
+        assert response.request_url is request.url
         assert response.status == 404
         assert response.reason == "Not Found"
         assert "Content-Type" in response.headers
         assert "Content-Length" in response.headers
         assert response.text == "404: Not Found"
+        assert response.body == b"404: Not Found"
+        assert response.encoding == "utf-8"
+
+        await controller.session.close()
+
+
+@pytest.mark.asyncio
+async def test_downloader_process_stream(factory: Factory, server):
+    async def handler(request):
+        return web.Response(text="<html><a href='/a/'>a</a></html>", content_type="text/html")
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    async with server(app=app, port=8888):
+        spider = factory.obj.spider.create()
+        spider.stream = ("a",)
+        controller = Controller(spider=spider)
+        controller.session = aiohttp.ClientSession()
+        downloader = Downloader(controller=controller)
+
+        response = await downloader.process(request=Request(url="http://127.0.0.1:8888/"))
+        assert response.status == 200
+        assert response.text is None
+        assert response.encoding == "utf-8"
+        assert [e.get("href") async for e in response.iterparse(tag="a")] == ["/a/"]
+        response.release()
+        assert response._release is None
+        response.release()
+
+        await controller.session.close()
+
+
+@pytest.mark.asyncio
+async def test_downloader_process_timeout(factory: Factory, server):
+    async def handler(request):
+        response = web.StreamResponse(headers={"Content-Type": "text/html"})
+        await response.prepare(request)
+        for _ in range(5):
+            await response.write(b"x" * 100)
+            await asyncio.sleep(0.1)
+        return response
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    async with server(app=app, port=8888):
+        spider = factory.obj.spider.create()
+        controller = Controller(spider=spider)
+        controller.session = aiohttp.ClientSession()
+        downloader = Downloader(controller=controller)
+        request = Request(url="http://127.0.0.1:8888/")
+
+        assert downloader.timeout == aiohttp.ClientTimeout(total=20, connect=10, sock_read=10)
+        assert (await downloader.process(request=request)).body == b"x" * 500
+
+        with factory.settings as s:
+            # slowly sent response is not waited for
+            s.set(dict(CONN_TIMEOUT=0.2))
+            with pytest.raises(asyncio.TimeoutError):
+                await downloader.process(request=request)
+            s.set(dict(CONN_TIMEOUT=None, CONN_READ_TIMEOUT=0.05))
+            with pytest.raises(asyncio.TimeoutError):
+                await downloader.process(request=request)
+
+            # spider timeout takes precedence
+            spider.request = lambda: dict(timeout=aiohttp.ClientTimeout(total=10))
+            assert (await downloader.process(request=request)).body == b"x" * 500
+
+        await controller.session.close()
+
+
+@pytest.mark.asyncio
+async def test_downloader_process_rejected(factory: Factory, server):
+    async def handler(request):
+        return web.Response(body=b"x" * 1000, content_type=request.query.get("type", "text/html"))
+
+    async def chunked(request):
+        response = web.StreamResponse(headers={"Content-Type": "text/html"})
+        await response.prepare(request)
+        for _ in range(10):
+            await response.write(b"x" * 100)
+        return response
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    app.router.add_get("/chunked/", chunked)
+    async with server(app=app, port=8888):
+        spider = factory.obj.spider.create()
+        controller = Controller(spider=spider)
+        controller.session = aiohttp.ClientSession()
+        downloader = Downloader(controller=controller)
+
+        response = await downloader.process(request=Request(url="http://127.0.0.1:8888/?type=application/pdf"))
+        assert response.body == b"x" * 1000
+
+        with factory.settings as s:
+            s.set(dict(CONN_MAX_BODY_SIZE=999, CONN_CONTENT_TYPES=("text/html",)))
+            with pytest.raises(ResponseRejectedException) as e:
+                await downloader.process(request=Request(url="http://127.0.0.1:8888/?type=application/pdf"))
+            assert "Content type application/pdf" in str(e.value)
+            with pytest.raises(ResponseRejectedException) as e:
+                await downloader.process(request=Request(url="http://127.0.0.1:8888/"))
+            assert "Content length 1000" in str(e.value)
+            with pytest.raises(ResponseRejectedException) as e:
+                await downloader.process(request=Request(url="http://127.0.0.1:8888/chunked/"))
+            assert "over 999 bytes" in str(e.value)
+
+            # spider limits take precedence
+            spider.max_body_size = 1000
+            spider.content_types = ("text/html", "application/pdf")
+            response = await downloader.process(request=Request(url="http://127.0.0.1:8888/?type=application/pdf"))
+            assert response.body == b"x" * 1000
+            response = await downloader.process(request=Request(url="http://127.0.0.1:8888/chunked/"))
+            assert response.body == b"x" * 1000 and response.max_body_size == 1000
+
+            # streamed body is limited while parsing
+            spider.max_body_size = 500
+            spider.stream = ("a",)
+            response = await downloader.process(request=Request(url="http://127.0.0.1:8888/chunked/"))
+            with pytest.raises(ResponseRejectedException):
+                [e async for e in response.iterparse(tag="a", size=100)]
+            response.release()
 
         await controller.session.close()
 
@@ -76,6 +335,105 @@ def test_response():
     assert response.text == "<html></html>"
 
 
+class Chunks:
+    def __init__(self, *chunks):
+        self.chunks = chunks
+
+    async def iter_chunked(self, size):
+        for chunk in self.chunks:
+            yield chunk
+
+
+@pytest.mark.asyncio
+async def test_response_iterparse():
+    chunks = [b"<html><body><div><a href='/a'>a</a><a hr", b"ef='/b'>b</a></div><p>", "č</p></body>".encode("cp1250")]
+    response = Response(
+        url="url", version="1.1", status=200, reason="OK", headers=dict(), text=None, content=Chunks(*chunks),
+        encoding="cp1250",
+    )
+    elements = []
+    async for element in response.iterparse(tag=("a", "p")):
+        elements.append((element.tag, element.get("href"), element.text, len(element.getparent())))
+    assert elements == [("a", "/a", "a", 1), ("a", "/b", "b", 2), ("p", None, "č", 2)]
+
+    response.content = Chunks()
+    assert [e async for e in response.iterparse()] == []
+
+    release = mock.Mock()
+    response = Response(url="url", version="1.1", status=200, reason="OK", headers=dict(), text="", release=release)
+    response.release()
+    response.release()
+    assert release.call_count == 1
+
+
+def test_response_text():
+    body = "<p>čšž</p>".encode("cp1250")
+    response = Response(url="url", version="1.1", status=200, reason="OK", headers=dict(), body=body, encoding="cp1250")
+    assert response._text is None
+    assert response.body is body
+    assert response.text == "<p>čšž</p>"
+    assert response.text is response.text
+
+    response = Response(url="url", version="1.1", status=200, reason="OK", headers=dict(), body="<p>č</p>".encode())
+    assert response.text == "<p>č</p>"
+    assert response.charset == "utf-8"
+    assert response.encoding is None
+
+    # encoding not in headers is detected
+    body = "<meta charset='windows-1252'><p>café – naïve</p>".encode("cp1252")
+    response = Response(url="url", version="1.1", status=200, reason="OK", headers=dict(), body=body)
+    assert response.text == "<meta charset='windows-1252'><p>café – naïve</p>"
+    assert response.charset == "cp1252"
+
+    response = Response(url="url", version="1.1", status=200, reason="OK", headers=dict(), body=b"\x81<p>a</p>")
+    with mock.patch("okami.utils.detect_encoding", return_value="cp1252"):
+        assert response.text == "\ufffd<p>a</p>"
+    response.text = "text"
+    assert response.text == "text"
+
+    response = Response(url="url", version="1.1", status=200, reason="OK", headers=dict())
+    assert response.text is None
+
+
+def test_response_document_body():
+    body = "<p>čšž</p>".encode("cp1250")
+    response = Response(
+        url="url", version="1.1", status=200, reason="OK", headers=dict(), body=memoryview(body), encoding="cp1250"
+    )
+    assert response.xpath("//p/text()") == ["čšž"]
+    assert response._text is None
+
+    response = Response(url="url", version="1.1", status=200, reason="OK", headers=dict(), body="<p>č</p>".encode())
+    assert response.xpath("//p/text()") == ["č"]
+    assert response._text is None
+
+    # charset declared only in meta tag
+    body = (
+        "<html><head><meta http-equiv='Content-Type' content='text/html; charset=windows-1252'></head>"
+        "<body><p>café – naïve</p></body></html>"
+    ).encode("cp1252")
+    response = Response(url="url", version="1.1", status=200, reason="OK", headers=dict(), body=body)
+    assert response.xpath("//p/text()") == ["café – naïve"]
+    assert response._text is None
+
+    response = Response(url="url", version="1.1", status=200, reason="OK", headers=dict(), body=body)
+    response.text = "<p>text</p>"
+    assert response.xpath("//p/text()") == ["text"]
+
+
+def test_response_document():
+    response = Response(
+        url="url", version="version", status=200, reason="reason", headers=dict(), text="<p><a href='/a'>a</a></p>"
+    )
+    with mock.patch("lxml.html.document_fromstring", wraps=lxml.html.document_fromstring) as m:
+        document = response.document
+        assert response.document is document
+        assert response.xpath("//a/@href") == ["/a"]
+        assert response.xpath("//a[@href=$href]/text()", href="/a") == ["a"]
+        assert m.call_count == 1
+        assert m.call_args == mock.call(html="<p><a href='/a'>a</a></p>")
+
+
 def test_result():
     task = Task(url="url")
     tasks = {Task(url="url1"), Task(url="url2"), Task(url="url3")}
@@ -120,6 +478,56 @@ def test_state_to_dict():
     )
 
 
+def test_key_cache___init__(factory: Factory):
+    controller = Controller(spider=factory.obj.spider.create())
+    key_cache = KeyCache(controller=controller, size=10)
+    assert key_cache.controller is controller
+    assert key_cache.size == 10
+    assert key_cache.keys == dict()
+    assert controller.stats.get("key_cache/hits") == 0
+    assert controller.stats.get("key_cache/misses") == 0
+
+
+@pytest.mark.asyncio
+async def test_key_cache_get(factory: Factory, coro):
+    controller = Controller(spider=factory.obj.spider.create())
+    controller.spider.hash = mock.Mock(side_effect=coro(mock.Mock(side_effect=lambda task, response: None)))
+    key_cache = KeyCache(controller=controller, size=2)
+    t1, t2, t3 = Task(url="url1"), Task(url="url2"), Task(url="url3")
+
+    assert await key_cache.get(task=t1, response=None) == hashlib.sha1(b"url1").hexdigest()
+    assert await key_cache.get(task=t1, response=None) == hashlib.sha1(b"url1").hexdigest()
+    assert controller.spider.hash.call_count == 1
+    assert controller.stats.get("key_cache/hits") == 1
+    assert controller.stats.get("key_cache/misses") == 1
+
+    await key_cache.get(task=t2, response=None)
+    await key_cache.get(task=t1, response=None)
+    await key_cache.get(task=t3, response=None)
+    assert list(key_cache.keys) == [t1, t3]
+    assert controller.stats.get("key_cache/hits") == 2
+    assert controller.stats.get("key_cache/misses") == 3
+
+    controller.spider.hash = mock.Mock(side_effect=coro(mock.Mock(return_value="key")))
+    key_cache = KeyCache(controller=controller, size=0)
+    assert await key_cache.get(task=t1, response=None) == "key"
+    assert await key_cache.get(task=t1, response=None) == "key"
+    assert controller.spider.hash.call_count == 2
+    assert key_cache.keys == dict()
+
+    # keys are computed from tasks as they are unless canonicalisation is enabled
+    controller.spider.hash = mock.Mock(side_effect=coro(mock.Mock(return_value=None)))
+    key = await key_cache.get(task=Task(url="HTTP://X/a?b=1&a=2#top"), response=None)
+    assert key == hashlib.sha1(b"HTTP://X/a?b=1&a=2#top").hexdigest()
+    assert controller.spider.hash.call_args[1]["task"] == Task(url="HTTP://X/a?b=1&a=2#top")
+
+    with factory.settings as s:
+        s.set(dict(CANONICAL_ENABLED=True))
+        key = await key_cache.get(task=Task(url="HTTP://X/a?b=1&a=2#top"), response=None)
+        assert key == hashlib.sha1(b"http://x/a?a=2&b=1").hexdigest()
+        assert controller.spider.hash.call_args[1]["task"] == Task(url="http://x/a?a=2&b=1")
+
+
 def test_stats___init__():
     controller = object()
     stats = Stats(controller=controller)
@@ -131,13 +539,127 @@ def test_stats_collect():
     controller = mock.Mock(
         storage=mock.Mock(to_dict=lambda: dict(a=1, b=2)),
         throttle=mock.Mock(to_dict=lambda: dict(a=11, b=22)),
+        connections=mock.Mock(to_dict=lambda: dict(a=111)),
+        resolver=mock.Mock(to_dict=lambda: dict(a=1111)),
     )
     controller.xxxx()
     stats = Stats(controller=controller)
-    assert stats.collect() == {"storage/a": 1, "storage/b": 2, "throttle/a": 11, "throttle/b": 22}
+    data = {"storage/a": 1, "storage/b": 2, "throttle/a": 11, "throttle/b": 22, "connector/a": 111, "resolver/a": 1111}
+    assert stats.collect() == data
     stats.set("key", 123)
-    assert stats.collect() == {"storage/a": 1, "storage/b": 2, "throttle/a": 11, "throttle/b": 22, "key": 123}
-    assert stats.data == {"storage/a": 1, "storage/b": 2, "throttle/a": 11, "throttle/b": 22, "key": 123}
+    assert stats.collect() == dict(data, key=123)
+    assert stats.data == dict(data, key=123)
+
+
+@pytest.mark.asyncio
+async def test_connections(server):
+    async def handler(request):
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    connections = Connections()
+    assert connections.to_dict() == dict(
+        open=None,
+        acquired=None,
+        created=0,
+        reused=0,
+        queued=0,
+        reuse_ratio=0.0,
+        dns_hits=0,
+        dns_misses=0,
+        dns_hit_ratio=0.0,
+    )
+    async with server(app=app, port=8888):
+        connector = aiohttp.TCPConnector(limit=1)
+        connections.connector = connector
+        async with aiohttp.ClientSession(connector=connector, trace_configs=[connections.trace]) as session:
+            for _ in range(3):
+                async with session.get("http://localhost:8888/") as response:
+                    await response.read()
+            assert connections.pool() == (0, 1)
+            data = connections.to_dict()
+            assert data["open"] == 1
+            assert data["acquired"] == 0
+            assert data["created"] == 1
+            assert data["reused"] == 2
+            assert data["reuse_ratio"] == 2 / 3
+            assert data["dns_misses"] == 1
+            assert data["dns_hits"] == 0
+
+    # pool is read from private attributes of connector
+    connector = aiohttp.TCPConnector()
+    assert isinstance(connector._acquired, set)
+    assert isinstance(connector._conns, dict)
+    await connector.close()
+
+    connections.connector = object()
+    with mock.patch("okami.api.log") as log:
+        assert connections.to_dict()["open"] is None
+        assert connections.pool() == (None, None)
+    assert log.warning.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_resolver():
+    lookups = []
+
+    async def resolve(host, port, family):
+        lookups.append(host)
+        await asyncio.sleep(0.01)
+        if host == "fail":
+            raise OSError("fail")
+        return [dict(hostname=host, host="1.2.3.4", port=port, family=family, proto=0, flags=0)]
+
+    resolver = Resolver(ttl=None, max_concurrent=1)
+    resolver.resolver = mock.Mock(resolve=resolve)
+    resolver.prefetch(host="a.com")
+    resolver.prefetch(host="a.com")
+    resolver.prefetch(host="127.0.0.1")
+    resolver.prefetch(host=None)
+    assert resolver.prefetched == 1
+    assert list(resolver.pending) == [("a.com", 0)]
+
+    # pending lookup is awaited, addresses are cached
+    addresses = await resolver.resolve(host="a.com", port=80)
+    assert addresses == [dict(hostname="a.com", host="1.2.3.4", port=80, family=0, proto=0, flags=0)]
+    assert (await resolver.resolve(host="a.com", port=443))[0]["port"] == 443
+    assert resolver.hits == 2
+    assert resolver.misses == 0
+    assert resolver.pending == dict()
+    resolver.prefetch(host="a.com")
+    assert resolver.prefetched == 1
+
+    # lookups are limited
+    resolver.prefetch(host="b.com")
+    resolver.prefetch(host="c.com")
+    assert resolver.semaphore.locked() is False
+    await asyncio.sleep(0)
+    assert resolver.semaphore.locked() is True
+    assert (await resolver.resolve(host="d.com"))[0]["hostname"] == "d.com"
+    assert lookups == ["a.com", "b.com", "c.com", "d.com"]
+    assert resolver.misses == 1
+
+    resolver.prefetch(host="fail")
+    await asyncio.sleep(0.02)
+    assert resolver.failed == 1
+    with pytest.raises(OSError):
+        await resolver.resolve(host="fail")
+
+    assert resolver.to_dict() == dict(
+        cached=4, pending=0, hits=2, misses=2, hit_ratio=0.5, prefetched=4, failed=1
+    )
+
+    # cache expires
+    resolver.ttl = 10
+    resolver.cache[("a.com", 0)] = (0, resolver.cache[("a.com", 0)][1])
+    assert resolver.cached(key=("a.com", 0)) is None
+    assert ("a.com", 0) not in resolver.cache
+
+    resolver.prefetch(host="e.com")
+    await resolver.close()
+    assert resolver.pending == dict()
+    assert ("e.com", 0) not in resolver.cache
 
 
 def test_stats_get():
@@ -240,6 +762,20 @@ def test_task___ne__():
     assert Task(url=None, data=None) != Obj(url=None, data=None)
 
 
+def test_task_canonical(factory: Factory):
+    task = Task(url="HTTP://X:80/a?utm_source=y&b=1#top", data=1)
+    assert task.canonical() is task
+
+    with factory.settings as s:
+        s.set(dict(CANONICAL_ENABLED=True))
+        task = Task(url="http://x/a?b=1")
+        assert task.canonical() is task
+        assert Task(url="HTTP://X:80/a?utm_source=y&b=1#top", data=1).canonical() == Task(url="http://x/a?b=1", data=1)
+
+        s.set(dict(CANONICAL_DROP_FRAGMENT=False))
+        assert Task(url="http://x/a#top").canonical() == Task(url="http://x/a#top")
+
+
 def test_task_from_dict():
     args = dict(url="url", data=dict(t1=1, t2=2))
     task = Task.from_dict(args)
@@ -339,7 +875,196 @@ def test_throttle_calculate(freezer):
 
 def test_throttle_to_dict():
     throttle = Throttle()
-    assert throttle.to_dict() == dict(iterations=0, sleep=0.0001, delta=0.0001, time=0.0001 * 2, rps=0)
+    assert throttle.to_dict() == dict(
+        iterations=0, sleep=0.0001, delta=0.0001, time=0.0001 * 2, rps=0, hosts=0, hosts_open=0, opened=0
+    )
 
     throttle = Throttle(sleep=1.23, max_rps=123, fn=lambda x: x.sleep + 100)
-    assert throttle.to_dict() == dict(iterations=0, sleep=1.23, delta=1.23, time=1.23 * 2, rps=0)
+    assert throttle.to_dict() == dict(
+        iterations=0, sleep=1.23, delta=1.23, time=1.23 * 2, rps=0, hosts=0, hosts_open=0, opened=0
+    )
+
+    throttle.bucket(url="http://a.com/")
+    throttle.bucket(url="http://b.com/").failure()
+    assert throttle.to_dict()["hosts"] == 2
+
+    throttle = Throttle(host_max_failures=1)
+    throttle.bucket(url="http://a.com/")
+    throttle.bucket(url="http://b.com/").failure()
+    assert throttle.to_dict()["hosts_open"] == 1
+    assert throttle.to_dict()["opened"] == 1
+
+
+@pytest.mark.parametrize(
+    "url,host", [
+        ("http://example.com/a/", "example.com"),
+        ("https://www.example.com/a/?b=1", "example.com"),
+        ("http://cdn.example.com:8080/a/", "cdn.example.com:8080"),
+        ("//cdn.example.com/a/", ""),
+    ]
+)
+def test_throttle_host(url, host):
+    assert Throttle.host(url=url) == host
+
+
+def test_throttle_bucket():
+    throttle = Throttle(host_max_rps=2, host_max_concurrent=3, hosts={"b.com": dict(max_rps=5)})
+    bucket = throttle.bucket(url="http://a.com/1/")
+    assert bucket is throttle.bucket(url="http://a.com/2/")
+    assert bucket.max_rps == 2.0
+    assert bucket.max_concurrent == 3
+    assert bucket.max_failures == 5
+    assert bucket.recovery == 30.0
+
+    bucket = throttle.bucket(url="http://b.com/1/")
+    assert bucket is not throttle.bucket(url="http://a.com/1/")
+    assert bucket.max_rps == 5.0
+    assert bucket.max_concurrent == 3
+    assert set(throttle.buckets) == {"a.com", "b.com"}
+
+
+@pytest.mark.freeze_time("2016-12-23 00:00:00")
+def test_throttle_delay():
+    throttle = Throttle()
+    assert throttle.delay(url="http://a.com/") == 0.0
+    assert throttle.delay(url="http://a.com/") == 0.0
+
+    throttle = Throttle(host_max_rps=4)
+    assert throttle.delay(url="http://a.com/") == 0.0
+    assert throttle.delay(url="http://a.com/") == 0.25
+    assert throttle.delay(url="http://b.com/") == 0.0
+    assert throttle.delay(url="http://a.com/") == 0.25
+
+
+def test_throttle_update():
+    throttle = Throttle(host_max_failures=2)
+    assert throttle.update(url="http://a.com/", status=200, latency=1.0) is None
+    throttle.update(url="http://a.com/", status=constants.status.RETRIAL, latency=1.0)
+    throttle.update(url="http://a.com/", status=404, latency=1.0)
+    throttle.update(url="http://a.com/", status=constants.status.RETRIAL, latency=1.0)
+    assert throttle.bucket(url="http://a.com/").circuit == Bucket.CLOSED
+    throttle.update(url="http://a.com/", status=constants.status.RETRIAL, latency=1.0)
+    assert throttle.bucket(url="http://a.com/").circuit == Bucket.OPEN
+    assert throttle.bucket(url="http://b.com/").circuit == Bucket.CLOSED
+
+
+def test_adaptive_throttle___init__():
+    throttle = AdaptiveThrottle(host_max_rps=10, max_rps=5)
+    assert throttle.window == 10
+    assert throttle.start_rps == 1.0
+    assert throttle.min_rps == 0.1
+    assert throttle.increase == 1.0
+    assert throttle.decrease == 0.5
+    assert throttle.max_latency is None
+    assert throttle.latency_factor == 3.0
+    assert throttle.windows == dict()
+    assert throttle.state.max_rps == 5
+    assert throttle.host_settings["max_rps"] == 10
+
+
+def test_adaptive_throttle_bucket(factory: Factory):
+    throttle = AdaptiveThrottle(start_rps=4, host_max_rps=2, hosts={"b.com": dict(max_rps=10, max_concurrent=3)})
+    bucket = throttle.bucket(url="http://a.com/")
+    assert bucket is throttle.bucket(url="http://a.com/1/")
+    assert bucket.max_rps == 2.0
+    assert bucket.max_concurrent == 1
+    assert throttle.windows["a.com"].max_rps == 2
+    assert throttle.windows["a.com"].max_concurrent == settings.CONN_MAX_CONCURRENT_REQUESTS
+
+    bucket = throttle.bucket(url="http://b.com/")
+    assert bucket.max_rps == 4.0
+    assert throttle.windows["b.com"].max_rps == 10
+    assert throttle.windows["b.com"].max_concurrent == 3
+
+
+def test_adaptive_throttle_update():
+    throttle = AdaptiveThrottle(window=2, start_rps=2, host_max_rps=20, host_max_concurrent=5)
+    url = "http://a.com/"
+    bucket = throttle.bucket(url=url)
+
+    # slow start
+    for rps, concurrent in [(4.0, 2), (8.0, 4), (16.0, 5), (20.0, 5)]:
+        throttle.update(url=url, status=200, latency=0.1)
+        throttle.update(url=url, status=200, latency=0.1)
+        assert (bucket.max_rps, bucket.max_concurrent) == (rps, concurrent)
+
+    # errors
+    throttle.update(url=url, status=constants.status.HTTP_429, latency=0.1)
+    assert (bucket.max_rps, bucket.max_concurrent) == (20.0, 5)
+    throttle.update(url=url, status=200, latency=0.1)
+    assert (bucket.max_rps, bucket.max_concurrent) == (10.0, 2)
+
+    # additive increase
+    throttle.update(url=url, status=200, latency=0.1)
+    throttle.update(url=url, status=200, latency=0.1)
+    assert (bucket.max_rps, bucket.max_concurrent) == (11.0, 3)
+
+    # latency
+    throttle.update(url=url, status=200, latency=1.0)
+    throttle.update(url=url, status=200, latency=1.0)
+    assert (bucket.max_rps, bucket.max_concurrent) == (5.5, 1)
+
+    for status in [constants.status.RETRIAL, constants.status.HTTP_500, constants.status.HTTP_503]:
+        throttle.update(url=url, status=status, latency=1.0)
+        throttle.update(url=url, status=200, latency=1.0)
+    assert (bucket.max_rps, bucket.max_concurrent) == (0.6875, 1)
+    assert throttle.windows["a.com"].decreased == 5
+    assert throttle.windows["a.com"].increased == 5
+
+    throttle = AdaptiveThrottle(window=1, max_latency=0.5)
+    bucket = throttle.bucket(url=url)
+    throttle.update(url=url, status=200, latency=0.4)
+    assert bucket.max_rps == 2.0
+    throttle.update(url=url, status=200, latency=0.6)
+    assert bucket.max_rps == 1.0
+
+
+def test_adaptive_throttle_to_dict():
+    throttle = AdaptiveThrottle(window=2)
+    assert throttle.to_dict() == dict(
+        iterations=0,
+        sleep=0.0001,
+        delta=0.0001,
+        time=0.0001 * 2,
+        rps=0,
+        hosts=0,
+        hosts_open=0,
+        opened=0,
+        window_latency=0.0,
+        window_errors=0,
+        host_rps=0,
+        host_concurrent=0,
+        increased=0,
+        decreased=0,
+    )
+    throttle.update(url="http://a.com/", status=500, latency=1.0)
+    throttle.update(url="http://b.com/", status=200, latency=2.0)
+    data = throttle.to_dict()
+    assert data["hosts"] == 2
+    assert data["window_latency"] == 1.5
+    assert data["window_errors"] == 1
+    assert data["host_rps"] == 2.0
+    assert data["host_concurrent"] == 2
+
+
+def test_window():
+    window = Window(size=2, max_rps=1, max_concurrent=2)
+    assert window.max_rps == 1
+    assert window.max_concurrent == 2
+    assert window.latency == 0.0
+    assert window.errors == 0
+    assert window.count == 0
+
+    window.add(latency=1.0, error=False)
+    window.add(latency=2.0, error=True)
+    window.add(latency=3.0, error=False)
+    assert window.latency == 2.5
+    assert window.errors == 1
+    assert window.count == 3
+
+    window.adjust()
+    assert window.count_adjusted == 3
+    assert window.latency_baseline == 2.5
+    window.add(latency=5.5, error=False)
+    window.adjust(alpha=0.5)
+    assert window.latency_baseline == 3.375
@@ -0,0 +1,187 @@
+import os
+
+import aiohttp
+import pytest
+import yarl
+from aiohttp import web
+
+from okami import Request, Response
+from okami.cache import CacheDownloader, ResponseCache
+from okami.engine import Controller
+from okami.exceptions import CacheMissException
+from tests.factory import Factory
+
+
+def create_response(url, body):
+    return Response(
+        url=yarl.URL(url),
+        version=aiohttp.HttpVersion(1, 1),
+        status=200,
+        reason="OK",
+        headers={"Content-Type": "text/html"},
+        body=body,
+        encoding="utf-8",
+    )
+
+
+def test_response_cache(tmpdir):
+    filename = os.path.join(str(tmpdir), "cache.sqlite")
+    cache = ResponseCache(filename=filename)
+    key = cache.fingerprint(method="get", url="http://localhost/")
+    assert key == cache.fingerprint(method="GET", url="http://localhost/")
+    assert key != cache.fingerprint(method="POST", url="http://localhost/")
+    assert cache.get(key) is None
+
+    cache.set(key=key, response=create_response(url="http://localhost/", body=b"<html>a</html>" * 100))
+    assert len(cache) == 1
+    assert 0 < cache.size < 1400
+
+    response = cache.get(key)
+    assert response.url == yarl.URL("http://localhost/")
+    assert response.version == aiohttp.HttpVersion(1, 1)
+    assert response.status == 200
+    assert response.reason == "OK"
+    assert response.headers["content-type"] == "text/html"
+    assert response.body == b"<html>a</html>" * 100
+    assert response.text == "<html>a</html>" * 100
+
+    # replaced response keeps size
+    size = cache.size
+    cache.set(key=key, response=create_response(url="http://localhost/", body=b"<html>a</html>" * 100))
+    assert cache.size == size
+    cache.close()
+
+    cache = ResponseCache(filename=filename)
+    assert len(cache) == 1
+    assert cache.size == size
+    cache.close()
+
+    with pytest.raises(ValueError):
+        ResponseCache(filename=filename, eviction="other")
+
+
+@pytest.mark.parametrize("eviction,evicted", [("lru", "http://localhost/1/"), ("fifo", "http://localhost/0/")])
+def test_response_cache_evict(tmpdir, eviction, evicted):
+    cache = ResponseCache(filename=os.path.join(str(tmpdir), "cache.sqlite"), eviction=eviction)
+    keys = [cache.fingerprint(method="GET", url="http://localhost/{}/".format(i)) for i in range(3)]
+    cache.set(key=keys[0], response=create_response(url="http://localhost/0/", body=b"0"))
+    cache.set(key=keys[1], response=create_response(url="http://localhost/1/", body=b"1"))
+    cache.get(keys[0])
+    cache.max_size = cache.size
+    cache.set(key=keys[2], response=create_response(url="http://localhost/2/", body=b"2"))
+    assert len(cache) == 2
+    assert cache.evicted == 1
+    assert cache.size <= cache.max_size
+    assert cache.get(cache.fingerprint(method="GET", url=evicted)) is None
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_cache_downloader_initialise(factory: Factory, tmpdir):
+    controller = Controller(spider=factory.obj.spider.create())
+    downloader = CacheDownloader(controller=controller)
+    downloader.initialise()
+    assert downloader.cache is None
+    downloader.finalise()
+
+    with factory.settings as s:
+        s.set(dict(CACHE_MODE="record", CACHE_PATH=str(tmpdir)))
+        downloader.initialise()
+        assert downloader.mode == "record"
+        assert downloader.cache.filename == os.path.join(
+            str(tmpdir), "{}.cache.sqlite".format(controller.spider.name)
+        )
+        assert controller.stats.get(downloader.key_hits) == 0
+        downloader.finalise()
+        assert downloader.cache is None
+
+        s.set(dict(CACHE_MODE="other"))
+        with pytest.raises(ValueError):
+            downloader.initialise()
+
+
+@pytest.mark.asyncio
+async def test_cache_downloader_process(factory: Factory, server, tmpdir):
+    requests = []
+
+    async def handler(request):
+        requests.append(request.path)
+        return web.Response(text="<html>{}</html>".format(len(requests)), content_type="text/html")
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    async with server(app=app, port=8888):
+        controller = Controller(spider=factory.obj.spider.create())
+        controller.session = aiohttp.ClientSession()
+        downloader = CacheDownloader(controller=controller)
+        request = Request(url="http://127.0.0.1:8888/")
+
+        with factory.settings as s:
+            s.set(dict(CACHE_MODE="replay", CACHE_PATH=str(tmpdir)))
+            downloader.initialise()
+            with pytest.raises(CacheMissException):
+                await downloader.process(request=request)
+            assert requests == []
+            assert controller.stats.get(downloader.key_misses) == 1
+            downloader.finalise()
+
+            s.set(dict(CACHE_MODE="record"))
+            downloader.initialise()
+            assert (await downloader.process(request=request)).text == "<html>1</html>"
+            assert (await downloader.process(request=request)).text == "<html>1</html>"
+            assert len(requests) == 1
+            assert controller.stats.get(downloader.key_hits) == 1
+            downloader.finalise()
+
+            s.set(dict(CACHE_MODE="refresh"))
+            downloader.initialise()
+            assert (await downloader.process(request=request)).text == "<html>2</html>"
+            assert len(requests) == 2
+            downloader.finalise()
+
+            s.set(dict(CACHE_MODE="replay"))
+            downloader.initialise()
+            response = await downloader.process(request=request)
+            assert response.text == "<html>2</html>"
+            assert response.status == 200
+            assert response.encoding == "utf-8"
+            assert response.request_url == request.url
+            assert len(requests) == 2
+            downloader.finalise()
+
+        await controller.session.close()
+
+
+@pytest.mark.parametrize("status", [304, 404, 429, 500, 503])
+@pytest.mark.asyncio
+async def test_cache_downloader_process_not_cached(factory: Factory, server, tmpdir, status):
+    requests = []
+
+    async def handler(request):
+        requests.append(request.path)
+        if len(requests) == 1:
+            return web.Response(status=status)
+        return web.Response(text="<html>ok</html>", content_type="text/html")
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    async with server(app=app, port=8888):
+        controller = Controller(spider=factory.obj.spider.create())
+        controller.session = aiohttp.ClientSession()
+        downloader = CacheDownloader(controller=controller)
+        request = Request(url="http://127.0.0.1:8888/")
+
+        with factory.settings as s:
+            s.set(dict(CACHE_MODE="record", CACHE_PATH=str(tmpdir)))
+            downloader.initialise()
+            assert (await downloader.process(request=request)).status == status
+            assert len(downloader.cache) == 0
+            assert (await downloader.process(request=request)).text == "<html>ok</html>"
+            assert (await downloader.process(request=request)).text == "<html>ok</html>"
+            assert len(requests) == 2
+            assert len(downloader.cache) == 1
+            assert controller.stats.get(downloader.key_misses) == 2
+            assert controller.stats.get(downloader.key_hits) == 1
+            downloader.finalise()
+
+        await controller.session.close()
@@ -86,6 +86,29 @@ def test_example(m1, m2):
         assert "for \"process\": invalid choice: {}. (choose from server, spider)".format(c) in result.output, c
 
 
+@mock.patch("okami.cli.benchmarks.run", return_value=[("size=1", 100.0, "/s"), ("size=10", 1000.0, "/s")])
+def test_benchmark(m1):
+    runner = CliRunner()
+    result = runner.invoke(cli.benchmark, ["scheduler"])
+    assert result.exit_code == 0
+    assert "Benchmark: scheduler" in result.output
+    assert "size=1" in result.output
+    assert "1000.00/s" in result.output
+    assert m1.call_args == mock.call(name="scheduler", address="127.0.0.1:8000", multiplier=4, sizes=())
+
+    for o in ["--size", "-s"]:
+        result = runner.invoke(cli.benchmark, ["scheduler", o, 5])
+        assert result.exit_code == 0, o
+        assert m1.call_args == mock.call(name="scheduler", address="127.0.0.1:8000", multiplier=4, sizes=(5,)), o
+
+    result = runner.invoke(cli.benchmark)
+    assert result.exit_code == 2
+
+    for c in ["non-existent", "non_existent"]:
+        result = runner.invoke(cli.benchmark, [c])
+        assert result.exit_code == 2, c
+
+
 def test_list(factory: Factory):
     runner = CliRunner()
 
@@ -1,11 +1,12 @@
 import asyncio
+from collections import deque
 from unittest import mock
 
 import aiohttp
 import pytest
 
 from okami import constants, exceptions, settings
-from okami.api import Downloader, Request, Response, Result, Task, Throttle
+from okami.api import Bucket, Downloader, Request, Response, Result, Task, Throttle
 from okami.engine import (
     Controller,
     HttpMiddleware,
@@ -19,8 +20,12 @@ from okami.engine import (
     SpiderMiddleware,
     StartupPipeline,
     TasksPipeline,
+    Watchdog,
+    process_spider,
 )
-from okami.exceptions import NoSuchSpiderException
+from okami.example import Example
+from okami.exceptions import NoSuchSpiderException, ResponseRejectedException
+from okami.storage import Storage
 from tests.factory import Factory
 
 
@@ -95,6 +100,7 @@ def test_controller___init__(factory: Factory):
     assert isinstance(controller.manager, Manager)
     assert controller.manager.name == spider.name
     assert controller.manager.storage is controller.storage
+    assert controller.manager.throttle is controller.throttle
 
     with factory.settings as s:
         s.set(dict(DEBUG=True, ASYNC_SLOW_CALLBACK_DURATION=0.5))
@@ -106,19 +112,25 @@ def test_controller___init__(factory: Factory):
 @pytest.mark.asyncio
 async def test_controller_initialise(factory: Factory, coro):
     spider = factory.obj.spider.create()
+    spider.urls = dict(spider.urls, start=["http://X.com/?utm_source=y"])
     controller = Controller(spider=spider)
     controller.pipeline.initialise = mock.Mock(side_effect=coro(mock.Mock()))
     controller.pipeline.startup.process = mock.Mock(side_effect=coro(mock.Mock(return_value=spider)))
     controller.middleware.initialise = mock.Mock(side_effect=coro(mock.Mock()))
-    controller.manager.event.clear = mock.Mock()
     controller.manager.storage.add_tasks_queued = mock.Mock()
-    await controller.initialise()
+    controller.storage.initialise = mock.Mock()
+    controller.downloader.initialise = mock.Mock()
+    with factory.settings as s:
+        s.set(dict(CANONICAL_ENABLED=True))
+        await controller.initialise()
+    assert controller.storage.initialise.call_count == 1
+    assert controller.downloader.initialise.call_count == 1
     assert controller.pipeline.initialise.call_count == 1
     assert controller.pipeline.startup.process.call_count == 1
     assert controller.pipeline.startup.process.call_args == mock.call(spider=spider)
     assert controller.middleware.initialise.call_count == 1
-    assert controller.manager.event.clear.call_count == 1
     assert controller.manager.storage.add_tasks_queued.call_count == 1
+    assert controller.manager.storage.add_tasks_queued.call_args == mock.call({Task(url="http://x.com/")})
 
 
 @pytest.mark.asyncio
@@ -142,28 +154,116 @@ async def test_controller_start(factory: Factory, coro):
 async def test_controller_run(factory: Factory, coro):
     spider = factory.obj.spider.create()
     controller = Controller(spider=spider)
-    controller.process = mock.Mock(side_effect=coro(mock.Mock()))
-    manager = mock.Mock(side_effect=coro(mock.Mock()))
-    manager.__class__.running = mock.PropertyMock(side_effect=[True, False])
-    controller.manager = manager
-    controller.manager.scheduled = mock.Mock(side_effect=coro(mock.Mock(return_value=[object()])))
+    controller.worker = mock.Mock(side_effect=coro(mock.Mock()))
     controller.manager.storage.set_info_time_started = mock.Mock()
-    controller.manager.event.is_set = mock.Mock(return_value=False)
-    controller.manager.event.wait = mock.Mock(side_effect=coro(mock.Mock()))
     await controller.run()
-    assert controller.process.call_count == 1
+    assert controller.worker.call_count == settings.CONN_MAX_CONCURRENT_REQUESTS
     assert controller.manager.storage.set_info_time_started.call_count == 1
-    assert controller.manager.event.is_set.call_count == 1
-    assert controller.manager.event.wait.call_count == 1
 
-    controller.manager.reset_mock()
-    manager.__class__.running = mock.PropertyMock(side_effect=[True, False])
-    controller.manager.event.is_set = mock.Mock(return_value=True)
-    await controller.run()
+    controller.worker = mock.Mock(side_effect=coro(mock.Mock(side_effect=[None, ValueError("error")] * 100)))
+    with pytest.raises(ValueError):
+        await controller.run()
+    assert controller.worker.call_count == settings.CONN_MAX_CONCURRENT_REQUESTS
+
+
+@pytest.mark.asyncio
+async def test_controller_worker(factory: Factory, coro):
+    spider = factory.obj.spider.create()
+    controller = Controller(spider=spider)
+    tasks = [{Task(url="url1")}, set(), {Task(url="url2")}]
+    controller.process = mock.Mock(side_effect=coro(mock.Mock()))
+    controller.manager.scheduled = mock.Mock(side_effect=coro(mock.Mock(side_effect=tasks)))
+    controller.manager.wait = mock.Mock(side_effect=coro(mock.Mock()))
+    controller.manager.done = mock.Mock(side_effect=coro(mock.Mock()))
+    with mock.patch("okami.engine.Manager.running", new_callable=mock.PropertyMock) as running:
+        running.side_effect = [True, True, True, False]
+        await controller.worker()
+    assert controller.manager.scheduled.call_count == 3
     assert controller.process.call_count == 2
-    assert controller.manager.storage.set_info_time_started.call_count == 1
-    assert controller.manager.event.is_set.call_count == 1
-    assert controller.manager.event.wait.call_count == 0
+    assert controller.manager.wait.call_count == 1
+    assert controller.manager.done.call_count == 2
+    assert controller.manager.done.call_args == mock.call(tasks={Task(url="url2")})
+
+    controller.process = mock.Mock(side_effect=coro(mock.Mock(side_effect=exceptions.OkamiTerminationException)))
+    controller.manager.scheduled = mock.Mock(side_effect=coro(mock.Mock(side_effect=tasks)))
+    controller.manager.done = mock.Mock(side_effect=coro(mock.Mock()))
+    controller.manager.pending = 1
+    with pytest.raises(exceptions.OkamiTerminationException):
+        await controller.worker()
+    assert controller.manager.done.call_count == 1
+    assert controller.manager.terminate is True
+
+
+@pytest.mark.asyncio
+async def test_controller_run_concurrency(factory: Factory):
+    spider = factory.obj.spider.create()
+    controller = Controller(spider=spider)
+    controller.manager.storage.add_tasks_queued({Task(url="url{}".format(i)) for i in range(100)})
+    processing = []
+
+    async def process(task):
+        async with controller.manager.semaphore:
+            processing.append(settings.CONN_MAX_CONCURRENT_REQUESTS - controller.manager.semaphore._value)
+            await asyncio.sleep(0.001)
+            result = Result(status=constants.status.OK, task=task, tasks=set(), items=[])
+            await controller.manager.process(result=result)
+            return result
+
+    controller.process = process
+    await controller.run()
+    assert len(processing) == 100
+    assert max(processing) == settings.CONN_MAX_CONCURRENT_REQUESTS
+    assert controller.manager.pending == 0
+    assert controller.manager.running is False
+
+
+@pytest.mark.asyncio
+async def test_controller_run_dead_host(factory: Factory, coro):
+    spider = factory.obj.spider.create()
+    controller = Controller(spider=spider)
+    healthy = {Task(url="http://healthy.com/{}/".format(i)) for i in range(5)}
+    dead = {Task(url="http://dead.com/{}/".format(i)) for i in range(3)}
+    controller.manager.storage.add_tasks_queued(healthy | dead)
+
+    async def process(request):
+        if "dead.com" in request.url:
+            raise aiohttp.ClientConnectionError("Connection refused")
+        return Response(url=request.url, version="1.1", status=200, reason="OK", headers=dict(), text="<html/>")
+
+    async def spider_before(task, response):
+        return response
+
+    async def spider_after(task, response, tasks, items):
+        return tasks, items
+
+    controller.downloader.process = process
+    controller.middleware.http.before = mock.Mock(side_effect=coro(lambda request: request))
+    controller.middleware.http.after = mock.Mock(side_effect=coro(lambda response: response))
+    controller.middleware.spider.before = spider_before
+    controller.middleware.spider.after = spider_after
+    controller.spider.process = mock.Mock(side_effect=coro(mock.Mock(return_value=(set(), []))))
+    with factory.settings as s:
+        s.set(dict(PAUSE_TIMEOUT=0.001, CONN_MAX_RETRIES=2, THROTTLE_SETTINGS=dict()))
+        await controller.run()
+        await controller.finalise()
+
+    assert controller.manager.terminate is True
+    assert controller.spider.process.call_count == len(healthy)
+    assert controller.storage.get_tasks_failed() == dead
+    assert controller.storage.tasks_queued_is_empty() is True
+    assert controller.manager.retrials == set()
+
+    # without circuit breaker dead host terminates scraping
+    controller = Controller(spider=spider)
+    controller.throttle.host_settings["max_failures"] = None
+    controller.manager.storage.add_tasks_queued(dead)
+    controller.downloader.process = process
+    controller.middleware.http.before = mock.Mock(side_effect=coro(lambda request: request))
+    with factory.settings as s:
+        s.set(dict(PAUSE_TIMEOUT=0.001, CONN_MAX_RETRIES=2))
+        with pytest.raises(exceptions.OkamiTerminationException):
+            await controller.run()
+        await controller.finalise()
 
 
 @pytest.mark.parametrize("status", [200, 201, 301, 302])
@@ -211,7 +311,25 @@ async def test_controller_process(factory: Factory, coro, status):
     assert controller.pipeline.items.process.call_args == mock.call(items=items)
 
 
-@pytest.mark.parametrize("status", constants.HTTP_FAILED)
+@pytest.mark.asyncio
+async def test_controller_process_skipped(factory: Factory, coro):
+    controller = Controller(spider=factory.obj.spider.create())
+    release = mock.Mock()
+    response = Response(url="url", version="1.1", status=200, reason="OK", headers=dict(), text="", release=release)
+    controller.download = mock.Mock(side_effect=coro(mock.Mock(return_value=response)))
+    controller.middleware.spider.before = mock.Mock(side_effect=coro(mock.Mock(return_value=None)))
+    controller.spider.process = mock.Mock(side_effect=coro(mock.Mock()))
+    controller.middleware.spider.after = mock.Mock(side_effect=coro(mock.Mock()))
+
+    result = await controller.process(task=Task(url="url"))
+    assert result.status == constants.status.OK
+    assert result.tasks == set()
+    assert controller.spider.process.call_count == 0
+    assert controller.middleware.spider.after.call_count == 0
+    assert release.call_count == 1
+
+
+@pytest.mark.parametrize("status", sorted(constants.HTTP_FAILED | {constants.status.HTTP_304}))
 @pytest.mark.asyncio
 async def test_controller_process_http_failed(factory: Factory, coro, status):
     spider = factory.obj.spider.create()
@@ -247,7 +365,13 @@ async def test_controller_process_http_failed(factory: Factory, coro, status):
 
 
 @pytest.mark.parametrize(
-    "exception,status", [(aiohttp.ClientError, constants.status.RETRIAL), (Exception, constants.status.FAILED)]
+    "exception,status",
+    [
+        (aiohttp.ClientError, constants.status.RETRIAL),
+        (asyncio.TimeoutError, constants.status.RETRIAL),
+        (ResponseRejectedException, constants.status.REJECTED),
+        (Exception, constants.status.FAILED),
+    ],
 )
 @pytest.mark.asyncio
 async def test_controller_process_exceptions(factory: Factory, coro, exception, status):
@@ -284,6 +408,128 @@ async def test_controller_process_exceptions(factory: Factory, coro, exception,
     assert controller.middleware.spider.after.call_count == 0
     assert controller.pipeline.tasks.process.call_count == 0
     assert controller.pipeline.items.process.call_count == 0
+    assert controller.stats.get("downloader/rejected") == int(status == constants.status.REJECTED)
+    assert controller.session.close.call_count == 0
+
+
+@pytest.mark.asyncio
+async def test_controller_process_release(factory: Factory, coro):
+    controller = Controller(spider=factory.obj.spider.create())
+    release = mock.Mock()
+    response = Response(
+        url="url", version="1.1", status=200, reason="OK", headers=dict(), text=None, content=object(), release=release
+    )
+    controller.download = mock.Mock(side_effect=coro(mock.Mock(return_value=response)))
+    controller.spider.process = mock.Mock(side_effect=coro(mock.Mock(side_effect=ValueError)))
+
+    result = await controller.process(task=Task(url="url"))
+    assert result.status == constants.status.FAILED
+    assert release.call_count == 1
+
+
+@pytest.mark.parametrize("executor", [None, "thread", "process"])
+@pytest.mark.asyncio
+async def test_controller_parse(factory: Factory, executor):
+    response = Response(
+        url="http://localhost/",
+        version="1.1",
+        status=200,
+        reason="OK",
+        headers=dict(a="1"),
+        text="<html><nav><a href='/a/'>a</a></nav></html>",
+    )
+    task = Task(url="http://localhost/")
+    with factory.settings as s:
+        s.set(dict(SPIDER_EXECUTOR=executor, SPIDER_EXECUTOR_WORKERS=1))
+        controller = Controller(spider=Example())
+        assert (controller.executor is None) is (executor is None)
+        tasks, items = await controller.parse(task=task, response=response)
+        await controller.finalise()
+    assert tasks == {Task(url="http://localhost/a/")}
+    assert items == []
+
+
+def test_process_spider(factory: Factory, coro):
+    spider = factory.obj.spider.create()
+    spider.process = mock.Mock(side_effect=coro(mock.Mock(return_value=({Task(url="url")}, []))))
+    assert process_spider(spider=spider, task=Task(url="url"), response=None) == ({Task(url="url")}, [])
+    assert process_spider(spider=spider, task=Task(url="url"), response=None) == ({Task(url="url")}, [])
+    assert spider.process.call_count == 2
+    assert spider.process.call_args == mock.call(task=Task(url="url"), response=None)
+
+
+@pytest.mark.asyncio
+async def test_controller_download(factory: Factory, coro):
+    spider = factory.obj.spider.create()
+    controller = Controller(spider=spider)
+    controller.throttle.update = mock.Mock()
+    request = Request(url="url")
+    response = mock.Mock(status=429)
+    task = Task(url="url")
+
+    controller.downloader.process = mock.Mock(side_effect=coro(mock.Mock(return_value=response)))
+    assert await controller.download(task=task, request=request) is response
+    assert controller.throttle.update.call_count == 1
+    assert controller.throttle.update.call_args[1]["url"] == "url"
+    assert controller.throttle.update.call_args[1]["status"] == 429
+    assert controller.throttle.update.call_args[1]["latency"] >= 0
+
+    controller.downloader.process = mock.Mock(side_effect=aiohttp.ClientError())
+    with pytest.raises(aiohttp.ClientError):
+        await controller.download(task=task, request=request)
+    assert controller.throttle.update.call_count == 2
+    assert controller.throttle.update.call_args[1]["status"] == constants.status.RETRIAL
+    assert controller.stats.get("downloader/timeouts") == 0
+
+    controller.downloader.process = mock.Mock(side_effect=coro(mock.Mock(side_effect=asyncio.TimeoutError)))
+    with pytest.raises(asyncio.TimeoutError):
+        await controller.download(task=task, request=request)
+    assert controller.throttle.update.call_count == 3
+    assert controller.throttle.update.call_args[1]["status"] == constants.status.RETRIAL
+    assert controller.stats.get("downloader/timeouts") == 1
+    assert controller.watchdog.pending == dict()
+
+
+@pytest.mark.asyncio
+async def test_watchdog(factory: Factory):
+    controller = Controller(spider=factory.obj.spider.create())
+    watchdog = Watchdog(controller=controller, interval=0.01)
+    assert controller.stats.get(watchdog.key_pending) == 0
+    assert controller.stats.get(watchdog.key_cancelled) == 0
+
+    async def download(delay):
+        await asyncio.sleep(delay)
+        return delay
+
+    with factory.settings as s:
+        s.set(dict(REQUEST_DEADLINE=0.05, REQUEST_MAX_PENDING=1))
+        with watchdog:
+            assert await watchdog.watch(url="url", coro=download(delay=0)) == 0
+            with mock.patch("okami.engine.log") as log:
+                results = await asyncio.gather(
+                    watchdog.watch(url="url1", coro=download(delay=0.02)),
+                    watchdog.watch(url="url2", coro=download(delay=10)),
+                    return_exceptions=True,
+                )
+            assert results[0] == 0.02
+            assert isinstance(results[1], asyncio.TimeoutError)
+            assert log.error.call_count >= 1
+            assert log.warning.call_count == 1
+        assert watchdog.future is None
+        assert watchdog.pending == dict()
+        assert watchdog.cancelled == set()
+        assert controller.stats.get(watchdog.key_cancelled) == 1
+
+        # downloads are never cancelled without deadline
+        s.set(dict(REQUEST_DEADLINE=None))
+        future = asyncio.ensure_future(watchdog.watch(url="url", coro=download(delay=0.02)))
+        await asyncio.sleep(0)
+        pending = list(watchdog.pending)[0]
+        watchdog.pending[pending] = ("url", 0)
+        watchdog.check()
+        assert controller.stats.get(watchdog.key_pending) == 1
+        assert await future == 0.02
+        assert controller.stats.get(watchdog.key_cancelled) == 1
 
 
 @pytest.mark.asyncio
@@ -297,12 +543,16 @@ async def test_controller_finalise(factory: Factory, coro):
     controller.manager.stop = mock.Mock(side_effect=coro(mock.Mock()))
     controller.pipeline.finalise = mock.Mock(side_effect=coro(mock.Mock()))
     controller.middleware.finalise = mock.Mock(side_effect=coro(mock.Mock()))
+    controller.storage.finalise = mock.Mock()
+    controller.downloader.finalise = mock.Mock()
 
     await controller.finalise()
     assert controller.manager.stop.call_count == 1
+    assert controller.downloader.finalise.call_count == 1
     assert controller.session.close.call_count == 1
     assert controller.pipeline.finalise.call_count == 1
     assert controller.middleware.finalise.call_count == 1
+    assert controller.storage.finalise.call_count == 1
 
     await controller.finalise()
     assert controller.manager.stop.call_count == 2
@@ -318,9 +568,13 @@ def test_manager___init__():
     assert manager.storage is storage
     assert manager.terminate is False
     assert manager.retrials == set()
+    assert manager.delayed == []
     assert manager.counters == dict()
     assert manager.iterations == 0
-    assert manager.event.__class__ is asyncio.Event
+    assert manager.pending == 0
+    assert manager.throttle is None
+    assert manager.parked == dict()
+    assert manager.condition.__class__ is asyncio.Condition
     assert manager.semaphore.__class__ is asyncio.Semaphore
     assert manager.semaphore._value == settings.CONN_MAX_CONCURRENT_REQUESTS
 
@@ -346,30 +600,252 @@ def test_manager_running(queue, terminate, retrials, running, calls):
     assert storage.tasks_queued_is_empty.call_count == calls, (terminate, retrials, running, calls)
 
 
+@pytest.mark.parametrize(
+    "terminate,retrials,pending,queue,running", [
+        (False, {5}, 0, True, True),
+        (True, {5}, 0, False, False),
+        (False, set(), 1, True, True),
+        (False, set(), 0, False, True),
+        (False, set(), 0, True, False),
+    ]
+)
+def test_manager_running_pending(terminate, retrials, pending, queue, running):
+    storage = mock.Mock()
+    storage.tasks_queued_is_empty = mock.Mock(return_value=queue)
+    manager = Manager(name="name", storage=storage)
+    manager.terminate = terminate
+    manager.retrials = retrials
+    manager.pending = pending
+    assert manager.running is running
+
+
+@pytest.mark.parametrize(
+    "delay,queue,available", [
+        (0, True, True),
+        (10, True, False),
+        (None, False, True),
+        (None, True, False),
+    ]
+)
+def test_manager_available(delay, queue, available):
+    storage = mock.Mock()
+    storage.tasks_queued_is_empty = mock.Mock(return_value=queue)
+    manager = Manager(name="name", storage=storage)
+    if delay is not None:
+        manager.delay(task=5, delay=delay)
+    assert manager.available is available
+
+
+@pytest.mark.freeze_time("2016-12-23 00:00:00")
+def test_manager_delay(freezer):
+    manager = Manager(name="name", storage=mock.Mock())
+    assert manager.delayed_wait() is None
+    manager.delay(task=Task(url="b"), delay=2)
+    manager.delay(task=Task(url="a"), delay=1)
+    assert manager.retrials == {Task(url="a"), Task(url="b")}
+    assert [t for _, _, t in sorted(manager.delayed)] == [Task(url="a"), Task(url="b")]
+    assert manager.delayed_wait() == 1
+    freezer.move_to("2016-12-23 00:00:05")
+    assert manager.delayed_wait() == 0
+
+
+@pytest.mark.parametrize("retrials,minimum,maximum", [(1, 5, 6.25), (2, 10, 12.5), (3, 20, 25), (10, 60, 75)])
+def test_manager_backoff(retrials, minimum, maximum):
+    delays = [Manager.backoff(retrials=retrials) for _ in range(100)]
+    assert all(minimum <= delay <= maximum for delay in delays)
+    assert len(set(delays)) > 1
+
+
 @pytest.mark.asyncio
 async def test_manager_scheduled():
     storage = mock.Mock()
-    storage.get_tasks_queued = mock.Mock(side_effect=[222, 333])
+    storage.get_tasks_queued_batch = mock.Mock(side_effect=[[222], [333]])
+    storage.tasks_queued_is_empty = mock.Mock(return_value=False)
+
+    manager = Manager(name="name", storage=storage)
+    manager.delay(task=11, delay=0)
+    manager.delay(task=22, delay=0)
+
+    assert await manager.scheduled() in ([11], [22])
+    assert storage.get_tasks_queued_batch.call_count == 0
+    assert await manager.scheduled() in ([11], [22])
+    assert storage.get_tasks_queued_batch.call_count == 0
+    assert manager.retrials == set()
+    assert manager.pending == 2
+
+    assert [222] == await manager.scheduled()
+    assert storage.get_tasks_queued_batch.call_count == 1
+    assert storage.get_tasks_queued_batch.call_args == mock.call(size=1)
+
+    assert [333] == await manager.scheduled()
+    assert storage.get_tasks_queued_batch.call_count == 2
+    assert manager.pending == 4
+
+    storage.tasks_queued_is_empty = mock.Mock(return_value=True)
+    assert [] == await manager.scheduled()
+    assert storage.get_tasks_queued_batch.call_count == 2
+    assert manager.pending == 4
+
+
+@pytest.mark.asyncio
+async def test_manager_scheduled_batch(factory: Factory):
+    storage = Storage(name="name")
+    storage.add_tasks_queued({Task(url="url{}".format(i)) for i in range(10)})
+    manager = Manager(name="name", storage=storage)
+    manager.delay(task=Task(url="retrial1"), delay=0)
+    manager.delay(task=Task(url="retrial2"), delay=0)
+    manager.delay(task=Task(url="retrial3"), delay=60)
+
+    tasks = await manager.scheduled(size=5)
+    assert len(tasks) == 5
+    assert {Task(url="retrial1"), Task(url="retrial2")} == set(tasks[:2])
+    assert manager.retrials == {Task(url="retrial3")}
+    assert manager.pending == 5
+
+    assert len(await manager.scheduled(size=100)) == 7
+    assert manager.pending == 12
+    assert manager.retrials == {Task(url="retrial3")}
+    assert storage.tasks_queued_is_empty() is True
+
+    with factory.settings as s:
+        s.set(dict(SCHEDULER_BATCH_SIZE=3))
+        storage.add_tasks_queued({Task(url="url{}".format(i)) for i in range(10, 20)})
+        assert len(await manager.scheduled()) == 3
+
+
+@pytest.mark.freeze_time("2016-12-23 00:00:00")
+@pytest.mark.asyncio
+async def test_manager_scheduled_throttled(factory: Factory, freezer):
+    storage = Storage(name="name")
+    storage.add_tasks_queued({Task(url="http://a.com/{}/".format(i)) for i in range(3)})
+    storage.add_tasks_queued({Task(url="http://b.com/1/")})
+    throttle = Throttle(host_max_rps=1)
+    manager = Manager(name="name", storage=storage, throttle=throttle)
+
+    tasks = await manager.scheduled(size=10)
+    assert {Throttle.host(t.url) for t in tasks} == {"a.com", "b.com"}
+    assert len(tasks) == 2
+    assert manager.parked_size == 2
+    assert list(manager.parked) == [throttle.bucket(url="http://a.com/")]
+    assert manager.available is False
+    assert manager.running is True
+
+    freezer.move_to("2016-12-23 00:00:01")
+    assert manager.available is True
+    assert len(await manager.scheduled(size=10)) == 1
+    assert manager.available is False
+
+    freezer.move_to("2016-12-23 00:00:02")
+    assert len(await manager.scheduled(size=10)) == 1
+    assert manager.parked == dict()
+    assert manager.pending == 4
+
+    with factory.settings as s:
+        s.set(dict(SCHEDULER_MAX_PARKED=1))
+        storage.add_tasks_queued({Task(url="http://a.com/{}/".format(i)) for i in range(3, 6)})
+        assert len(await manager.scheduled(size=10)) == 0
+        assert manager.parked_size == 1
+        assert storage.tasks_queued_is_empty() is False
+        assert manager.available is False
+
+
+@pytest.mark.freeze_time("2016-12-23 00:00:00")
+@pytest.mark.asyncio
+async def test_manager_scheduled_circuit(freezer):
+    storage = Storage(name="name")
+    storage.add_tasks_queued({Task(url="http://a.com/1/"), Task(url="http://b.com/1/")})
+    throttle = Throttle(host_max_failures=1, host_recovery=10)
+    manager = Manager(name="name", storage=storage, throttle=throttle)
+    throttle.update(url="http://a.com/", status=constants.status.RETRIAL, latency=1.0)
+    manager.delay(task=Task(url="http://a.com/2/"), delay=0)
+
+    assert await manager.scheduled(size=10) == [Task(url="http://b.com/1/")]
+    bucket = throttle.bucket(url="http://a.com/")
+    assert manager.parked == {bucket: deque([Task(url="http://a.com/2/"), Task(url="http://a.com/1/")])}
+    assert manager.retrials == set()
+    assert manager.available is False
+
+    # half-open circuit hands out a single trial request
+    freezer.move_to("2016-12-23 00:00:10")
+    assert manager.available is True
+    assert await manager.scheduled(size=10) == [Task(url="http://a.com/2/")]
+    assert await manager.scheduled(size=10) == []
+    throttle.update(url="http://a.com/", status=200, latency=1.0)
+    assert await manager.scheduled(size=10) == [Task(url="http://a.com/1/")]
+
+
+@pytest.mark.asyncio
+async def test_manager_scheduled_circuit_parked(factory: Factory):
+    storage = Storage(name="name")
+    storage.add_tasks_queued({Task(url="http://a.com/{}/".format(i)) for i in range(20)})
+    throttle = Throttle(host_max_failures=1)
+    manager = Manager(name="name", storage=storage, throttle=throttle)
+    throttle.update(url="http://a.com/", status=constants.status.RETRIAL, latency=1.0)
+
+    # tasks of open circuit do not starve healthy hosts
+    with factory.settings as s:
+        s.set(dict(SCHEDULER_MAX_PARKED=10))
+        assert await manager.scheduled(size=5) == []
+        assert len(manager.parked[throttle.bucket(url="http://a.com/")]) == 20
+        assert manager.parked_size == 0
+        storage.add_tasks_queued({Task(url="http://b.com/{}/".format(i)) for i in range(3)})
+        assert manager.available is True
+        tasks = await manager.scheduled(size=5)
+        assert {Throttle.host(t.url) for t in tasks} == {"b.com"}
+        assert len(tasks) == 3
+
+
+@pytest.mark.asyncio
+async def test_manager_wait_parked():
+    storage = mock.Mock()
+    storage.tasks_queued_is_empty = mock.Mock(return_value=True)
+    manager = Manager(name="name", storage=storage)
+    bucket = Bucket(max_rps=100)
+    bucket.tokens = 0.0
+    manager.parked = {bucket: deque([Task(url="url")])}
+    await asyncio.wait_for(manager.wait(), timeout=1)
+    assert manager.available is True
+
+
+@pytest.mark.asyncio
+async def test_manager_wait_delayed():
+    storage = mock.Mock()
+    storage.tasks_queued_is_empty = mock.Mock(return_value=True)
+    manager = Manager(name="name", storage=storage)
+    manager.delay(task=Task(url="url"), delay=0.01)
+    assert manager.available is False
+    await asyncio.wait_for(manager.wait(), timeout=1)
+    assert manager.available is True
 
+
+@pytest.mark.asyncio
+async def test_manager_wait_done():
+    storage = mock.Mock()
+    storage.tasks_queued_is_empty = mock.Mock(return_value=True)
     manager = Manager(name="name", storage=storage)
-    manager.retrials = {11, 22}
+    manager.pending = 1
 
-    assert {11} == await manager.scheduled()
-    assert storage.get_tasks_queued.call_count == 0
-    assert {22} == await manager.scheduled()
-    assert storage.get_tasks_queued.call_count == 0
+    waiter = asyncio.ensure_future(manager.wait())
+    await asyncio.sleep(0)
+    assert waiter.done() is False
 
-    manager.retrials = set()
-    assert {222} == await manager.scheduled()
-    assert storage.get_tasks_queued.call_count == 1
+    await manager.done(tasks={Task(url="url")})
+    await asyncio.wait_for(waiter, timeout=1)
+    assert manager.pending == 0
+    assert manager.running is False
+    assert storage.add_tasks_finished.call_args == mock.call({Task(url="url")})
 
-    manager.retrials = set()
-    assert {333} == await manager.scheduled()
-    assert storage.get_tasks_queued.call_count == 2
+    manager.retrials.add(Task(url="url"))
+    await manager.done(tasks={Task(url="url"), Task(url="url2")})
+    assert storage.add_tasks_finished.call_args == mock.call({Task(url="url2")})
+    manager.retrials.clear()
 
-    with pytest.raises(RuntimeError) as e:
-        await manager.scheduled()
-    assert "RuntimeError: coroutine raised StopIteration" in str(e)
+    manager.pending = 1
+    waiter = asyncio.ensure_future(manager.wait())
+    await asyncio.sleep(0)
+    assert waiter.done() is False
+    await manager.stop()
+    await asyncio.wait_for(waiter, timeout=1)
 
 
 @pytest.mark.asyncio
@@ -380,34 +856,25 @@ async def test_manager_process(factory: Factory):
     storage.add_info_items_processed = mock.Mock()
     storage.add_tasks_failed = mock.Mock()
     manager.storage = storage
-    manager.event.is_set = mock.Mock(side_effect=[False])
-    manager.event.set = mock.Mock()
 
     items = [factory.obj.product.create(), factory.obj.product.create()]
     tasks = {Task(url="url1"), Task(url="url2")}
     task = Task(url="url")
     result = Result(status=constants.status.OK, task=task, tasks=tasks, items=items)
 
-    # test set event
     await manager.process(result=result)
     assert manager.iterations == 1
     assert manager.retrials == set()
     assert storage.add_tasks_queued.call_count == 1
     assert storage.add_info_items_processed.call_count == 1
     assert storage.add_tasks_failed.call_count == 0
-    assert manager.event.is_set.call_count == 1
-    assert manager.event.set.call_count == 1
 
-    # test not set event
-    manager.event.is_set = mock.Mock(side_effect=[True])
     await manager.process(result=result)
     assert manager.iterations == 2
     assert manager.retrials == set()
     assert storage.add_tasks_queued.call_count == 2
     assert storage.add_info_items_processed.call_count == 2
     assert storage.add_tasks_failed.call_count == 0
-    assert manager.event.is_set.call_count == 1
-    assert manager.event.set.call_count == 1
 
 
 @pytest.mark.asyncio
@@ -431,6 +898,40 @@ async def test_manager_process_retrial(factory: Factory):
                 await manager.process(result=result)
                 assert manager.iterations == i
                 assert manager.retrials == {task}
+                assert await manager.scheduled() == [task]
+
+    # retrials of isolated hosts fail on their own
+    storage = mock.Mock(get_tasks_failed=mock.Mock(return_value=[task]))
+    manager = Manager(name="name", storage=storage, throttle=Throttle())
+    with factory.settings as s:
+        s.set(dict(PAUSE_TIMEOUT=0))
+        for i in range(settings.CONN_MAX_RETRIES - 1):
+            await manager.process(result=result)
+            assert await manager.scheduled() == [task]
+        await manager.process(result=result)
+    assert manager.retrials == set()
+    assert manager.delayed == []
+    assert storage.add_tasks_failed.call_args == mock.call({task})
+    assert manager.isolated(task=task) is True
+    assert Manager(name="name", storage=storage, throttle=Throttle(host_max_failures=None)).isolated(task=task) is False
+    assert Manager(name="name", storage=storage).isolated(task=task) is False
+
+    # failures of isolated hosts count toward REQUEST_MAX_FAILED
+    storage.get_tasks_failed = mock.Mock(return_value=list(range(settings.REQUEST_MAX_FAILED)))
+    manager = Manager(name="name", storage=storage, throttle=Throttle())
+    with factory.settings as s:
+        s.set(dict(PAUSE_TIMEOUT=0, CONN_MAX_RETRIES=1))
+        with pytest.raises(exceptions.OkamiTerminationException) as e:
+            await manager.process(result=result)
+        assert "REQUEST_MAX_FAILED Reached. Terminating!" in str(e)
+
+    # retrial does not block processing
+    manager = Manager(name="name", storage=mock.Mock())
+    with mock.patch("okami.engine.asyncio.sleep") as sleep:
+        await manager.process(result=result)
+    assert sleep.call_count == 0
+    assert manager.retrials == {task}
+    assert 5 <= manager.delayed_wait() <= 6.25
 
 
 @pytest.mark.asyncio
@@ -774,6 +1275,13 @@ async def test_spider_middleware_before(factory: Factory, coro):
         for m in middleware.middlewares:
             assert mock.call(sender=m, task=task, response=response) in signal.call_args_list
 
+    # middleware returning None skips remaining middleware
+    for m in middleware.middlewares:
+        m.before = mock.Mock(side_effect=coro(mock.Mock(return_value=None)))
+    with mock.patch("okami.engine.signals.spider_middleware_started.send", side_effect=coro(mock.Mock())):
+        assert await middleware.before(task=task, response=response) is None
+        assert [m.before.call_count for m in middleware.middlewares] == [1, 0]
+
     # test exception
     for m in middleware.middlewares:
         m.before = mock.Mock(side_effect=coro(mock.Mock(side_effect=Exception)))
@@ -1187,7 +1695,7 @@ async def test_tasks_pipeline_initialise(factory: Factory, coro):
         for p in pipeline.pipelines:
             assert p.initialise.call_count == 1
             assert p.initialise.call_args == []
-        assert signal.call_count == 1
+        assert signal.call_count == len(pipeline.pipelines)
         for p in pipeline.pipelines:
             assert mock.call(sender=p) in signal.call_args_list
 
@@ -1219,8 +1727,8 @@ async def test_tasks_pipeline_process(factory: Factory, coro):
         for p in pipeline.pipelines:
             assert p.process.call_count == 1
             assert p.process.call_args == mock.call(tasks=tasks)
-        assert s1.call_count == 1
-        assert s2.call_count == 1
+        assert s1.call_count == len(pipeline.pipelines)
+        assert s2.call_count == len(pipeline.pipelines)
         for p in pipeline.pipelines:
             assert mock.call(sender=p, tasks=tasks) in s1.call_args_list
             assert mock.call(sender=p, tasks=tasks) in s2.call_args_list
@@ -1255,7 +1763,7 @@ async def test_tasks_pipeline_finalise(factory: Factory, coro):
         for p in pipeline.pipelines:
             assert p.finalise.call_count == 1
             assert p.finalise.call_args == []
-        assert signal.call_count == 1
+        assert signal.call_count == len(pipeline.pipelines)
         for p in pipeline.pipelines:
             assert mock.call(sender=p) in signal.call_args_list
 
@@ -6,11 +6,13 @@ from unittest import mock
 
 import aiohttp
 import pytest
+import yarl
+from sqlitedict import SqliteDict
 
 import okami
 from okami import constants, Request, Response, settings, Task
 from okami.engine import Controller
-from okami.middleware import Delta, DeltaSqlite, Headers, Logger, Middleware, Session
+from okami.middleware import Conditional, Delta, DeltaSqlite, Duplicates, Headers, Journal, Logger, Middleware, Session
 from tests.factory import Factory
 
 
@@ -20,6 +22,10 @@ def test_middleware___init__():
     assert middleware.controller is controller
 
 
+def incr_count(controller, prefix):
+    return len([c for c in controller.stats.incr.call_args_list if c[1]["key"].startswith(prefix)])
+
+
 @pytest.mark.asyncio
 async def test_middleware_initialise():
     middleware = Middleware(controller=object())
@@ -114,20 +120,20 @@ async def test_delta_after(factory: Factory, tmpdir):
         assert (tasks, items) == await delta.after(
             task=task, response=object(), tasks=tasks, items=items
         )
-        assert controller.stats.incr.call_count == 1
+        assert incr_count(controller, prefix="delta/") == 1
         assert delta.db == {hashlib.sha1(task.url.encode()).hexdigest(): str(time.time())}
 
         assert (tasks, items) == await delta.after(
             task=task, response=object(), tasks=tasks, items=items
         )
-        assert controller.stats.incr.call_count == 2
+        assert incr_count(controller, prefix="delta/") == 2
         assert delta.db == {hashlib.sha1(task.url.encode()).hexdigest(): str(time.time())}
 
         t1 = Task(url="url1")
         assert ({Task(url="url2")}, items) == await delta.after(
             task=t1, response=object(), tasks={Task(url="url2")}, items=items
         )
-        assert controller.stats.incr.call_count == 3
+        assert incr_count(controller, prefix="delta/") == 3
         assert delta.db == {
             hashlib.sha1(t1.url.encode()).hexdigest(): str(time.time()),
             hashlib.sha1(task.url.encode()).hexdigest(): str(time.time()),
@@ -137,13 +143,33 @@ async def test_delta_after(factory: Factory, tmpdir):
         assert ({Task(url="url2")}, items) == await delta.after(
             task=t1, response=object(), tasks={t1, Task(url="url2")}, items=items
         )
-        assert controller.stats.incr.call_count == 5
+        assert incr_count(controller, prefix="delta/") == 5
         assert delta.db == {
             hashlib.sha1(t1.url.encode()).hexdigest(): str(time.time()),
             hashlib.sha1(task.url.encode()).hexdigest(): str(time.time()),
         }
 
 
+@pytest.mark.asyncio
+async def test_delta_after_canonical(factory: Factory, tmpdir):
+    controller = Controller(spider=factory.obj.spider.create())
+    items = [factory.obj.product.create()]
+
+    with factory.settings as s:
+        s.set(dict(DELTA_ENABLED=True, DELTA_PATH=str(tmpdir), CANONICAL_ENABLED=True))
+        delta = Delta(controller=controller)
+        await delta.initialise()
+
+        # processed task is queued with canonical URL, found links are not canonical yet
+        await delta.after(task=Task(url="http://x.com/p/?a=2&b=1"), response=object(), tasks=set(), items=items)
+        tasks = {Task(url="http://X.com/p/?b=1&a=2#top"), Task(url="http://x.com/p/?a=2&b=1&utm_source=y")}
+        assert (set(), items) == await delta.after(
+            task=Task(url="http://x.com/"), response=object(), tasks=tasks, items=items
+        )
+        assert controller.stats.get("delta/skipped") == 2
+        await delta.finalise()
+
+
 @pytest.mark.freeze_time("2016-12-23 00:00:00")
 @pytest.mark.asyncio
 async def test_delta_finalise(factory: Factory, tmpdir):
@@ -163,9 +189,64 @@ async def test_delta_finalise(factory: Factory, tmpdir):
         )
         await delta.finalise()
         assert os.path.exists(delta.filename)
-        assert json.load(open(delta.filename)) == {
-            hashlib.sha1(task.url.encode()).hexdigest(): str(time.time()),
-        }
+        assert [json.loads(line) for line in open(delta.filename)] == [
+            [hashlib.sha1(task.url.encode()).hexdigest(), str(time.time())],
+        ]
+        assert delta.db.file.closed is True
+
+
+def test_journal(tmpdir):
+    filename = os.path.join(str(tmpdir), "journal.json")
+    journal = Journal(filename=filename)
+    assert os.path.exists(filename)
+    assert journal._index is None
+    assert len(journal) == 0
+    assert journal._index == dict()
+
+    journal["a"] = "1"
+    journal["b"] = "2"
+    assert "a" in journal
+    assert journal["b"] == "2"
+    assert journal == dict(a="1", b="2")
+    assert [json.loads(line) for line in open(filename)] == [["a", "1"], ["b", "2"]]
+    journal.close()
+
+    journal = Journal(filename=filename)
+    journal["a"] = "3"
+    assert journal._index is None
+    assert journal == dict(a="3", b="2")
+    assert journal.lines == 3
+    journal.close()
+
+
+def test_journal_load(tmpdir):
+    filename = os.path.join(str(tmpdir), "journal.json")
+    with open(filename, "w") as f:
+        f.write('{"a": "1", "b": "2"}\n["c", "3"]\n["d", ')
+
+    journal = Journal(filename=filename)
+    journal["e"] = "5"
+    assert journal == dict(a="1", b="2", c="3", e="5")
+    assert journal.lines == 3
+    journal.close()
+
+
+def test_journal_compact(tmpdir):
+    filename = os.path.join(str(tmpdir), "journal.json")
+    journal = Journal(filename=filename, ratio=2)
+    assert len(journal) == 0
+    journal["a"] = "1"
+    journal["a"] = "2"
+    assert journal.lines == 2
+    journal["a"] = "3"
+    assert journal.lines == 1
+    assert [json.loads(line) for line in open(filename)] == [["a", "3"]]
+    assert not os.path.exists("{}.compact".format(filename))
+
+    journal["b"] = "4"
+    assert journal == dict(a="3", b="4")
+    assert [json.loads(line) for line in open(filename)] == [["a", "3"], ["b", "4"]]
+    journal.close()
 
 
 def test_delta_sqlite___init__():
@@ -173,6 +254,7 @@ def test_delta_sqlite___init__():
     assert delta.db is None
     assert delta.key_added == "delta/added"
     assert delta.key_skipped == "delta/skipped"
+    assert delta.writes == 0
 
 
 @pytest.mark.asyncio
@@ -229,20 +311,20 @@ async def test_delta_sqlite_after(factory: Factory, tmpdir):
         assert (tasks, items) == await delta.after(
             task=task, response=object(), tasks=tasks, items=items
         )
-        assert controller.stats.incr.call_count == 1
+        assert incr_count(controller, prefix="delta/") == 1
         assert delta.db == {hashlib.sha1(task.url.encode()).hexdigest(): str(time.time())}
 
         assert (tasks, items) == await delta.after(
             task=task, response=object(), tasks=tasks, items=items
         )
-        assert controller.stats.incr.call_count == 2
+        assert incr_count(controller, prefix="delta/") == 2
         assert delta.db == {hashlib.sha1(task.url.encode()).hexdigest(): str(time.time())}
 
         t1 = Task(url="url1")
         assert ({Task(url="url2")}, items) == await delta.after(
             task=t1, response=object(), tasks={Task(url="url2")}, items=items
         )
-        assert controller.stats.incr.call_count == 3
+        assert incr_count(controller, prefix="delta/") == 3
         assert delta.db == {
             hashlib.sha1(t1.url.encode()).hexdigest(): str(time.time()),
             hashlib.sha1(task.url.encode()).hexdigest(): str(time.time()),
@@ -252,7 +334,7 @@ async def test_delta_sqlite_after(factory: Factory, tmpdir):
         assert ({Task(url="url2")}, items) == await delta.after(
             task=t1, response=object(), tasks={t1, Task(url="url2")}, items=items
         )
-        assert controller.stats.incr.call_count == 5
+        assert incr_count(controller, prefix="delta/") == 5
         assert delta.db == {
             hashlib.sha1(t1.url.encode()).hexdigest(): str(time.time()),
             hashlib.sha1(task.url.encode()).hexdigest(): str(time.time()),
@@ -274,6 +356,49 @@ async def test_delta_sqlite_finalise(factory: Factory, tmpdir):
         assert delta.db.conn is None
 
 
+def test_duplicates___init__():
+    duplicates = Duplicates(controller=object())
+    assert duplicates.fingerprints is None
+    assert duplicates.simhashes is None
+    assert duplicates.key_skipped == "duplicates/skipped"
+
+
+@pytest.mark.parametrize("simhash", [False, True])
+@pytest.mark.asyncio
+async def test_duplicates_before(factory: Factory, simhash):
+    def create(text, **kwargs):
+        return Response(url="url", version="1.1", status=200, reason="OK", headers=dict(), text=text, **kwargs)
+
+    text = "<html>{}</html>".format(" ".join("word{}".format(i) for i in range(200)))
+    task = Task(url="url")
+    controller = Controller(spider=factory.obj.spider.create())
+    duplicates = Duplicates(controller=controller)
+    response = create(text=text)
+    assert await duplicates.before(task=task, response=response) is response
+
+    with factory.settings as s:
+        s.set(dict(DUPLICATES_SIMHASH=simhash))
+        await duplicates.initialise()
+        assert (duplicates.simhashes is not None) is simhash
+        assert controller.stats.get(duplicates.key_skipped) == 0
+
+        assert await duplicates.before(task=task, response=response) is response
+        assert await duplicates.before(task=task, response=create(text=text)) is None
+        assert controller.stats.get(duplicates.key_skipped) == 1
+
+        response = create(text=text.replace("word1 ", "word "))
+        assert (await duplicates.before(task=task, response=response) is None) is simhash
+        assert controller.stats.get(duplicates.key_skipped) == 1 + simhash
+
+        response = create(text="<html>other</html>")
+        assert await duplicates.before(task=task, response=response) is response
+
+        # streamed responses are not compared
+        response = create(text=None, content=object())
+        assert await duplicates.before(task=task, response=response) is response
+        assert await duplicates.before(task=task, response=response) is response
+
+
 @pytest.mark.asyncio
 async def test_logger_after(factory: Factory, capsys):
     controller = Controller(spider=factory.obj.spider.create())
@@ -324,6 +449,132 @@ async def test_headers_before(factory: Factory):
     assert request.headers == {"User-Agent": "Okami/{}".format(okami.__version__)}
 
 
+def test_conditional___init__():
+    conditional = Conditional(controller=object())
+    assert conditional.db is None
+    assert conditional.replay is False
+    assert conditional.key_not_modified == "conditional/not_modified"
+
+
+@pytest.mark.asyncio
+async def test_conditional_initialise(factory: Factory, tmpdir):
+    controller = Controller(spider=factory.obj.spider.create())
+    conditional = Conditional(controller=controller)
+    await conditional.initialise()
+    assert conditional.db is None
+
+    with factory.settings as s:
+        s.set(dict(CONDITIONAL_ENABLED=True, CONDITIONAL_PATH=str(tmpdir), CONDITIONAL_MODE="replay"))
+        conditional = Conditional(controller=controller)
+        await conditional.initialise()
+        assert conditional.replay is True
+        assert conditional.filename == os.path.join(
+            str(tmpdir), "{}.conditional.sqlite".format(controller.spider.name)
+        )
+        assert controller.stats.get(conditional.key_not_modified) == 0
+        await conditional.finalise()
+
+        s.set(dict(CONDITIONAL_MODE="other"))
+        with pytest.raises(ValueError):
+            await Conditional(controller=controller).initialise()
+
+
+@pytest.mark.parametrize("mode", ["skip", "replay"])
+@pytest.mark.asyncio
+async def test_conditional(factory: Factory, tmpdir, mode):
+    def create(status, headers):
+        return Response(
+            url="http://localhost/", version="1.1", status=status, reason="OK", headers=headers, body=b"<html/>",
+            encoding="utf-8", release=release,
+        )
+
+    release = mock.Mock()
+    controller = Controller(spider=factory.obj.spider.create())
+    with factory.settings as s:
+        s.set(dict(CONDITIONAL_ENABLED=True, CONDITIONAL_PATH=str(tmpdir), CONDITIONAL_MODE=mode))
+        conditional = Conditional(controller=controller)
+        await conditional.initialise()
+
+        request = await conditional.before(request=Request(url="http://localhost/"))
+        assert request.headers == dict()
+
+        # responses without validators are not stored
+        response = create(status=200, headers=dict())
+        assert await conditional.after(response=response) is response
+        assert "http://localhost/" not in conditional.db
+
+        response = create(status=200, headers={"ETag": '"a"', "Last-Modified": "Fri, 23 Dec 2016 00:00:00 GMT"})
+        assert await conditional.after(response=response) is response
+        request = await conditional.before(request=Request(url="http://localhost/"))
+        assert request.headers == {"If-None-Match": '"a"', "If-Modified-Since": "Fri, 23 Dec 2016 00:00:00 GMT"}
+
+        response = create(status=304, headers=dict())
+        result = await conditional.after(response=response)
+        assert controller.stats.get(conditional.key_not_modified) == 1
+        if mode == "skip":
+            assert result is response
+            assert release.call_count == 0
+        else:
+            assert result is not response
+            assert result.status == 200
+            assert result.body == b"<html/>"
+            assert result.headers["ETag"] == '"a"'
+            assert release.call_count == 1
+
+        await conditional.finalise()
+        db = SqliteDict(filename=conditional.filename, tablename="conditional")
+        assert db["http://localhost/"]["etag"] == '"a"'
+        assert db["http://localhost/"]["body"] == (b"<html/>" if mode == "replay" else None)
+        db.close()
+
+
+@pytest.mark.parametrize("url", ["http://X.com/ä/", "http://x.com/redirected/"])
+@pytest.mark.asyncio
+async def test_conditional_request_url(factory: Factory, tmpdir, url):
+    def create(status, headers):
+        return Response(
+            url=yarl.URL("http://x.com/%C3%A4/"), version="1.1", status=status, reason="OK", headers=headers,
+            body=b"<html/>", encoding="utf-8", request_url=url,
+        )
+
+    controller = Controller(spider=factory.obj.spider.create())
+    with factory.settings as s:
+        s.set(dict(CONDITIONAL_ENABLED=True, CONDITIONAL_PATH=str(tmpdir), CONDITIONAL_MODE="replay"))
+        conditional = Conditional(controller=controller)
+        await conditional.initialise()
+
+        await conditional.after(response=create(status=200, headers={"ETag": '"a"'}))
+        request = await conditional.before(request=Request(url=url))
+        assert request.headers == {"If-None-Match": '"a"'}
+
+        result = await conditional.after(response=create(status=304, headers=dict()))
+        assert result.status == 200
+        assert result.body == b"<html/>"
+        assert result.request_url == url
+        await conditional.finalise()
+
+
+@pytest.mark.asyncio
+async def test_conditional_commit(factory: Factory, tmpdir):
+    def create(i):
+        return Response(
+            url="http://localhost/{}/".format(i), version="1.1", status=200, reason="OK", headers={"ETag": '"a"'},
+            body=b"<html/>", encoding="utf-8",
+        )
+
+    controller = Controller(spider=factory.obj.spider.create())
+    with factory.settings as s:
+        s.set(dict(CONDITIONAL_ENABLED=True, CONDITIONAL_PATH=str(tmpdir), CONDITIONAL_COMMIT_SIZE=2))
+        conditional = Conditional(controller=controller)
+        await conditional.initialise()
+        with mock.patch.object(conditional.db, "commit") as commit:
+            for i in range(5):
+                await conditional.after(response=create(i=i))
+        assert commit.call_count == 2
+        assert conditional.writes == 1
+        await conditional.finalise()
+
+
 @pytest.mark.asyncio
 async def test_session_before(factory: Factory):
     request = Request(url="url", headers={})
@@ -335,6 +586,12 @@ async def test_session_before(factory: Factory):
     assert isinstance(s1, aiohttp.ClientSession)
     assert s1.connector._limit == settings.CONN_MAX_CONCURRENT_CONNECTIONS
     assert s1.connector._ssl == settings.CONN_VERIFY_SSL
+    assert s1.connector._limit_per_host == 0
+    assert s1.connector.use_dns_cache is True
+    assert s1.connector._keepalive_timeout == settings.CONN_KEEPALIVE_TIMEOUT
+    assert s1.connector.force_close is False
+    assert controller.connections.connector is s1.connector
+    assert s1.connector._resolver is controller.resolver
 
     assert await session.before(request=request) is request
     s2 = controller.session
@@ -353,3 +610,89 @@ async def test_session_before(factory: Factory):
 
     for s in [s2, s3]:
         await s.close()
+
+    controller.session = None
+    with mock.patch("okami.middleware.aiohttp.ClientSession") as client_session:
+        assert await session.before(request=request) is request
+    assert client_session.call_args == mock.call(
+        connector=controller.connections.connector, trace_configs=[controller.connections.trace]
+    )
+    await controller.connections.connector.close()
+
+
+def test_session_connector(factory: Factory):
+    controller = Controller(spider=factory.obj.spider.create())
+    session = Session(controller=controller)
+    assert session.connector()["resolver"] is controller.resolver
+    with factory.settings as s:
+        s.set(dict(CONN_MAX_CONCURRENT_CONNECTIONS_PER_HOST=2, CONN_DNS_CACHE_TTL=None, CONN_KEEPALIVE_TIMEOUT=5))
+        kwargs = session.connector()
+        assert kwargs["limit_per_host"] == 2
+        assert kwargs["use_dns_cache"] is True
+        assert kwargs["ttl_dns_cache"] is None
+        assert kwargs["keepalive_timeout"] == 5
+        assert kwargs["force_close"] is False
+
+        s.set(dict(CONN_DNS_CACHE_TTL=0, CONN_FORCE_CLOSE=True))
+        kwargs = session.connector()
+        assert kwargs["use_dns_cache"] is False
+        assert kwargs["force_close"] is True
+        assert "keepalive_timeout" not in kwargs
+
+
+@pytest.mark.asyncio
+async def test_delta_sqlite_existing(factory: Factory, tmpdir):
+    controller = Controller(spider=factory.obj.spider.create())
+
+    with factory.settings as s:
+        s.set(dict(DELTA_ENABLED=True, DELTA_PATH=str(tmpdir)))
+        delta = DeltaSqlite(controller=controller)
+        await delta.initialise()
+        assert delta.existing(keys=set()) == set()
+
+        for i in range(5):
+            delta.db["key{}".format(i)] = "value"
+        assert delta.existing(keys={"key1", "key3", "key9"}) == {"key1", "key3"}
+        assert delta.existing(keys={"key{}".format(i) for i in range(10)}, size=2) == {
+            "key{}".format(i) for i in range(5)
+        }
+        await delta.finalise()
+
+
+@pytest.mark.asyncio
+async def test_delta_sqlite_commit(factory: Factory, tmpdir, freezer):
+    controller = Controller(spider=factory.obj.spider.create())
+    task = Task(url="url")
+    items = [[factory.obj.product.create()]]
+
+    with factory.settings as s:
+        s.set(dict(DELTA_ENABLED=True, DELTA_PATH=str(tmpdir), DELTA_COMMIT_SIZE=2, DELTA_COMMIT_INTERVAL=10))
+        delta = DeltaSqlite(controller=controller)
+        await delta.initialise()
+        delta.db.commit = mock.Mock()
+
+        delta.commit(force=True)
+        assert delta.db.commit.call_count == 0
+
+        await delta.after(task=Task(url="url1"), response=object(), tasks=set(), items=items)
+        assert delta.writes == 1
+        assert delta.db.commit.call_count == 0
+
+        await delta.after(task=Task(url="url2"), response=object(), tasks={task}, items=items)
+        assert delta.writes == 0
+        assert delta.db.commit.call_count == 1
+
+        await delta.after(task=Task(url="url3"), response=object(), tasks=set(), items=items)
+        freezer.tick(10)
+        await delta.after(task=task, response=object(), tasks=set(), items=[])
+        assert delta.writes == 0
+        assert delta.db.commit.call_count == 2
+
+        await delta.after(task=Task(url="url4"), response=object(), tasks=set(), items=items)
+        del delta.db.commit
+        await delta.finalise()
+        assert delta.writes == 0
+
+    db = SqliteDict(filename=delta.filename, tablename="delta")
+    assert len(db) == 4
+    db.close()
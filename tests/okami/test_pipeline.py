@@ -3,7 +3,7 @@ from unittest import mock
 import pytest
 
 from okami import Task
-from okami.pipeline import Cache, Cleaner, Images, Parser, Pipeline, Settings, Tasks
+from okami.pipeline import Cache, Canonical, Cleaner, Images, Parser, Pipeline, Resolve, Settings, Tasks
 from tests.factory import Factory
 
 
@@ -39,6 +39,58 @@ async def test_cache_process(factory: Factory):
     assert await pipeline.process(spider=spider) is spider
 
 
+@pytest.mark.asyncio
+async def test_canonical_process(factory: Factory):
+    task = Task(url="http://x/a?b=1")
+    tasks = {
+        task,
+        Task(url="http://x/a?utm_source=y&b=1"),
+        Task(url="HTTP://X:80/a?b=1#top"),
+        Task(url="http://www.x/a?c=1&b=1", data=1),
+    }
+    pipeline = Canonical(controller=object())
+    assert await pipeline.process(tasks=tasks) == tasks
+
+    with factory.settings as s:
+        s.set(dict(CANONICAL_ENABLED=True))
+        result = await pipeline.process(tasks=tasks)
+        assert result == {task, Task(url="http://www.x/a?b=1&c=1", data=1)}
+
+        s.set(dict(CANONICAL_SORT_QUERY=False, CANONICAL_DROP_PARAMS=(), CANONICAL_STRIP_WWW=True))
+        result = await pipeline.process(tasks=tasks)
+        assert result == {
+            task, Task(url="http://x/a?utm_source=y&b=1"), Task(url="http://x/a?c=1&b=1", data=1)
+        }
+
+
+@pytest.mark.asyncio
+async def test_resolve_process(factory: Factory):
+    controller = mock.Mock()
+    controller.session.connector = controller.connections.connector
+    tasks = {Task(url="http://x.com/a"), Task(url="https://Y.com:8443/b"), Task(url="http://127.0.0.1/")}
+    pipeline = Resolve(controller=controller)
+    assert pipeline.enabled is True
+    assert await pipeline.process(tasks=tasks) is tasks
+    assert sorted(c[1]["host"] for c in controller.resolver.prefetch.call_args_list) == ["127.0.0.1", "x.com", "y.com"]
+
+    # disabled DNS cache
+    controller.resolver.prefetch.reset_mock()
+    with factory.settings as s:
+        s.set(dict(CONN_DNS_CACHE_TTL=0))
+        assert pipeline.enabled is False
+        assert await pipeline.process(tasks=tasks) is tasks
+    assert controller.resolver.prefetch.call_count == 0
+
+    # spider session with own connector
+    controller.session.connector = mock.Mock()
+    assert pipeline.enabled is False
+    assert await pipeline.process(tasks=tasks) is tasks
+    assert controller.resolver.prefetch.call_count == 0
+
+    controller.session = None
+    assert pipeline.enabled is False
+
+
 @pytest.mark.asyncio
 async def test_cleaner_process(factory: Factory):
     items = [[factory.obj.product.create(), factory.obj.product.create()]]
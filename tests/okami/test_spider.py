@@ -12,7 +12,7 @@ from tests.factory import Factory
 async def test_base_spider():
     spider = BaseSpider()
     request = Request(url="url")
-    response = mock.Mock(text="<html></html>")
+    response = Response(url="url", version="1.1", status=200, reason="OK", headers=dict(), text="<html></html>")
 
     assert spider.name is None
     assert spider.urls is None
@@ -84,3 +84,39 @@ async def test_base_spider_tasks(factory: Factory):
         Task(url="http://localhost/allow2/"),
         Task(url="http://localhost/allow1/"),
     }
+
+
+class Chunks:
+    def __init__(self, *chunks):
+        self.chunks = chunks
+
+    async def iter_chunked(self, size):
+        for chunk in self.chunks:
+            yield chunk
+
+
+@pytest.mark.asyncio
+async def test_base_spider_process_stream():
+    spider = BaseSpider()
+    spider.stream = ("a",)
+    response = Response(
+        url="http://localhost/",
+        version="version",
+        status=constants.status.OK,
+        reason="reason",
+        headers=dict(),
+        text=None,
+        content=Chunks(b"<html><a href='/a/'>a</a><a hr", b"ef='/b/'>b</a></html>"),
+    )
+
+    with pytest.raises(SpiderException):
+        await spider.process(task=Task(url="http://localhost/"), response=response)
+
+    async def element(task, response, element):
+        return {Task(url=element.get("href"))}, [element.text]
+
+    spider.element = element
+    response.content = Chunks(b"<html><a href='/a/'>a</a><a hr", b"ef='/b/'>b</a></html>")
+    assert await spider.process(task=Task(url="http://localhost/"), response=response) == (
+        {Task(url="/a/"), Task(url="/b/")}, ["a", "b"]
+    )
@@ -1,9 +1,13 @@
+import os
 import time
+from unittest import mock
 
 import pytest
 
 from okami.api import Task
-from okami.storage import BaseStorage, Storage, queue
+from okami.storage import (
+    BaseStorage, BloomFilter, Fingerprints, ScalableBloomFilter, SimHashes, SqliteStorage, Storage, canonical, queue,
+)
 
 
 def test_base_storage___init__():
@@ -16,6 +20,11 @@ def test_base_storage_to_dict():
     assert base_storage.to_dict() == dict()
 
 
+def test_base_storage_initialise():
+    base_storage = BaseStorage(name=None)
+    assert base_storage.initialise() is None
+
+
 def test_base_storage_finalise():
     base_storage = BaseStorage(name=None)
     assert base_storage.finalise() is None
@@ -69,12 +78,28 @@ def test_base_storage_get_tasks_queued():
         base_storage.get_tasks_queued()
 
 
+def test_base_storage_get_tasks_queued_batch():
+    base_storage = BaseStorage(name=None)
+    with pytest.raises(NotImplementedError):
+        base_storage.get_tasks_queued_batch(size=2)
+
+    base_storage.tasks_queued_is_empty = lambda: False
+    base_storage.get_tasks_queued = lambda: 1
+    assert base_storage.get_tasks_queued_batch(size=2) == [1, 1]
+    assert base_storage.get_tasks_queued_batch(size=0) == []
+
+
 def test_base_storage_add_tasks_queued():
     base_storage = BaseStorage(name=None)
     with pytest.raises(NotImplementedError):
         base_storage.add_tasks_queued(values=[1, 2, 3])
 
 
+def test_base_storage_add_tasks_finished():
+    base_storage = BaseStorage(name=None)
+    assert base_storage.add_tasks_finished(values={1, 2, 3}) is None
+
+
 def test_base_storage_tasks_queued_is_empty():
     base_storage = BaseStorage(name=None)
     with pytest.raises(NotImplementedError):
@@ -121,7 +146,7 @@ def test_storage_add_tasks_failed():
 
 def test_storage_add_tasks_processed():
     storage = Storage()
-    assert storage.get_tasks_processed() == set()
+    assert len(storage.get_tasks_processed()) == 0
 
     s1 = {Task(url="a"), Task(url="b"), Task(url="c")}
     s2 = {Task(url="c"), Task(url="d"), Task(url="e")}
@@ -129,11 +154,25 @@ def test_storage_add_tasks_processed():
     storage.add_tasks_processed(values=s1)
     storage.add_tasks_processed(values=s2)
     storage.add_tasks_processed(values=s3)
-    assert storage.get_tasks_processed() == s1 | s2 | s3
+    assert all(task in storage.get_tasks_processed() for task in s1 | s2 | s3)
+    assert len(storage.get_tasks_processed()) == 8
     with pytest.raises(ValueError):
         storage.add_tasks_processed(values=[1, 2, 3])
 
 
+def test_storage_canonical():
+    def fn(task):
+        return task.url.lower()
+
+    storage = Storage(canonical=fn)
+    storage.add_tasks_queued({Task(url="A"), Task(url="b")})
+    storage.add_tasks_queued({Task(url="a"), Task(url="B", data="data")})
+    assert len(storage.get_tasks_queued_batch(size=10)) == 2
+
+    storage = Storage(canonical="okami.storage.canonical")
+    assert storage.get_tasks_processed().canonical is canonical
+
+
 def test_storage_add_tasks_queued():
     storage = Storage()
     pytest.raises(queue.Empty, storage.get_tasks_queued)
@@ -150,6 +189,19 @@ def test_storage_add_tasks_queued():
         storage.add_tasks_queued(values=[1, 2, 3])
 
 
+def test_storage_get_tasks_queued_batch():
+    storage = Storage()
+    assert storage.get_tasks_queued_batch(size=10) == []
+
+    s1 = {Task(url="a"), Task(url="b"), Task(url="c")}
+    storage.add_tasks_queued(s1)
+    tasks = storage.get_tasks_queued_batch(size=2)
+    assert len(tasks) == 2
+    tasks += storage.get_tasks_queued_batch(size=2)
+    assert s1 == set(tasks)
+    assert storage.tasks_queued_is_empty() is True
+
+
 def test_storage_finalise():
     pass
 
@@ -217,41 +269,42 @@ def test_storage_get_tasks_failed():
 
 def test_storage_get_tasks_processed():
     storage = Storage()
-    assert storage.get_tasks_processed() == set()
+    assert isinstance(storage.get_tasks_processed(), Fingerprints)
+    assert len(storage.get_tasks_processed()) == 0
 
     s1 = {Task(url="a"), Task(url="b"), Task(url="c")}
     storage.add_tasks_processed(values=s1)
-    assert storage.get_tasks_processed() == s1
+    assert all(task in storage.get_tasks_processed() for task in s1)
+    assert Task(url="d") not in storage.get_tasks_processed()
+    assert Task(url="a", data="data") not in storage.get_tasks_processed()
 
     s2 = {Task(url="c"), Task(url="d"), Task(url="e")}
     storage.add_tasks_processed(values=s2)
-    assert storage.get_tasks_processed() == s1 | s2
-
-    s3 = {Task(url=1), Task(url=2), Task(url=3)}
-    storage.add_tasks_processed(values=s3)
-    assert storage.get_tasks_processed() == s1 | s2 | s3
+    assert all(task in storage.get_tasks_processed() for task in s1 | s2)
+    assert len(storage.get_tasks_processed()) == 5
 
 
 def test_storage_get_tasks_queued():
     storage = Storage()
     pytest.raises(queue.Empty, storage.get_tasks_queued)
 
-    s1 = {"a", "b", "c"}
+    s1 = {Task(url="a"), Task(url="b"), Task(url="c")}
     storage.add_tasks_queued(s1)
     assert storage._tasks_queued.qsize() == 3
     assert s1 == {storage.get_tasks_queued() for _ in s1}
     pytest.raises(queue.Empty, storage.get_tasks_queued)
     assert storage._tasks_queued.qsize() == 0
 
-    s2 = {"c", "d", "e"}
+    s2 = {Task(url="c"), Task(url="d"), Task(url="e")}
     storage.add_tasks_queued(s2)
     assert storage._tasks_queued.qsize() == 2
-    assert {"d", "e"} == {storage.get_tasks_queued() for _ in range(2)}
+    assert {Task(url="d"), Task(url="e")} == {storage.get_tasks_queued() for _ in range(2)}
     pytest.raises(queue.Empty, storage.get_tasks_queued)
 
-    storage.add_tasks_queued({1, 2, 3})
+    s3 = {Task(url=1), Task(url=2), Task(url=3)}
+    storage.add_tasks_queued(s3)
     assert storage._tasks_queued.qsize() == 3
-    assert {1, 2, 3} == {storage.get_tasks_queued() for _ in range(3)}
+    assert s3 == {storage.get_tasks_queued() for _ in range(3)}
     pytest.raises(queue.Empty, storage.get_tasks_queued)
     assert storage._tasks_queued.qsize() == 0
 
@@ -273,7 +326,7 @@ def test_storage_tasks_queued_is_empty():
     assert storage.tasks_queued_is_empty()
     assert isinstance(storage.tasks_queued_is_empty(), bool)
 
-    storage.add_tasks_queued({i for i in "abc"})
+    storage.add_tasks_queued({Task(url=i) for i in "abc"})
     assert not storage.tasks_queued_is_empty()
     assert isinstance(storage.tasks_queued_is_empty(), bool)
 
@@ -284,9 +337,315 @@ def test_storage_to_dict():
         times_running=0.0, tasks_queued=0, tasks_processed=0, tasks_failed=0, items_processed=0, items_failed=0
     )
 
-    storage.add_tasks_queued(values={1, 2, 3})
-    storage.add_tasks_processed(values={11, 22, 33})
-    storage.add_tasks_failed(values={111, 222, 333})
+    storage.add_tasks_queued(values={Task(url=1), Task(url=2), Task(url=3)})
+    storage.add_tasks_processed(values={Task(url=11), Task(url=22), Task(url=33)})
+    storage.add_tasks_failed(values={Task(url=111), Task(url=222), Task(url=333)})
     assert storage.to_dict() == dict(
         times_running=0.0, tasks_queued=3, tasks_processed=6, tasks_failed=3, items_processed=0, items_failed=0
     )
+
+
+def test_canonical():
+    assert canonical(Task(url="http://a.com/")) == "http://a.com/\nnull"
+    assert canonical(Task(url="http://a.com/", data=dict(b=1, a=2))) == 'http://a.com/\n{"a": 2, "b": 1}'
+
+
+def test_fingerprints():
+    fingerprints = Fingerprints(capacity=4)
+    assert len(fingerprints) == 0
+    assert fingerprints.nbytes == 4 * 8
+    assert Task(url="a") not in fingerprints
+
+    assert fingerprints.add(task=Task(url="a")) is True
+    assert fingerprints.add(task=Task(url="a")) is False
+    assert Task(url="a") in fingerprints
+    assert len(fingerprints) == 1
+
+    tasks = [Task(url=str(i)) for i in range(100)]
+    fingerprints.update(values=tasks)
+    assert len(fingerprints) == 101
+    assert fingerprints.nbytes == 256 * 8
+    assert all(task in fingerprints for task in tasks)
+    assert Task(url="100") not in fingerprints
+
+
+def test_fingerprints_dump_load(tmpdir):
+    fingerprints = Fingerprints(capacity=4)
+    fingerprints.update(values=[Task(url=str(i)) for i in range(50)])
+    filename = os.path.join(str(tmpdir), "fingerprints")
+    with open(filename, "wb") as f:
+        fingerprints.dump(fp=f)
+        f.write(b"tail")
+
+    loaded = Fingerprints()
+    with open(filename, "rb") as f:
+        loaded.load(fp=f)
+        assert f.read() == b"tail"
+    assert len(loaded) == 50
+    assert loaded.table == fingerprints.table
+    assert all(Task(url=str(i)) in loaded for i in range(50))
+    assert loaded.add(task=Task(url="50")) is True
+
+
+def test_fingerprints_fingerprint():
+    fingerprints = Fingerprints()
+    fingerprint = fingerprints.fingerprint(task=Task(url="a"))
+    assert 0 < fingerprint < 2 ** 64
+    assert fingerprint == fingerprints.fingerprint(task=Task(url="a"))
+    assert fingerprint != fingerprints.fingerprint(task=Task(url="b"))
+
+
+def test_sim_hashes():
+    simhashes = SimHashes(distance=3)
+    assert [b[0] for b in simhashes.blocks] == [0, 16, 32, 48]
+    assert 0 not in simhashes
+    assert simhashes.add(value=0) is True
+    assert simhashes.add(value=0b111) is False
+    assert 0b1111 not in simhashes
+    assert (0b111 << 60) in simhashes
+    assert simhashes.add(value=0b1111) is True
+    assert len(simhashes) == 2
+
+    simhashes = SimHashes(distance=4)
+    assert simhashes.blocks[-1] == (48, 2 ** 16 - 1)
+    assert simhashes.add(value=2 ** 64 - 1) is True
+    assert (2 ** 64 - 1) ^ 0b1111 in simhashes
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    assert bloom.size == 9586
+    assert bloom.hashes == 7
+    assert len(bloom.bits) == 1199
+    assert bloom.fill_ratio == 0.0
+    assert bloom.false_positive_rate == 0.0
+
+    assert bloom.contains(h1=1, h2=3) is False
+    bloom.add(h1=1, h2=3)
+    assert bloom.contains(h1=1, h2=3) is True
+    assert bloom.count == 1
+    assert bloom.positions(h1=1, h2=3) == [1, 4, 7, 10, 13, 16, 19]
+
+    bloom.count = 1000
+    assert round(bloom.fill_ratio, 2) == 0.52
+    assert round(bloom.false_positive_rate, 2) == 0.01
+
+
+def test_scalable_bloom_filter():
+    bloom = ScalableBloomFilter(capacity=10, error_rate=0.01)
+    assert len(bloom) == 0
+    assert bloom.fill_ratio == 0.0
+    assert bloom.false_positive_rate == 0.0
+    assert Task(url="a") not in bloom
+
+    assert bloom.add(task=Task(url="a")) is True
+    assert bloom.add(task=Task(url="a")) is False
+    assert Task(url="a") in bloom
+
+    tasks = [Task(url=str(i)) for i in range(100)]
+    bloom.update(values=tasks)
+    assert all(task in bloom for task in tasks)
+    assert 95 <= len(bloom) <= 101
+    assert [(f.capacity, f.error_rate) for f in bloom.filters] == [
+        (10, 0.005), (20, 0.0025), (40, 0.00125), (80, 0.000625)
+    ]
+    assert 0.0 < bloom.fill_ratio < 1.0
+    assert 0.0 < bloom.false_positive_rate < 0.01
+
+
+def test_scalable_bloom_filter_dump_load(tmpdir):
+    bloom = ScalableBloomFilter(capacity=10)
+    bloom.update(values=[Task(url=str(i)) for i in range(50)])
+    filename = os.path.join(str(tmpdir), "bloom")
+    with open(filename, "wb") as f:
+        bloom.dump(fp=f)
+
+    loaded = ScalableBloomFilter(capacity=10)
+    with open(filename, "rb") as f:
+        loaded.load(fp=f)
+    assert len(loaded) == len(bloom)
+    assert [f.bits for f in loaded.filters] == [f.bits for f in bloom.filters]
+    assert all(Task(url=str(i)) in loaded for i in range(50))
+
+
+def test_storage_bloom(tmpdir):
+    storage = Storage(name="name", bloom=True, bloom_capacity=10, bloom_error_rate=0.01)
+    assert storage.filename is None
+    assert isinstance(storage.get_tasks_processed(), ScalableBloomFilter)
+    assert storage.to_dict() == dict(
+        times_running=0.0,
+        tasks_queued=0,
+        tasks_processed=0,
+        tasks_failed=0,
+        items_processed=0,
+        items_failed=0,
+        bloom_filters=0,
+        bloom_fill_ratio=0.0,
+        bloom_error_rate=0.0,
+    )
+
+    storage.add_tasks_queued({Task(url="a"), Task(url="b")})
+    storage.add_tasks_queued({Task(url="a"), Task(url="c")})
+    assert len(storage.get_tasks_queued_batch(size=10)) == 3
+    data = storage.to_dict()
+    assert data["tasks_processed"] == 3
+    assert data["bloom_filters"] == 1
+    assert 0.0 < data["bloom_fill_ratio"] < 1.0
+    assert 0.0 < data["bloom_error_rate"] < 0.01
+
+    # exact
+    storage = Storage(name="name", bloom=True, bloom_exact=True)
+    assert isinstance(storage.get_tasks_processed(), Fingerprints)
+    storage._tasks_bloom.add = lambda task: False
+    storage.add_tasks_queued({Task(url="a"), Task(url="b")})
+    storage.add_tasks_processed({Task(url="c")})
+    assert len(storage.get_tasks_queued_batch(size=10)) == 2
+    assert len(storage.get_tasks_processed()) == 3
+
+    # persistence
+    storage = Storage(name="name", bloom=True, path=str(tmpdir))
+    assert storage.filename == os.path.join(str(tmpdir), "name.bloom")
+    storage.initialise()
+    storage.add_tasks_queued({Task(url="a"), Task(url="b")})
+    storage.finalise()
+
+    storage = Storage(name="name", bloom=True, path=str(tmpdir))
+    storage.initialise()
+    storage.add_tasks_queued({Task(url="a"), Task(url="b"), Task(url="c")})
+    assert set(storage.get_tasks_queued_batch(size=10)) == {Task(url="a"), Task(url="b"), Task(url="c")}
+    assert storage.to_dict()["tasks_processed"] == 3
+
+    # tasks handed out but not finished are queued again
+    storage.add_tasks_finished({Task(url="a"), Task(url="b")})
+    storage.add_tasks_queued({Task(url="d", data=1)})
+    storage.finalise()
+
+    storage = Storage(name="name", bloom=True, path=str(tmpdir))
+    storage.initialise()
+    storage.add_tasks_queued({Task(url="a"), Task(url="c"), Task(url="e")})
+    assert set(storage.get_tasks_queued_batch(size=10)) == {Task(url="c"), Task(url="d", data=1), Task(url="e")}
+    storage.finalise()
+
+    # exact fingerprints
+    storage = Storage(name="exact", bloom=True, bloom_exact=True, path=str(tmpdir))
+    storage.initialise()
+    storage.add_tasks_queued({Task(url="a"), Task(url="b")})
+    storage.finalise()
+
+    storage = Storage(name="exact", bloom=True, bloom_exact=True, path=str(tmpdir))
+    storage.initialise()
+    assert len(storage.get_tasks_processed()) == 2
+    storage._tasks_bloom.add = lambda task: False
+    storage.add_tasks_queued({Task(url="a"), Task(url="c")})
+    assert set(storage.get_tasks_queued_batch(size=10)) == {Task(url="a"), Task(url="b"), Task(url="c")}
+
+
+def test_sqlite_storage___init__(tmpdir):
+    storage = SqliteStorage(name="name", path=str(tmpdir), buffer=10)
+    assert storage.filename == os.path.join(str(tmpdir), "name.storage.sqlite")
+    assert storage.buffer == 10
+    assert storage.connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert storage.tasks_queued_is_empty() is True
+    assert storage.to_dict() == dict(
+        times_running=0.0,
+        tasks_queued=0,
+        tasks_processed=0,
+        tasks_failed=0,
+        items_processed=0,
+        items_failed=0,
+    )
+    storage.finalise()
+
+
+def test_sqlite_storage_add_tasks_queued(tmpdir):
+    storage = SqliteStorage(name="name", path=str(tmpdir), buffer=2)
+    pytest.raises(queue.Empty, storage.get_tasks_queued)
+
+    s1 = {Task(url="a"), Task(url="b"), Task(url="c", data="c")}
+    storage.add_tasks_queued(s1)
+    assert storage.tasks_queued_is_empty() is False
+    assert s1 == {storage.get_tasks_queued() for _ in s1}
+    assert storage.tasks_queued_is_empty() is True
+
+    storage.add_tasks_queued({Task(url="a"), Task(url="d")})
+    assert storage.get_tasks_queued() == Task(url="d")
+    pytest.raises(queue.Empty, storage.get_tasks_queued)
+    assert storage.get_tasks_processed() == s1 | {Task(url="d")}
+    with pytest.raises(ValueError):
+        storage.add_tasks_queued(values=[1, 2, 3])
+    storage.finalise()
+
+
+def test_sqlite_storage_get_tasks_queued_batch(tmpdir):
+    storage = SqliteStorage(name="name", path=str(tmpdir), buffer=2)
+    assert storage.get_tasks_queued_batch(size=10) == []
+
+    s1 = {Task(url=str(i)) for i in range(5)}
+    storage.add_tasks_queued(s1)
+    tasks = storage.get_tasks_queued_batch(size=3)
+    assert len(tasks) == 3
+    tasks += storage.get_tasks_queued_batch(size=3)
+    assert s1 == set(tasks)
+    assert storage.tasks_queued_is_empty() is True
+    storage.finalise()
+
+
+def test_sqlite_storage_resume(tmpdir, freezer):
+    storage = SqliteStorage(name="name", path=str(tmpdir))
+    storage.set_info_time_started(time.time())
+    storage.add_info_items_processed(3)
+    storage.add_info_items_failed(2)
+    storage.add_tasks_queued({Task(url="a"), Task(url="b"), Task(url="c")})
+    storage.add_tasks_failed({Task(url="x")})
+    tasks = storage.get_tasks_queued_batch(size=2)
+    storage.add_tasks_finished({tasks[0]})
+    storage.finalise()
+
+    storage = SqliteStorage(name="name", path=str(tmpdir))
+    assert storage.get_info_time_started() == time.time()
+    assert storage.get_info_items_processed() == 3
+    assert storage.get_info_items_failed() == 2
+    assert storage.get_tasks_failed() == {Task(url="x")}
+    assert storage.to_dict()["tasks_queued"] == 2
+    assert storage.to_dict()["tasks_processed"] == 3
+    assert storage.to_dict()["tasks_failed"] == 1
+    assert set(storage.get_tasks_queued_batch(size=10)) == {Task(url="a"), Task(url="b"), Task(url="c")} - {tasks[0]}
+    storage.add_tasks_queued({Task(url="a"), Task(url="b"), Task(url="c")})
+    assert storage.tasks_queued_is_empty() is True
+    storage.finalise()
+
+    storage = SqliteStorage(name="name", path=str(tmpdir), resume=False)
+    assert storage.to_dict() == dict(
+        times_running=0.0,
+        tasks_queued=0,
+        tasks_processed=0,
+        tasks_failed=0,
+        items_processed=0,
+        items_failed=0,
+    )
+    storage.finalise()
+
+
+def test_sqlite_storage_add_tasks_processed(tmpdir):
+    storage = SqliteStorage(name="name", path=str(tmpdir))
+    assert storage.get_tasks_processed() == set()
+
+    s1 = {Task(url="a"), Task(url="b"), Task(url="c")}
+    s2 = {Task(url="c"), Task(url="d"), Task(url="e")}
+    storage.add_tasks_processed(values=s1)
+    storage.add_tasks_processed(values=s2)
+    assert storage.get_tasks_processed() == s1 | s2
+    assert storage.to_dict()["tasks_processed"] == 5
+    storage.add_tasks_queued({Task(url="e"), Task(url="f")})
+    assert storage.to_dict()["tasks_processed"] == 6
+    storage.add_tasks_failed({Task(url="a")})
+    storage.add_tasks_failed({Task(url="a"), Task(url="b")})
+    assert storage.to_dict()["tasks_failed"] == 2
+    with mock.patch.object(storage, "_count") as count:
+        storage.to_dict()
+    assert count.call_count == 0
+    with pytest.raises(ValueError):
+        storage.add_tasks_processed(values=[1, 2, 3])
+    with pytest.raises(ValueError):
+        storage.add_tasks_failed(values=[1, 2, 3])
+    storage.finalise()
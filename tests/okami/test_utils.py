@@ -1,3 +1,9 @@
+import codecs
+from unittest import mock
+
+import lxml.html
+import pytest
+
 from okami import utils
 
 URLS = [
@@ -67,3 +73,80 @@ def test_pprint(capsys):
     captured = capsys.readouterr()
     for c in ["{", "a", ":", "1", "b", ":", "2", "}"]:
         assert c in captured.out, c
+
+
+@pytest.mark.parametrize(
+    "url,expected",
+    [
+        ("http://X.com:80/a?c=2&b=1#f", "http://x.com/a?b=1&c=2"),
+        ("HTTPS://www.x.com:443", "https://x.com/"),
+        ("https://x.com:8443/a", "https://x.com:8443/a"),
+        ("http://x/a?utm_source=1&b=a%20b&fbclid=3", "http://x/a?b=a%20b"),
+        ("http://u:p@[::1]:8080/a?", "http://u:p@[::1]:8080/a"),
+        ("http://x:bad/", "http://x:bad/"),
+        ("/a?b&a#f", "/a?a&b"),
+    ],
+)
+def test_canonical_url(url, expected):
+    assert utils.canonical_url(url=url, drop_params=("utm_*", "fbclid"), strip_www=True) == expected
+
+
+@pytest.mark.parametrize(
+    "host,expected",
+    [("127.0.0.1", True), ("::1", True), ("[::1]", True), ("localhost", False), ("x.com", False), ("1.2.3", False)],
+)
+def test_is_ip_address(host, expected):
+    assert utils.is_ip_address(host) is expected
+
+
+@pytest.mark.parametrize(
+    "body,expected",
+    [
+        (codecs.BOM_UTF8 + "<p>č</p>".encode(), "utf-8"),
+        ("<p>č</p>".encode("utf-16"), "utf-16"),
+        (b"<meta charset='windows-1250'><p>\xe8</p>", "cp1250"),
+        (b"<meta http-equiv='Content-Type' content='text/html; charset=ISO-8859-2'>", "iso8859-2"),
+        (b"<meta charset='unknown'><p>a</p>", "utf-8"),
+        ("<p>č</p>".encode(), "utf-8"),
+        (b"", "utf-8"),
+    ],
+)
+def test_detect_encoding(body, expected):
+    assert utils.detect_encoding(body) == expected
+
+
+def test_detect_encoding_fallback():
+    body = "<p>café</p>".encode("cp1252")
+    with mock.patch.dict("sys.modules", chardet=None):
+        assert utils.detect_encoding(body) == "cp1252"
+        assert utils.detect_encoding(body, default="latin-1") == "latin-1"
+    with mock.patch.dict("sys.modules", chardet=mock.Mock(detect=lambda body: dict(encoding="ISO-8859-1"))):
+        assert utils.detect_encoding(body) == "ISO-8859-1"
+
+
+def test_canonical_url_options():
+    url = "http://www.x/a?utm_source=1&c=2&b=1#f"
+    assert utils.canonical_url(url=url) == "http://www.x/a?b=1&c=2&utm_source=1"
+    assert utils.canonical_url(url=url, sort_query=False, drop_fragment=False) == url
+    assert utils.canonical_url(url=url, sort_query=False, drop_params=("utm_source",)) == "http://www.x/a?c=2&b=1"
+
+
+def test_compile_xpath():
+    assert utils.compile_xpath(()) is None
+
+    xpath = utils.compile_xpath(("//a/@href", "//img/@src"))
+    assert xpath is utils.compile_xpath(("//a/@href", "//img/@src"))
+    assert xpath.path == "(//a/@href) | (//img/@src)"
+
+    document = lxml.html.document_fromstring("<p><a href='/a'>a</a><img src='/b'/><a href='/a'>a</a></p>")
+    assert xpath(document) == ["/a", "/b", "/a"]
+
+
+def test_simhash():
+    text = " ".join("word{}".format(i) for i in range(200))
+    value = utils.simhash(text=text)
+    assert 0 < value < 2 ** 64
+    assert value == utils.simhash(text=text.upper())
+    assert bin(value ^ utils.simhash(text=text + " word")).count("1") <= 3
+    assert bin(value ^ utils.simhash(text="something completely different")).count("1") > 3
+    assert utils.simhash(text="") == 0